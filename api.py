@@ -0,0 +1,129 @@
+"""Helpers for the JSON API (/api/v1/..., routes in app.py).
+
+API queries select just the columns a response needs (see the *_COLUMNS
+tuples) instead of loading User/Message objects, and the serializers
+below turn those rows into compact JSON: messages carry their author's
+id, and each author appears once in a separate "users" map.
+
+json_response() gives every response an ETag (a hash of the body, so a
+client that already has the data gets a 304) and gzips bodies big enough
+to be worth it when the client accepts gzip.
+"""
+
+import gzip
+import json
+
+from flask import request, Response
+
+from httpcache import conditional, make_etag
+from models import Message, User
+
+# Bodies smaller than this aren't worth compressing.
+GZIP_MIN_SIZE = 512
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+)
+
+AUTHOR_COLUMNS = (
+    User.username,
+    User.image_url,
+)
+
+PROFILE_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+
+def isoformat(timestamp):
+    """Naive UTC datetime as ISO 8601 with a Z."""
+
+    return timestamp.isoformat() + 'Z'
+
+
+def serialize_messages(rows, liked_ids, thumb_url):
+    """{"messages": [...], "users": {id: ...}} from message+author rows."""
+
+    messages = []
+    users = {}
+
+    for row in rows:
+        messages.append(dict(id=row.id,
+                             text=row.text,
+                             timestamp=isoformat(row.timestamp),
+                             user_id=row.user_id,
+                             liked=row.id in liked_ids))
+
+        if row.user_id not in users:
+            users[row.user_id] = dict(
+                id=row.user_id,
+                username=row.username,
+                image_url=thumb_url(row.image_url, 'timeline'))
+
+    return dict(messages=messages, users=users)
+
+
+def serialize_profile(row, following, thumb_url):
+    """Public profile from a PROFILE_COLUMNS row."""
+
+    return dict(id=row.id,
+                username=row.username,
+                image_url=thumb_url(row.image_url, 'profile'),
+                header_image_url=thumb_url(row.header_image_url, 'hero'),
+                bio=row.bio,
+                location=row.location,
+                messages_count=row.messages_count,
+                following_count=row.following_count,
+                followers_count=row.followers_count,
+                likes_count=row.likes_count,
+                following=following)
+
+
+def json_response(payload, status=200, etag=True):
+    """Compact JSON response, with an ETag and gzip when accepted.
+
+    Pass etag=False for the results of writes: a client's If-None-Match
+    mustn't turn one into a 304 that hides what the write did.
+    """
+
+    body = json.dumps(payload, separators=(',', ':')).encode('UTF-8')
+
+    if status != 200:
+        return Response(body, status, mimetype='application/json')
+
+    if etag:
+        resp = conditional(make_etag(body),
+                           lambda: Response(body, mimetype='application/json'))
+    else:
+        resp = Response(body, mimetype='application/json')
+
+    resp.vary.add('Accept-Encoding')
+
+    if (resp.status_code == 200 and
+            'gzip' in request.accept_encodings and
+            len(body) >= GZIP_MIN_SIZE):
+        resp.set_data(gzip.compress(body, compresslevel=6))
+        resp.headers['Content-Encoding'] = 'gzip'
+        if etag:
+            # the same data in a different encoding: only weakly equal
+            resp.set_etag(resp.get_etag()[0], weak=True)
+
+    return resp
+
+
+def api_error(message, status):
+    """JSON error body: {"error": message}."""
+
+    return json_response(dict(error=message), status)
@@ -1,14 +1,41 @@
+import json
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify, Response, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Like
+from api import (json_response, api_error, serialize_messages,
+                 serialize_profile, MESSAGE_COLUMNS, AUTHOR_COLUMNS,
+                 PROFILE_COLUMNS)
+from assets import Assets, build, vendor
+from caching import LRUCache, FragmentCache
+from hashing import hasher, HashingBusy
+from httpcache import conditional, make_etag, viewer_parts
+from metrics import Metrics, Gauge
+from migrations import MIGRATIONS, migrate, applied_versions
+from models import (db, connect_db, User, Message, Like, FollowersFollowee,
+                    Timeline, IdempotencyKey, follow_graph, replica_router,
+                    insert_ignoring_conflicts)
+from pagination import paginate, InvalidCursor, StreamedPage
+from profiler import Profiler
+from recommend import Recommender
+from routing import use_primary
+from search import search_users, typeahead_users, search_messages
+from thumbs import Thumbnails
 
 CURR_USER_KEY = "curr_user"
 
+# Template output pieces per chunk sent by stream_template
+STREAM_BUFFER_SIZE = 20
+
+# Longest Idempotency-Key header accepted (a UUID is 36)
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -17,12 +44,135 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Read replicas (comma-separated URLs) for GET requests; see routing.py
+replica_urls = [url.strip() for url in
+                os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+app.config['SQLALCHEMY_BINDS'] = {f'replica_{i}': url
+                                  for i, url in enumerate(replica_urls)}
+app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_PIN_SECONDS'] = int(
+    os.environ.get('REPLICA_PIN_SECONDS', 5))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = int(
+    os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 30))
+
+# Per-worker cache of logged-in users (see add_user_to_g)
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['LOG_SESSION_USER'] = False
+
+# Per-worker cache of rendered message cards (see caching.FragmentCache)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Password hashing (see hashing.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 0))
+app.config['HASH_MAX_PENDING'] = int(os.environ.get('HASH_MAX_PENDING', 32))
+app.config['HASH_TIMEOUT'] = float(os.environ.get('HASH_TIMEOUT', 30))
+
+# Resized user images (see thumbs.py)
+app.config['THUMBS_DIR'] = os.environ.get(
+    'THUMBS_DIR', os.path.join(app.instance_path, 'thumbs'))
+app.config['THUMBS_CACHE_BYTES'] = int(
+    os.environ.get('THUMBS_CACHE_BYTES', 256 * 1024 * 1024))
+app.config['THUMBS_FETCHER'] = os.environ.get('THUMBS_FETCHER', 'http')
+app.config['THUMBS_LOCAL_ROOT'] = os.environ.get('THUMBS_LOCAL_ROOT')
+
+# "Who to follow" suggestions (see recommend.py)
+app.config['RECOMMEND_COUNT'] = int(os.environ.get('RECOMMEND_COUNT', 5))
+app.config['RECOMMEND_REFRESH'] = int(
+    os.environ.get('RECOMMEND_REFRESH', 3600))
+
+# Request metrics at /metrics, summed across gunicorn workers through
+# files in METRICS_DIR when it's set (see metrics.py)
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+# Opt-in request profiling: X-Profile header or a sample (see profiler.py)
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+hasher.init_app(app)
+follow_graph.init_app(app)
+
+user_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'],
+                      ttl=app.config['USER_CACHE_TTL'])
+
+fragment_cache = FragmentCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                               max_bytes=app.config['FRAGMENT_CACHE_BYTES'])
+app.jinja_env.globals['cache_fragment'] = fragment_cache
+
+# Fingerprinted static files under /assets/ (see assets.py)
+assets = Assets(app)
+thumbnails = Thumbnails(app)
+metrics = Metrics(app)
+metrics.registry.add(Gauge(
+    'warbler_db_pool_connections',
+    'Pooled database connections, by bind and state.',
+    ('bind', 'state'), replica_router.pool_stats))
+metrics.registry.add(Gauge(
+    'warbler_db_replica_healthy',
+    '1 if every worker is using the replica, else 0.',
+    ('bind',), replica_router.replica_health, merge=min))
+metrics.registry.add(Gauge(
+    'warbler_db_replica_lag_seconds',
+    'Replication lag at the last health check.',
+    ('bind',), replica_router.replica_lag, merge=max))
+metrics.registry.add(Gauge(
+    'warbler_db_requests_routed_total',
+    'Requests whose reads went to each bind.',
+    ('bind',), replica_router.request_counts, kind='counter'))
+metrics.registry.add(Gauge(
+    'warbler_hash_pending',
+    'Password hashes queued or running in the hashing pool.',
+    (), lambda: {(): hasher.stats()['pending']}))
+metrics.registry.add(Gauge(
+    'warbler_hash_total',
+    'Password hashes and checks, by outcome.',
+    ('outcome',), hasher.outcomes, kind='counter'))
+metrics.registry.add(Gauge(
+    'warbler_hash_rehashed_total',
+    'Hashes upgraded to the configured cost at login.',
+    (), lambda: {(): hasher.stats()['rehashed']}, kind='counter'))
+profiler = Profiler(app)
+
+recommender = Recommender(load_edges=FollowersFollowee.edges,
+                          following=follow_graph.following)
+recommender.init_app(app)
+
+
+def caches():
+    """This worker's LRU caches by name (some are replaced by init_app)."""
+
+    return {'user': user_cache,
+            'fragment': fragment_cache,
+            'follow_graph': follow_graph.cache,
+            'recommend': recommender.cache}
+
+
+metrics.registry.add(Gauge(
+    'warbler_cache_requests_total',
+    'Per-worker cache lookups, by cache and result.',
+    ('cache', 'result'),
+    lambda: {key: value for name, cache in caches().items()
+             for key, value in (((name, 'hit'), cache.hits),
+                                ((name, 'miss'), cache.misses))},
+    kind='counter'))
+metrics.registry.add(Gauge(
+    'warbler_cache_entries',
+    'Entries held in per-worker caches.',
+    ('cache',),
+    lambda: {(name,): len(cache) for name, cache in caches().items()}))
 
 
 ##############################################################################
@@ -31,15 +181,55 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    The user is rebuilt from this worker's user_cache when possible, so
+    most requests skip the users lookup; static files, built assets,
+    thumbnails and /metrics skip it entirely.
+    Set LOG_SESSION_USER to log who each request ran as.
+    """
+
+    g.user = None
+
+    if (CURR_USER_KEY in session and
+            request.endpoint not in ('static', 'assets', 'thumbs',
+                                     'metrics')):
+        g.user = load_session_user(session[CURR_USER_KEY])
+
+    if app.config['LOG_SESSION_USER']:
+        app.logger.debug("before request %s", g.user)
 
-    else:
-        g.user = None
 
-    print("before request", g.user)
+def load_session_user(user_id):
+    """User for `user_id`, from user_cache or the database (or None)."""
+
+    snapshot = user_cache.get(user_id)
+
+    if snapshot is not None:
+        return User.from_snapshot(snapshot)
+
+    user = User.query.get(user_id)
+
+    if user:
+        user_cache.set(user_id, user.snapshot())
+
+    return user
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def clear_caches(context):
+    """Bulk deletes (scripts, tests) can't say which ids went away."""
+
+    if context.mapper.class_ is User:
+        user_cache.clear()
+        fragment_cache.clear()
+        follow_graph.clear()
+        recommender.clear()
+    elif context.mapper.class_ is Message:
+        fragment_cache.clear()
+    elif context.mapper.class_ is FollowersFollowee:
+        follow_graph.clear()
+        recommender.clear()
 
 
 def do_login(user):
@@ -54,6 +244,74 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+
+def paginate_messages(query, timestamp_col, id_col):
+    """Page through `query` using the ?before= cursor from the request."""
+
+    try:
+        return paginate(query,
+                        timestamp_col,
+                        id_col,
+                        before=request.args.get('before'),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    except InvalidCursor:
+        abort(400)
+
+
+def followed_ids_for_viewer(user_ids):
+    """Which of `user_ids` (a list or subquery) the logged-in user follows."""
+
+    if not g.user:
+        return set()
+
+    # (followee_id=A, follower_id=B) means "A follows B"
+    rows = (db.session
+            .query(FollowersFollowee.follower_id)
+            .filter(FollowersFollowee.followee_id == g.user.id,
+                    FollowersFollowee.follower_id.in_(user_ids)))
+
+    return {user_id for (user_id,) in rows}
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but send the page in chunks as it renders.
+
+    The request context (and so the db session and g) stays open until
+    the last chunk is sent. Queries run while streaming happen after the
+    X-DB-Queries header has gone out, so it doesn't count them.
+    """
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+
+    return Response(stream_with_context(stream))
+
+
+def who_to_follow(user_id):
+    """(id, username, image_url) rows of users suggested for `user_id`."""
+
+    ids = recommender.suggestions(user_id)
+
+    if not ids:
+        return []
+
+    rows = (db.session
+            .query(User.id, User.username, User.image_url)
+            .filter(User.id.in_(ids)))
+    by_id = {row.id: row for row in rows}
+
+    return [by_id[id] for id in ids if id in by_id]
+
+
+def liked_ids_for_viewer(messages):
+    """Ids of `messages` the logged-in user has liked (one query)."""
+
+    if not g.user:
+        return set()
+
+    return Like.liked_ids_for(g.user.id, [msg.id for msg in messages])
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -101,6 +359,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the password hash's cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,17 +385,53 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Without a query, the directory is paged by id (?after=<last id>) and
+    streamed to the browser as rows come off the database cursor.
+
+    Can take a 'q' param in querystring to search by that username
+    (ranked, paginated with 'page'; see search.py).
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = StreamedPage(db.session.query(User.id,
+                                              User.username,
+                                              User.image_url,
+                                              User.header_image_url,
+                                              User.bio),
+                             User.id,
+                             after=request.args.get('after', type=int),
+                             per_page=app.config['USERS_PER_PAGE'])
+
+        return stream_template('users/index.html',
+                               users=users,
+                               followed_ids=followed_ids_for_viewer(
+                                   users.ids()))
+
+    page = request.args.get('page', 1, type=int)
+    users, has_more = search_users(search,
+                                   page=max(page, 1),
+                                   per_page=app.config['USERS_PER_PAGE'])
+
+    return render_template('users/index.html',
+                           users=users,
+                           followed_ids=followed_ids_for_viewer(
+                               [user.id for user in users]),
+                           search=search,
+                           next_page=page + 1 if has_more else None)
+
 
-    return render_template('users/index.html', users=users)
+@app.route('/users/typeahead')
+def users_typeahead():
+    """JSON username suggestions for the search box: ?q=<prefix>."""
+
+    users = typeahead_users(request.args.get('q', ''))
+
+    return jsonify(users=[dict(id=user.id,
+                               username=user.username,
+                               image_url=user.image_url)
+                          for user in users])
 
 
 @app.route('/users/<int:user_id>')
@@ -146,15 +442,33 @@ def users_show(user_id):
 
     route = f'/users/{user_id}'
 
-    # snagging messages in order from the database;
+    # snagging messages in order from the database, a page at a time;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, route=route)
+    page = paginate_messages(Message.query.filter(Message.user_id == user_id),
+                             Message.timestamp,
+                             Message.id)
+    liked_ids = liked_ids_for_viewer(page.items)
+
+    etag = make_etag('users_show',
+                     user.id,
+                     user.profile_version,
+                     user.messages_count,
+                     user.following_count,
+                     user.followers_count,
+                     user.likes_count,
+                     [msg.id for msg in page.items],
+                     page.next_cursor,
+                     sorted(liked_ids),
+                     g.user and g.user.is_following(user),
+                     *viewer_parts())
+
+    return conditional(etag, lambda: render_template(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        liked_ids=liked_ids,
+        next_cursor=page.next_cursor,
+        route=route))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -192,9 +506,19 @@ def users_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    liked_msgs = user.liked_msgs
+    liked_msgs = (Message
+                  .query
+                  .join(Like, Like.msg_id == Message.id)
+                  .filter(Like.user_id == user_id)
+                  .options(db.joinedload(Message.author))
+                  .all())
+    liked_ids = Like.liked_ids_for(g.user.id, [msg.id for msg in liked_msgs])
 
-    return render_template('users/likes.html', user=user, messages=liked_msgs, route=route)
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=liked_msgs,
+                           liked_ids=liked_ids,
+                           route=route)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -206,10 +530,24 @@ def add_follow(follow_id):
         return redirect("/")
 
     followee = User.query.get_or_404(follow_id)
-    g.user.following.append(followee)
+    user_id = g.user.id
+
+    # Adds the follows row directly rather than through g.user.following,
+    # which would load the whole collection first. The database decides
+    # whether it's new: this worker's follow_graph may be out of date.
+    # (followee_id=A, follower_id=B) means "A follows B"
+    if insert_ignoring_conflicts(FollowersFollowee.__table__,
+                                 followee_id=user_id,
+                                 follower_id=followee.id):
+        Timeline.backfill(reader_id=user_id, author_id=followee.id)
+        User.bump_counts(user_id, following_count=1)
+        User.bump_counts(followee.id, followers_count=1)
+        recommender.invalidate(user_id)
+
     db.session.commit()
+    follow_graph.add(user_id, follow_id)
 
-    return redirect(f"/users/{g.user.id}/following")
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
@@ -220,14 +558,23 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
-    db.session.commit()
+    user_id = g.user.id
+    follow = FollowersFollowee.query.get((user_id, follow_id))
 
-    return redirect(f"/users/{g.user.id}/following")
+    if follow is not None:
+        db.session.delete(follow)
+        Timeline.prune(reader_id=user_id, author_id=follow_id)
+        User.bump_counts(user_id, following_count=-1)
+        User.bump_counts(follow_id, followers_count=-1)
+        db.session.commit()
+        follow_graph.remove(user_id, follow_id)
+        recommender.invalidate(user_id)
+
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@use_primary
 def profile():
     """Update profile for current user."""
 
@@ -240,15 +587,18 @@ def profile():
 
     if form.validate_on_submit():
 
-        user = User.authenticate(g.user.username,
-                                 form.password.data)
+        user = g.user
+
+        if user.check_password(form.password.data):
+            # re-key this user's cached message cards and profile ETags
+            user.profile_version = User.profile_version + 1
 
-        if user:
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
+            user_cache.invalidate(user.id)
             db.session.commit()
             return redirect(f'/users/{g.user.id}')
         else:
@@ -268,9 +618,40 @@ def delete_user():
 
     do_logout()
 
+    # (followee_id=A, follower_id=B) means "A follows B"
+    follows = db.session.query(FollowersFollowee)
+    User.bump_counts(follows.filter_by(followee_id=g.user.id)
+                            .with_entities(FollowersFollowee.follower_id),
+                     followers_count=-1)
+    User.bump_counts(follows.filter_by(follower_id=g.user.id)
+                            .with_entities(FollowersFollowee.followee_id),
+                     following_count=-1)
+
+    # likers of the user's messages lose one like per message they liked;
+    # then the messages go (the ORM would only null out their user_id)
+    msg_ids = db.session.query(Message.id).filter_by(user_id=g.user.id)
+    likes = Like.query.filter(Like.msg_id.in_(msg_ids))
+    liked = (db.select([db.func.count()])
+             .where(Like.user_id == User.id)
+             .where(Like.msg_id.in_(msg_ids))
+             .as_scalar())
+    (User.query
+     .filter(User.id.in_(likes.with_entities(Like.user_id)))
+     .update({User.likes_count: User.likes_count - liked},
+             synchronize_session=False))
+    likes.delete(synchronize_session=False)
+    Timeline.query.filter(Timeline.msg_id.in_(msg_ids)).delete(
+        synchronize_session=False)
+    Message.query.filter_by(user_id=g.user.id).delete(
+        synchronize_session=False)
+
+    user_cache.invalidate(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
 
+    # others' cached follow lists may include the deleted user
+    follow_graph.clear()
+
     return redirect("/signup")
 
 
@@ -291,8 +672,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # not g.user.messages.append, which loads all their messages first
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        Timeline.fan_out(msg)
+        User.bump_counts(g.user.id, messages_count=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -300,14 +685,51 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search message text: ?q=words, word* prefixes, "exact phrases".
+
+    Newest first, paginated with the same ?before= cursor as timelines.
+    """
+
+    search = request.args.get('q', '')
+
+    try:
+        page = search_messages(search,
+                               before=request.args.get('before'),
+                               per_page=app.config['MESSAGES_PER_PAGE'])
+    except InvalidCursor:
+        abort(400)
+
+    return render_template('messages/search.html',
+                           search=search,
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           liked_ids=liked_ids_for_viewer(page.items),
+                           route=request.full_path)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
     route = f'/messages/{message_id}'
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg, route=route)
+    msg = Message.query.get_or_404(message_id)
+    liked_ids = liked_ids_for_viewer([msg])
+
+    etag = make_etag('messages_show',
+                     msg.id,
+                     msg.author.profile_version,
+                     bool(liked_ids),
+                     g.user and g.user.is_following(msg.author),
+                     *viewer_parts())
+
+    return conditional(etag, lambda: render_template(
+        'messages/show.html',
+        message=msg,
+        liked_ids=liked_ids,
+        route=route))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -322,6 +744,11 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    Timeline.retract(msg.id)
+    fragment_cache.invalidate_where(lambda key: key[1] == msg.id)
+    User.bump_counts(msg.user_id, messages_count=-1)
+    User.bump_counts(db.session.query(Like.user_id).filter_by(msg_id=msg.id),
+                     likes_count=-1)
     db.session.delete(msg)
     db.session.commit()
 
@@ -338,18 +765,139 @@ def update_msg_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(msg_id)
-
-    if msg.is_liked(g.user):
-        Like.query.filter_by(msg_id=msg_id, user_id=g.user.id).delete()
-    else: 
-        like = Like(msg_id=msg_id,
-                    user_id=g.user.id)
-        db.session.add(like)
+    # the likes table's foreign key would only catch this on Postgres
+    if not db.session.query(Message.query.filter_by(id=msg_id)
+                            .exists()).scalar():
+        abort(404)
 
+    Like.toggle(g.user.id, msg_id)
     db.session.commit()
+
     return redirect(f'{route}')
 
+##############################################################################
+# JSON API (see api.py)
+
+
+def api_message_page(query, timestamp_col, id_col):
+    """JSON page of message/author rows, with the ?before= cursor applied."""
+
+    try:
+        page = paginate(query,
+                        timestamp_col,
+                        id_col,
+                        before=request.args.get('before'),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    except InvalidCursor:
+        return api_error("Invalid cursor.", 400)
+
+    payload = serialize_messages(page.items,
+                                 liked_ids_for_viewer(page.items),
+                                 thumbnails.url)
+    payload['next_cursor'] = page.next_cursor
+
+    return json_response(payload)
+
+
+@app.route('/api/v1/timeline')
+def api_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    if not g.user:
+        return api_error("Login required.", 401)
+
+    query = (db.session
+             .query(*MESSAGE_COLUMNS, *AUTHOR_COLUMNS)
+             .join(Timeline, Timeline.msg_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Timeline.user_id == g.user.id))
+
+    return api_message_page(query, Timeline.timestamp, Timeline.msg_id)
+
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    """A user's public profile and counts."""
+
+    row = (db.session
+           .query(*PROFILE_COLUMNS)
+           .filter(User.id == user_id)
+           .first())
+
+    if row is None:
+        return api_error("No such user.", 404)
+
+    # (followee_id=A, follower_id=B) means "A follows B"
+    following = bool(g.user) and db.session.query(
+        FollowersFollowee
+        .query
+        .filter_by(followee_id=g.user.id, follower_id=user_id)
+        .exists()).scalar()
+
+    return json_response(serialize_profile(row, following, thumbnails.url))
+
+
+@app.route('/api/v1/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages, newest first."""
+
+    if not db.session.query(User.query.filter_by(id=user_id)
+                            .exists()).scalar():
+        return api_error("No such user.", 404)
+
+    query = (db.session
+             .query(*MESSAGE_COLUMNS, *AUTHOR_COLUMNS)
+             .join(User, User.id == Message.user_id)
+             .filter(Message.user_id == user_id))
+
+    return api_message_page(query, Message.timestamp, Message.id)
+
+
+@app.route('/api/v1/messages/<int:msg_id>/like', methods=['POST'])
+def api_toggle_like(msg_id):
+    """Like or unlike a message: {"message_id", "liked", "likes"}.
+
+    With an Idempotency-Key header (unique per click), a retry returns
+    the first response instead of toggling again. A retry that arrives
+    while the first request is still running waits for it to commit
+    (see IdempotencyKey.claim), then gets its response.
+    """
+
+    if not g.user:
+        return api_error("Login required.", 401)
+
+    key = request.headers.get('Idempotency-Key')
+
+    if key is not None and not 0 < len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        return api_error("Invalid Idempotency-Key.", 400)
+
+    if not db.session.query(Message.query.filter_by(id=msg_id)
+                            .exists()).scalar():
+        return api_error("No such message.", 404)
+
+    if key is not None and not IdempotencyKey.claim(g.user.id, key,
+                                                    request.path):
+        db.session.rollback()
+        used = IdempotencyKey.query.get((g.user.id, key))
+        if used.path != request.path:
+            return api_error("Idempotency-Key was used for another request.",
+                             422)
+        resp = json_response(json.loads(used.response), etag=False)
+        resp.headers['Idempotent-Replayed'] = 'true'
+        return resp
+
+    payload = dict(message_id=msg_id,
+                   liked=Like.toggle(g.user.id, msg_id),
+                   likes=Like.count_for(msg_id))
+
+    if key is not None:
+        IdempotencyKey.record(g.user.id, key, json.dumps(payload))
+
+    db.session.commit()
+
+    return json_response(payload, etag=False)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -359,38 +907,126 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees, a page at a time,
+      read from the user's materialized timeline (see models.Timeline)
     """
 
     if g.user:
-        user_ids = [user.id for user in g.user.following]
-        user_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = paginate_messages(Timeline.messages_query(g.user.id),
+                                 Timeline.timestamp,
+                                 Timeline.msg_id)
 
-        return render_template('home.html', messages=messages, route='/')
+        return render_template('home.html',
+                               messages=page.items,
+                               liked_ids=liked_ids_for_viewer(page.items),
+                               next_cursor=page.next_cursor,
+                               who_to_follow=who_to_follow(g.user.id),
+                               route='/')
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    """Password hashing queue is full (or too slow): shed the request, ask
+    to retry."""
+
+    return ("Warbler is busy right now, please try again in a moment.",
+            503,
+            {"Retry-After": "1"})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Turn off caching in Flask, unless a route set its own policy
+#   (routes with cheap validators use httpcache.conditional; everything
+#   else stays uncached)
+#
+# Plain /static/ URLs stay uncached too, whatever send_file set: they're
+# not fingerprinted, so a deploy changes what they serve. Only /assets/
+# (see assets.py) is cached long-term.
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses without a cache policy."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
+    if "Cache-Control" not in req.headers or request.endpoint == 'static':
+        req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        req.headers["Pragma"] = "no-cache"
+        req.headers["Expires"] = "0"
     return req
+
+
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Rebuild users' cached message/follow/like counts from base tables."""
+
+    User.reconcile_counts()
+    db.session.commit()
+    print("User counts reconciled.")
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every home timeline from messages and follows.
+
+    Migration 5 does this when it adds timelines to an existing database;
+    run it again after loading data behind the app's back.
+    """
+
+    Timeline.rebuild()
+    db.session.commit()
+    print(f"Rebuilt timelines: {Timeline.query.count()} rows.")
+
+
+@app.cli.command('prune-idempotency-keys')
+def prune_idempotency_keys():
+    """Delete Idempotency-Key records older than a day."""
+
+    count = IdempotencyKey.prune()
+    db.session.commit()
+    print(f"Pruned {count} idempotency keys.")
+
+
+@app.cli.command('migrate')
+@click.option('--list', 'show', is_flag=True,
+              help='List migrations and whether each is applied.')
+def migrate_schema(show):
+    """Apply pending schema migrations (see migrations.py)."""
+
+    if show:
+        done = applied_versions(db.engine)
+        for migration in MIGRATIONS:
+            mark = 'x' if migration.version in done else ' '
+            print(f"[{mark}] {migration.version}: {migration.name}")
+        return
+
+    if not migrate(db.engine):
+        print("Schema is up to date.")
+
+
+@app.cli.command('build-assets')
+@click.option('--vendor', 'vendor_libs', is_flag=True,
+              help='Download CDN libraries into static/vendor/ first.')
+def build_assets(vendor_libs):
+    """Fingerprint and precompress static/ into static/dist/."""
+
+    if vendor_libs:
+        vendor(app.static_folder)
+
+    manifest = build(app.static_folder, app.config['ASSETS_DIST'])
+    assets.load_manifest()
+    print(f"Built {len(manifest)} assets into {app.config['ASSETS_DIST']}.")
+
+
+@app.cli.command('profile-token')
+def profile_token():
+    """Print an X-Profile header value that profiles a request."""
+
+    print(profiler.token())
@@ -0,0 +1,223 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything under static/ into static/dist/
+with a content hash in the file name (style.css -> style.3f2a9c1b04de.css),
+writes .gz (and .br, if the optional `brotli` package is installed)
+variants of text assets next to them, and records the mapping in
+static/dist/manifest.json. With --vendor it first downloads the CDN
+libraries base.html uses into static/vendor/ so they're served locally.
+
+Templates link assets through `asset_url()`; once built, URLs point at
+/assets/<hashed name>, which never changes content and so is served with
+a far-future, immutable Cache-Control and the best encoding the client
+accepts. Before a build, asset_url() falls back to plain /static/ URLs.
+"""
+
+import gzip
+import json
+import mimetypes
+import os
+import re
+import shutil
+from hashlib import sha256
+from urllib.request import urlopen
+
+from flask import abort, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# Worth compressing; images are already compressed.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map'}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+CSS_URL = re.compile(rb'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+# Libraries base.html loads from CDNs: {file in static/vendor/: CDN URL}.
+VENDOR_ASSETS = {
+    'bootstrap.css': 'https://unpkg.com/bootstrap/dist/css/bootstrap.css',
+    'jquery.js': 'https://unpkg.com/jquery',
+    'popper.js': 'https://unpkg.com/popper',
+    'bootstrap.js': 'https://unpkg.com/bootstrap',
+    # Font Awesome's CSS pulls its webfonts by relative URL, so it stays
+    # on the CDN rather than being vendored as a single file.
+}
+
+FONTAWESOME_URL = 'https://use.fontawesome.com/releases/v5.3.1/css/all.css'
+
+
+def vendor(static_folder):
+    """Download VENDOR_ASSETS into static/vendor/."""
+
+    vendor_folder = os.path.join(static_folder, 'vendor')
+    os.makedirs(vendor_folder, exist_ok=True)
+
+    for name, url in VENDOR_ASSETS.items():
+        with urlopen(url) as resp, \
+                open(os.path.join(vendor_folder, name), 'wb') as out:
+            shutil.copyfileobj(resp, out)
+
+
+def build(static_folder, dist_folder):
+    """Fingerprint and precompress every file in `static_folder`.
+
+    Stylesheets are done last, with their url(/static/...) references
+    rewritten to the fingerprinted URLs. Returns the manifest:
+    {logical path: hashed path}, both relative.
+    """
+
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+
+    sources = []
+
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs
+                   if os.path.abspath(os.path.join(root, d)) !=
+                   os.path.abspath(dist_folder)]
+        sources.extend(os.path.join(root, name) for name in files)
+
+    sources.sort(key=lambda path: path.endswith('.css'))
+    manifest = {}
+
+    for source in sources:
+        logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+
+        with open(source, 'rb') as f:
+            data = f.read()
+
+        if logical.endswith('.css'):
+            data = rewrite_css_urls(data, manifest)
+
+        base, ext = os.path.splitext(logical)
+        hashed = f"{base}.{sha256(data).hexdigest()[:12]}{ext}"
+
+        target = os.path.join(dist_folder, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+
+        if ext.lower() in COMPRESSIBLE:
+            compress(target, data)
+
+        manifest[logical] = hashed
+
+    with open(os.path.join(dist_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def rewrite_css_urls(css, manifest):
+    """Point url(/static/...) references in `css` at built assets."""
+
+    def replace(match):
+        hashed = manifest.get(match.group(2).decode('UTF-8'))
+        if hashed is None:
+            return match.group(0)
+        return b'url(%s/assets/%s%s)' % (match.group(1),
+                                          hashed.encode('UTF-8'),
+                                          match.group(1))
+
+    return CSS_URL.sub(replace, css)
+
+
+def compress(path, data):
+    """Write `data` to `path`.gz (and `path`.br when brotli is available)."""
+
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9))
+
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+class Assets:
+    """Serves built assets and provides asset_url()/vendor_url() to templates."""
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.dist_folder = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dist_folder = app.config.setdefault(
+            'ASSETS_DIST', os.path.join(app.static_folder, 'dist'))
+        self.load_manifest()
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals.update(asset_url=self.url,
+                                     vendor_url=self.vendor_url)
+
+    def load_manifest(self):
+        """(Re)read the manifest written by build(), if there is one."""
+
+        try:
+            with open(os.path.join(self.dist_folder, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, path):
+        """URL for static/`path`: fingerprinted if built, plain otherwise."""
+
+        hashed = self.manifest.get(path)
+
+        if hashed is None:
+            return f"/static/{path}"
+
+        return f"/assets/{hashed}"
+
+    def vendor_url(self, name):
+        """Local URL for a vendored library, or its CDN URL if not vendored."""
+
+        if name == 'fontawesome.css':
+            return FONTAWESOME_URL
+
+        path = f"vendor/{name}"
+
+        if path in self.manifest:
+            return self.url(path)
+
+        return VENDOR_ASSETS[name]
+
+    def serve(self, filename):
+        """Serve a built asset, precompressed if the client accepts it."""
+
+        if filename.endswith(('.gz', '.br')) or filename == MANIFEST:
+            abort(404)
+
+        path = os.path.join(self.dist_folder, filename)
+        dist = os.path.abspath(self.dist_folder)
+
+        if (not os.path.abspath(path).startswith(dist + os.sep) or
+                not os.path.isfile(path)):
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+        encoding = None
+
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if (candidate in request.accept_encodings and
+                    os.path.isfile(path + suffix)):
+                encoding = candidate
+                path += suffix
+                break
+
+        resp = send_file(path, mimetype=mimetype, conditional=True)
+
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+        resp.headers['Cache-Control'] = IMMUTABLE
+        resp.vary.add('Accept-Encoding')
+
+        return resp
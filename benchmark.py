@@ -0,0 +1,491 @@
+"""Replay a mix of logged-in traffic against Warbler and time it.
+
+    python benchmark.py [--scale 100x] [--requests 2000] [--concurrency 4]
+                        [--mix home=35,profile=20,like=15,follow=10,...]
+                        [--url http://127.0.0.1:8000 | --gunicorn 4]
+                        [--save NAME] [--compare NAME]
+
+--scale first generates (generator/create_csvs.py) and seeds (seed.py)
+a dataset of that size into DATABASE_URL -- which drops every table, so
+point it at a scratch database. Without it the current data is used.
+
+Requests go through app.test_client() in this process by default, with
+--url to a running server, or with --gunicorn N to a local gunicorn with
+N workers started for the run (same DATABASE_URL and SECRET_KEY). Each
+request is made as a random user: the harness signs their session cookie
+(and CSRF token) with the app's SECRET_KEY, so nobody has to log in.
+
+Per route it reports p50/p95/p99 latency, requests/sec and SQL queries
+per request (from the X-DB-Queries header, so only queries run before
+the headers are sent). --save writes the results to benchmarks/NAME.json;
+--compare reports the change against a saved run and exits 1 when a
+route's p95 grew by more than --tolerance or it issued more queries.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from flask import session
+from flask_wtf.csrf import generate_csrf
+
+from app import app, db, CURR_USER_KEY
+from models import User, Message
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'benchmarks')
+
+# Route -> share of requests
+DEFAULT_MIX = {
+    'home': 35,
+    'profile': 20,
+    'like': 15,
+    'follow': 10,
+    'post': 10,
+    'search': 10,
+}
+
+SEARCH_TERMS = ['people', 'time', 'world', 'music', 'water', 'book',
+                'friend', 'game', 'home', 'city', 'story', 'day']
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 if empty)."""
+
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+
+    return ordered[int(rank) - 1]
+
+
+def parse_mix(text):
+    """'home=3,like=1' -> {'home': 3, 'like': 1}."""
+
+    mix = {}
+
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown route {name!r}")
+        mix[name] = float(weight or 1)
+
+    return mix
+
+
+##############################################################################
+# Requests
+
+
+class VirtualUser:
+    """A logged-in user: signed session cookie plus a matching CSRF token."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.followed = set()
+
+        with app.test_request_context():
+            session[CURR_USER_KEY] = user_id
+            self.csrf_token = generate_csrf()
+            serializer = app.session_interface.get_signing_serializer(app)
+            cookie = serializer.dumps(dict(session))
+
+        self.headers = {'Cookie': f"{app.session_cookie_name}={cookie}"}
+
+
+class Workload:
+    """Picks the next (route, method, path, form) to send."""
+
+    def __init__(self, mix, user_ids, message_ids, seed=0):
+        self.routes = list(mix)
+        self.weights = [mix[route] for route in self.routes]
+        self.user_ids = user_ids
+        self.message_ids = message_ids
+        self.rng = random.Random(seed)
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def user(self):
+        user_id = self.rng.choice(self.user_ids)
+
+        if user_id not in self.users:
+            self.users[user_id] = VirtualUser(user_id)
+
+        return self.users[user_id]
+
+    def next(self):
+        with self.lock:
+            route = self.rng.choices(self.routes, self.weights)[0]
+            user = self.user()
+            return (route, user) + getattr(self, route)(user)
+
+    def home(self, user):
+        return 'GET', '/', None
+
+    def profile(self, user):
+        return 'GET', f"/users/{self.rng.choice(self.user_ids)}", None
+
+    def like(self, user):
+        # liking the same message twice unlikes it
+        msg_id = self.rng.choice(self.message_ids)
+        return ('POST', f"/messages/{msg_id}/like",
+                {'route': '/', 'csrf_token': user.csrf_token})
+
+    def follow(self, user):
+        # undo our own follows half the time, so the graph doesn't only grow
+        if user.followed and self.rng.random() < 0.5:
+            other = user.followed.pop()
+            path = f"/users/stop-following/{other}"
+        else:
+            other = self.rng.choice(self.user_ids)
+            user.followed.add(other)
+            path = f"/users/follow/{other}"
+
+        return 'POST', path, {'csrf_token': user.csrf_token}
+
+    def post(self, user):
+        words = self.rng.choices(SEARCH_TERMS, k=self.rng.randint(3, 12))
+        return ('POST', '/messages/new',
+                {'text': ' '.join(words), 'csrf_token': user.csrf_token})
+
+    def search(self, user):
+        query = urlencode({'q': self.rng.choice(SEARCH_TERMS)})
+        return 'GET', f"/messages/search?{query}", None
+
+
+class InProcessClient:
+    """Sends requests through the WSGI app in this process."""
+
+    def __init__(self):
+        self.client = app.test_client(use_cookies=False)
+
+    def send(self, method, path, form, headers):
+        resp = self.client.open(path, method=method, data=form,
+                                headers=headers)
+        resp.get_data()
+        resp.close()
+
+        return resp.status_code, resp.headers.get('X-DB-Queries')
+
+
+class HTTPClient:
+    """Sends requests over one keep-alive connection to `url`."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname,
+                                               parts.port or 80)
+
+    def send(self, method, path, form, headers):
+        body = None
+        headers = dict(headers)
+
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        self.conn.request(method, path, body, headers)
+        resp = self.conn.getresponse()
+        resp.read()
+
+        return resp.status, resp.getheader('X-DB-Queries')
+
+
+##############################################################################
+# Running
+
+
+class Results:
+    """Latencies, statuses and query counts per route."""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def record(self, route, status, seconds, queries):
+        with self.lock:
+            stats = self.routes.setdefault(
+                route, {'latencies': [], 'queries': [], 'errors': 0})
+            stats['latencies'].append(seconds)
+            if queries is not None:
+                stats['queries'].append(int(queries))
+            if status >= 500:
+                stats['errors'] += 1
+
+    def summary(self):
+        """{route: {count, rps, p50_ms, p95_ms, p99_ms, queries, errors}}."""
+
+        summary = {}
+        everything = {'latencies': [], 'queries': [], 'errors': 0}
+
+        for route, stats in sorted(self.routes.items()):
+            summary[route] = summarize(stats, self.elapsed)
+            everything['latencies'] += stats['latencies']
+            everything['queries'] += stats['queries']
+            everything['errors'] += stats['errors']
+
+        summary['all'] = summarize(everything, self.elapsed)
+
+        return summary
+
+
+def summarize(stats, elapsed):
+    latencies = stats['latencies']
+    queries = stats['queries']
+
+    return {
+        'count': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'queries': sum(queries) / len(queries) if queries else None,
+        'errors': stats['errors'],
+    }
+
+
+def run(workload, make_client, requests, concurrency=1, warmup=0):
+    """Send `warmup` untimed, then `requests` timed requests; Results."""
+
+    results = Results()
+    remaining = [warmup + requests]
+    counter = threading.Lock()
+
+    def worker():
+        client = make_client()
+
+        while True:
+            with counter:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                timed = remaining[0] < requests
+
+            route, user, method, path, form = workload.next()
+            started = time.perf_counter()
+            status, queries = client.send(method, path, form, user.headers)
+            elapsed = time.perf_counter() - started
+
+            if timed:
+                results.record(route, status, elapsed, queries)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # rps are over the whole run, warmup included, so scale it out
+    total = time.perf_counter() - started
+    results.elapsed = total * requests / (warmup + requests)
+
+    return results
+
+
+def seed_dataset(scale, data_dir):
+    """Generate CSVs at `scale` (unless already there) and seed from them."""
+
+    import seed
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    if not os.path.exists(os.path.join(data_dir, 'follows.csv')):
+        subprocess.run([sys.executable,
+                        os.path.join(here, 'generator', 'create_csvs.py'),
+                        '--scale', scale, '--out', data_dir],
+                       check=True)
+
+    seed.seed(data_dir, chunk_size=50000)
+
+
+def start_gunicorn(workers, port):
+    """gunicorn serving app:app on localhost:`port`, once it's listening."""
+
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+         '--bind', f"127.0.0.1:{port}", 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    for attempt in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+
+    proc.terminate()
+    sys.exit("gunicorn didn't start")
+
+
+##############################################################################
+# Baselines
+
+
+def save_baseline(name, summary, meta):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+
+    with open(os.path.join(BASELINE_DIR, f"{name}.json"), 'w') as f:
+        json.dump({'meta': meta, 'routes': summary}, f, indent=2,
+                  sort_keys=True)
+
+
+def load_baseline(name):
+    with open(os.path.join(BASELINE_DIR, f"{name}.json")) as f:
+        return json.load(f)['routes']
+
+
+def regressions(baseline, summary, tolerance):
+    """Routes whose p95 grew by more than `tolerance`, or that query more."""
+
+    found = []
+
+    for route, now in summary.items():
+        before = baseline.get(route)
+
+        if before is None:
+            continue
+
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append(f"{route}: p95 {before['p95_ms']:.1f}ms -> "
+                         f"{now['p95_ms']:.1f}ms")
+
+        # queries per request are deterministic enough to compare exactly,
+        # allowing for the random mix of hits and misses
+        if (now['queries'] is not None and before['queries'] is not None and
+                now['queries'] > before['queries'] + 0.5):
+            found.append(f"{route}: {before['queries']:.1f} -> "
+                         f"{now['queries']:.1f} queries/request")
+
+    return found
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'route':<10} {'count':>7} {'rps':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'5xx':>5}")
+
+    for route, stats in summary.items():
+        queries = ('-' if stats['queries'] is None
+                   else f"{stats['queries']:.1f}")
+        line = (f"{route:<10} {stats['count']:>7} {stats['rps']:>8.1f} "
+                f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+                f"{stats['p99_ms']:>8.1f} {queries:>8} {stats['errors']:>5}")
+
+        before = (baseline or {}).get(route)
+        if before and before['p95_ms']:
+            change = stats['p95_ms'] / before['p95_ms'] - 1
+            line += f"   p95 {change:+.0%}"
+
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a request mix against Warbler and time it.")
+    parser.add_argument('--scale', help='generate and seed this dataset '
+                        'first (1x, 100x, 10000x); DROPS ALL TABLES')
+    parser.add_argument('--data-dir',
+                        help='where generated CSVs go (default: '
+                        'instance/benchmark-SCALE)')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='route=weight,... from: ' + ', '.join(DEFAULT_MIX))
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--url', help='benchmark a running server instead')
+    parser.add_argument('--gunicorn', type=int, metavar='WORKERS',
+                        help='start a local gunicorn with WORKERS workers')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--save', metavar='NAME', help='save as a baseline')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 growth for --compare (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    if args.scale:
+        data_dir = args.data_dir or os.path.join(app.instance_path,
+                                                 f"benchmark-{args.scale}")
+        seed_dataset(args.scale, data_dir)
+
+    # ids are picked uniformly from these; gaps just make the odd 404
+    first_user, last_user = db.session.query(db.func.min(User.id),
+                                             db.func.max(User.id)).one()
+    first_msg, last_msg = db.session.query(db.func.min(Message.id),
+                                           db.func.max(Message.id)).one()
+    db.session.remove()
+
+    if last_user is None or last_msg is None:
+        sys.exit("no users or messages; seed the database (or use --scale)")
+
+    workload = Workload(args.mix,
+                        range(first_user, last_user + 1),
+                        range(first_msg, last_msg + 1),
+                        args.random_seed)
+
+    server = None
+    url = args.url
+
+    if args.gunicorn:
+        server = start_gunicorn(args.gunicorn, args.port)
+        url = f"http://127.0.0.1:{args.port}"
+
+    if url:
+        def make_client():
+            return HTTPClient(url)
+        target = url
+    else:
+        make_client = InProcessClient
+        target = 'in-process'
+
+    try:
+        results = run(workload, make_client, args.requests,
+                      args.concurrency, args.warmup)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = results.summary()
+    baseline = load_baseline(args.compare) if args.compare else None
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, "
+          f"{target}, {last_user:,} users")
+    print_summary(summary, baseline)
+
+    if args.save:
+        save_baseline(args.save, summary, {
+            'target': target,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'mix': args.mix,
+            'users': last_user,
+            'messages': last_msg,
+            'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+
+    if baseline is not None:
+        found = regressions(baseline, summary, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
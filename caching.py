@@ -0,0 +1,131 @@
+"""Small in-process caches.
+
+Each gunicorn worker keeps its own; nothing here is shared between
+processes, so entries should be safe to serve slightly stale (bounded by
+`ttl`) or be invalidated by the code that changes the underlying data.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class LRUCache:
+    """Thread-safe LRU cache with optional per-entry time-to-live.
+
+    Bounded by entry count and, if `max_bytes` is given, by the total
+    `sizeof` of the cached values. Counts hits and misses so callers can
+    report how well it's working.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, max_bytes=None,
+                 sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return (f"<LRUCache {len(self)}/{self.maxsize} "
+                f"hits={self.hits} misses={self.misses}>")
+
+    def get(self, key, default=None):
+        """Cached value for `key`, or `default` if missing or expired."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                value, expires, size = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Store `value`, evicting the least recently used entries if full."""
+
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (value, expires, size)
+            self.bytes += size
+
+            while self.entries and (
+                    len(self.entries) > self.maxsize or
+                    (self.max_bytes is not None and
+                     self.bytes > self.max_bytes)):
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def invalidate(self, key):
+        """Drop `key` if cached."""
+
+        with self.lock:
+            self._pop(key)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose key satisfies `predicate` (a full scan)."""
+
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Dict of size and hit/miss counters."""
+
+        with self.lock:
+            return dict(size=len(self.entries),
+                        maxsize=self.maxsize,
+                        bytes=self.bytes,
+                        max_bytes=self.max_bytes,
+                        hits=self.hits,
+                        misses=self.misses)
+
+
+class FragmentCache(LRUCache):
+    """Cache of rendered template fragments.
+
+    Registered as the `cache_fragment` template global; wrap the
+    viewer-independent part of a template in a call block keyed by
+    whatever versions it depends on:
+
+        {% call cache_fragment('home-card', msg.id, msg.author.profile_version) %}
+          ...
+        {% endcall %}
+    """
+
+    def __call__(self, *key, caller):
+        html = self.get(key)
+
+        if html is None:
+            html = Markup(caller())
+            self.set(key, html)
+
+        return html
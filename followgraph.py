@@ -0,0 +1,84 @@
+"""In-process index of who follows whom.
+
+User.is_following / is_followed_by used to load a user's whole
+following/followers collection and scan it, and templates call them once
+per card. FollowGraph keeps, per user id, the sorted ids of the users
+they follow in an array('q') (8 bytes an edge, versus a full ORM object),
+so a check is a binary search on an already-loaded array.
+
+Adjacency is loaded one user at a time, on first use, and held in an
+LRU cache with a TTL like the session user cache: add_follow and
+stop_following update this worker's copy as they commit, and other
+workers see the change once their copy expires.
+"""
+
+from array import array
+from bisect import bisect_left
+
+from caching import LRUCache
+
+
+class FollowGraph:
+    """Per-worker cache of follow adjacency, keyed by follower id.
+
+    `load(user_id)` returns the ids `user_id` follows, in ascending order.
+    """
+
+    def __init__(self, load, maxsize=10000, ttl=60):
+        self.load = load
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def init_app(self, app):
+        """Size the cache from FOLLOW_GRAPH_SIZE and FOLLOW_GRAPH_TTL."""
+
+        self.cache = LRUCache(
+            maxsize=app.config.setdefault('FOLLOW_GRAPH_SIZE', 10000),
+            ttl=app.config.setdefault('FOLLOW_GRAPH_TTL', 60))
+
+    def following(self, user_id):
+        """Sorted array of the ids `user_id` follows."""
+
+        ids = self.cache.get(user_id)
+
+        if ids is None:
+            ids = array('q', self.load(user_id))
+            self.cache.set(user_id, ids)
+
+        return ids
+
+    def is_following(self, follower_id, followee_id):
+        """Does `follower_id` follow `followee_id`?"""
+
+        ids = self.following(follower_id)
+        i = bisect_left(ids, followee_id)
+
+        return i < len(ids) and ids[i] == followee_id
+
+    # Arrays are replaced rather than changed in place, so a check running
+    # in another thread never sees one half-updated.
+
+    def add(self, follower_id, followee_id):
+        """Record a committed follow (if the follower is loaded)."""
+
+        ids = self.cache.get(follower_id)
+
+        if ids is not None:
+            i = bisect_left(ids, followee_id)
+            if i == len(ids) or ids[i] != followee_id:
+                self.cache.set(follower_id,
+                               ids[:i] + array('q', [followee_id]) + ids[i:])
+
+    def remove(self, follower_id, followee_id):
+        """Record a committed unfollow (if the follower is loaded)."""
+
+        ids = self.cache.get(follower_id)
+
+        if ids is not None:
+            i = bisect_left(ids, followee_id)
+            if i < len(ids) and ids[i] == followee_id:
+                self.cache.set(follower_id, ids[:i] + ids[i + 1:])
+
+    def clear(self):
+        """Forget everything (after deleting users or bulk changes)."""
+
+        self.cache.clear()
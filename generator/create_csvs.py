@@ -2,15 +2,39 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. benchmark datasets:
+
+    python generator/create_csvs.py --scale 100x --out /tmp/warbler-100x
+    python seed.py --data-dir /tmp/warbler-100x
+
+Output depends only on --scale (or the explicit counts) and --seed: every
+chunk of rows draws from its own Random seeded by (seed, table, chunk), so
+the files come out byte-for-byte the same whatever --processes is. Nothing
+touches the network.
+
+Follows are sampled per follower rather than from the list of all pairs:
+how many people a user follows is drawn from a Pareto distribution (most
+follow a few, some follow thousands), and who they follow is picked in
+proportion to rank ** -POPULARITY_SKEW, so a few accounts get a large
+share of all followers. Posting is skewed the same way (more gently), but
+over an independent ranking.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import os
+import random
+import sys
+import time
+from array import array
+from bisect import bisect
+from datetime import datetime
+from itertools import accumulate
+from multiprocessing import Pool
+
+from helpers import (IMAGE_URLS, HEADER_IMAGE_URLS, PASSWORD, WORDS,
+                     place, random_datetime, sentence)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -18,60 +42,253 @@ USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'heade
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# (users, messages, follows)
+SCALES = {
+    '1x': (300, 1000, 5000),
+    '100x': (30000, 100000, 500000),
+    '10000x': (3000000, 10000000, 50000000),
+}
+
+# Messages are dated within two years before this (fixed, so reruns match)
+END_DATE = datetime(2018, 11, 1)
+
+# Rows of users / messages, or followers, generated per task
+CHUNK_SIZE = 10000
+
+# Tail exponent of follows-per-user; lower is more skewed
+FOLLOWING_ALPHA = 1.5
+
+# Nobody follows more than this many (or a quarter of all) users
+MAX_FOLLOWING = 5000
+
+# Weight of the k-th most popular user is k ** -skew
+POPULARITY_SKEW = 0.8
+ACTIVITY_SKEW = 0.5
+
+# Set in each worker by init_worker
+state = None
+
+
+def chunk_rng(seed, table, chunk):
+    """Random for one chunk of one table, independent of the others."""
+
+    return random.Random(f"{seed}:{table}:{chunk}")
+
+
+def cumulative_weights(count, skew):
+    """Running totals of rank ** -skew for ranks 1..count."""
+
+    return array('d', accumulate(k ** -skew for k in range(1, count + 1)))
+
+
+def weighted_choice(rng, cumulative):
+    """Index picked with probability proportional to its weight."""
+
+    return bisect(cumulative, rng.random() * cumulative[-1])
+
+
+def following_scale(mean, cap, seed):
+    """Multiplier for Pareto draws so follows-per-user averages `mean`.
+
+    Found by bisection over a fixed sample, since the cap (and rounding)
+    pulls the mean of the capped distribution below the plain one.
+    """
+
+    rng = random.Random(f"{seed}:scale")
+    draws = [(1 - rng.random()) ** (-1 / FOLLOWING_ALPHA)
+             for _ in range(20000)]
+
+    def sample_mean(scale):
+        return sum(min(cap, max(1, round(scale * x))) for x in draws) / len(draws)
+
+    low, high = 0.0, float(cap)
+    for _ in range(40):
+        mid = (low + high) / 2
+        if sample_mean(mid) < mean:
+            low = mid
+        else:
+            high = mid
+
+    return high
+
+
+class State:
+    """What every worker needs to generate any chunk."""
+
+    def __init__(self, num_users, num_messages, num_follows, seed):
+        self.num_users = num_users
+        self.num_messages = num_messages
+        self.seed = seed
+
+        # rank -> user id, so popularity isn't tied to signup order, and
+        # the busiest posters aren't the most followed (which would
+        # multiply the size of everyone's home timeline)
+        self.by_rank = array('l', range(1, num_users + 1))
+        random.Random(f"{seed}:ranks").shuffle(self.by_rank)
+        self.by_activity = array('l', range(1, num_users + 1))
+        random.Random(f"{seed}:activity").shuffle(self.by_activity)
+
+        self.popularity = cumulative_weights(num_users, POPULARITY_SKEW)
+        self.activity = cumulative_weights(num_users, ACTIVITY_SKEW)
 
-fake = Faker()
+        self.max_following = max(1, min(MAX_FOLLOWING, (num_users - 1) // 4))
+        self.following_scale = following_scale(num_follows / num_users,
+                                               self.max_following, seed)
 
-# Generate random profile image URLs to use for users
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+def init_worker(*args):
+    global state
+    state = State(*args)
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def to_csv(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
+def users_chunk(chunk, start, stop):
+    rng = chunk_rng(state.seed, 'users', chunk)
+    rows = []
+
+    for user_id in range(start + 1, stop + 1):
+        # the id suffix keeps usernames (and so emails) unique
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+        rows.append((
+            f"{username}@example.com",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD,
+            sentence(rng, 4, 10),
+            rng.choice(HEADER_IMAGE_URLS),
+            place(rng),
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    return to_csv(rows), len(rows)
+
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+def messages_chunk(chunk, start, stop):
+    rng = chunk_rng(state.seed, 'messages', chunk)
+    rows = []
+
+    for _ in range(start, stop):
+        text = ' '.join(sentence(rng, 3, 12) for _ in range(rng.randint(1, 4)))
+        rows.append((
+            text[:MAX_WARBLER_LENGTH],
+            random_datetime(rng, END_DATE),
+            state.by_activity[weighted_choice(rng, state.activity)],
         ))
 
-# Generate follows.csv from random pairings of users
+    return to_csv(rows), len(rows)
+
+
+def follows_chunk(chunk, start, stop):
+    """Follows of users start+1..stop, each user's in ascending order."""
+
+    rng = chunk_rng(state.seed, 'follows', chunk)
+    rows = []
+
+    for user_id in range(start + 1, stop + 1):
+        x = (1 - rng.random()) ** (-1 / FOLLOWING_ALPHA)
+        wanted = min(state.max_following,
+                     max(1, round(state.following_scale * x)))
+
+        # rejection sampling; the cap keeps collisions rare, and the
+        # attempt limit bounds the odd unlucky user
+        followed = set()
+        for attempt in range(wanted * 4):
+            other = state.by_rank[weighted_choice(rng, state.popularity)]
+            if other != user_id:
+                followed.add(other)
+                if len(followed) == wanted:
+                    break
+
+        # (followee_id, follower_id) means "followee_id follows follower_id"
+        rows.extend((user_id, other) for other in sorted(followed))
+
+    return to_csv(rows), len(rows)
+
+
+GENERATORS = {
+    'users': users_chunk,
+    'messages': messages_chunk,
+    'follows': follows_chunk,
+}
+
+
+def run_task(task):
+    table, chunk, start, stop = task
+    return GENERATORS[table](chunk, start, stop)
+
+
+def tasks(table, count):
+    for chunk, start in enumerate(range(0, count, CHUNK_SIZE)):
+        yield table, chunk, start, min(start + CHUNK_SIZE, count)
+
+
+def generate(out, num_users, num_messages, num_follows, seed=0,
+             processes=None):
+    """Write users.csv, messages.csv and follows.csv into `out`.
+
+    follows.csv holds roughly (not exactly) `num_follows` rows.
+    """
+
+    os.makedirs(out, exist_ok=True)
+
+    tables = [
+        ('users', USERS_CSV_HEADERS, num_users),
+        ('messages', MESSAGES_CSV_HEADERS, num_messages),
+        ('follows', FOLLOWS_CSV_HEADERS, num_users),
+    ]
+
+    args = (num_users, num_messages, num_follows, seed)
+
+    with Pool(processes, initializer=init_worker, initargs=args) as pool:
+        for table, headers, count in tables:
+            started = time.perf_counter()
+            rows = 0
+
+            with open(os.path.join(out, f"{table}.csv"), 'w',
+                      newline='') as f:
+                csv.writer(f).writerow(headers)
+
+                # imap returns chunks in order, however they're scheduled
+                for text, n in pool.imap(run_task, tasks(table, count)):
+                    f.write(text)
+                    rows += n
+
+            elapsed = time.perf_counter() - started
+            print(f"{table:<10} {rows:>12,} rows {elapsed:8.2f}s "
+                  f"({rows / elapsed:,.0f} rows/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSV fixtures (no network needed).")
+    parser.add_argument('--scale', choices=SCALES, default='1x',
+                        help='preset sizes (default: 1x, the committed CSVs)')
+    parser.add_argument('--users', type=int, help='override the preset')
+    parser.add_argument('--messages', type=int, help='override the preset')
+    parser.add_argument('--follows', type=int, help='override the preset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.dirname(__file__) or '.',
+                        help='output directory (default: generator/)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    users, messages, follows = SCALES[args.scale]
+    users = args.users or users
+    messages = args.messages or messages
+    follows = args.follows or follows
+
+    if users < 2:
+        sys.exit("need at least 2 users")
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    started = time.perf_counter()
+    generate(args.out, users, messages, follows, args.seed, args.processes)
+    print(f"done in {time.perf_counter() - started:.2f}s")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,175 @@
-"""Support functions for CSV generation."""
+"""Support data and functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is local, so datasets can be generated without network
+access: header images are a fixed list (captured once from splashbase),
+and text, names and places are assembled from small word lists.
+"""
 
+from datetime import timedelta
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
 
-    return datetime.fromtimestamp(random_timestamp)
+HEADER_IMAGE_URLS = [
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0uemhCk1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh121HEWa1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh17lfd9R1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1uhYnog1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh25vNOvI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh29fxz111st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh2m1hnS81st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x80NkDu1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x9xqeef1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xdqmle51st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xfarCvW1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xijE2nr1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq4kHmAg1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq69jlcS1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq8fyQwI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqamedKu1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqdfx05t1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqfpSTPN1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqhxFulr1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqj9QUeq1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqkkwK2M1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s1hAudo1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s32zb6l1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s661UgK1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s995bvI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6f50W261st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6l06zXi1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6poZxE51st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg',
+]
+
+WORDS = """
+able about account across act action activity actually add address admit
+adult affect after again against agency agent agree ahead air allow almost
+alone along already also although always among amount analysis and animal
+another answer anyone anything appear apply approach area argue arm around
+arrive art article artist assume attack attention author available avoid
+away baby back bad bag ball bank bar base beat beautiful because become bed
+before begin behavior behind believe benefit best better between beyond big
+bill billion bit black blood blue board body book born both box boy break
+bring brother budget build building business buy call camera campaign can
+cancer candidate capital car card care career carry case catch cause cell
+center central century certain chair challenge chance change character
+charge check child choice choose church citizen city civil claim class clear
+close coach cold collection college color come commercial common community
+company compare computer concern condition conference consider consumer
+contain continue control cost could country couple course court cover create
+crime cultural culture cup current customer cut dark data daughter day dead
+deal death debate decade decide decision deep defense degree democratic
+describe design despite detail determine develop difference different
+difficult dinner direction director discover discuss disease doctor dog door
+down draw dream drive drop drug during each early east easy eat economic
+economy edge education effect effort eight either election else employee end
+energy enjoy enough enter entire environment especially establish even
+evening event ever every evidence exactly example executive exist expect
+experience expert explain eye face fact factor fail fall family far fast
+father fear federal feel feeling few field fight figure fill film final
+finally financial find fine finger finish fire firm first fish five floor fly
+focus follow food foot force foreign forget form former forward four free
+friend front full fund future game garden gas general generation girl give
+glass goal good government great green ground group grow growth guess gun guy
+hair half hand hang happen happy hard have head health hear heart heat heavy
+help her here herself high himself history hit hold home hope hospital hot
+hotel hour house however huge human hundred husband idea identify image
+imagine impact important improve include increase indeed indicate individual
+industry information inside instead institution interest interview investment
+issue item itself job join just keep key kid kill kind kitchen know knowledge
+land language large last late later laugh law lawyer lay lead leader learn
+least leave left leg legal less letter level lie life light like likely line
+list listen little live local long look lose loss lot love low machine
+magazine main maintain major majority make manage management manager many
+market marriage material matter may maybe mean measure media medical meet
+meeting member memory mention message method middle might military million
+mind minute miss mission model modern moment money month more morning most
+mother mouth move movement movie much music must myself name nation national
+natural nature near nearly necessary need network never news newspaper next
+nice night none nor north note nothing notice now number occur off offer
+office officer official often oil old once one only onto open operation
+opportunity option order organization other others our out outside over own
+owner page pain painting paper parent part participant particular partner
+party pass past patient pattern pay peace people per perform perhaps period
+person personal phone physical pick picture piece place plan plant play
+player point police policy political politics poor popular population
+position positive possible power practice prepare present president pressure
+pretty prevent price private probably problem process produce product
+production professional professor program project property protect prove
+provide public pull purpose push put quality question quickly quite race
+radio raise range rate rather reach read ready real reality realize really
+reason receive recent recently recognize record red reduce reflect region
+relate relationship religious remain remember remove report represent
+require research resource respond response rest result return reveal rich
+right rise risk road rock role room rule run safe same save say scene school
+science scientist score sea season seat second section security see seek
+seem sell send senior sense series serious serve service set seven several
+shake share she shoot short shot should shoulder show side sign significant
+similar simple simply since sing single sister sit site situation six size
+skill skin small smile social society soldier some somebody someone
+something sometimes son song soon sort sound source south southern space
+speak special specific speech spend sport spring staff stage stand standard
+star start state statement station stay step still stock stop store story
+strategy street strong structure student study stuff style subject success
+successful such suddenly suffer suggest summer support sure surface system
+table take talk task tax teach teacher team technology television tell ten
+tend term test than thank that their them themselves then theory there these
+they thing think third this those though thought thousand threat three
+through throughout throw thus time today together tonight too top total tough
+toward town trade traditional training travel treat treatment tree trial
+trip trouble true truth try turn type under understand unit until upon use
+usually value various very victim view violence visit voice vote wait walk
+wall want war watch water way weapon wear week weight well west western what
+whatever when where whether which while white whole whom whose why wide wife
+will win wind window wish with within without woman wonder word work worker
+world worry would write writer wrong yard yeah year yes yet you young your
+yourself
+""".split()
+
+PLACE_PREFIXES = ['', '', '', 'East ', 'West ', 'North ', 'South ', 'New ',
+                  'Lake ', 'Port ']
+PLACE_SUFFIXES = ['burgh', 'ton', 'ville', 'side', 'mouth', 'land', 'fort',
+                  'haven', 'berg', 'port', 'view', 'chester', 'bury', 'stad']
+
+
+def sentence(rng, min_words, max_words):
+    """Random capitalized sentence of `min_words` to `max_words` words."""
+
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def place(rng):
+    """Random made-up town name."""
+
+    return (rng.choice(PLACE_PREFIXES) +
+            rng.choice(WORDS).capitalize() +
+            rng.choice(PLACE_SUFFIXES))
+
+
+def random_datetime(rng, end, days=730):
+    """Random datetime within `days` before `end`."""
+
+    return end - timedelta(seconds=rng.uniform(0, days * 86400))
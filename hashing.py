@@ -0,0 +1,185 @@
+"""Password hashing on a bounded process pool.
+
+bcrypt is slow on purpose, so hashing on the request thread ties up a
+worker for the whole hash. PasswordHasher runs hashes/checks in a small
+process pool instead (HASH_WORKERS processes, created lazily in each
+gunicorn worker), caps how many may be queued at once (HASH_MAX_PENDING)
+and raises HashingBusy beyond that so the app can shed load rather than
+pile up logins. A hash that doesn't finish within HASH_TIMEOUT seconds
+also raises HashingBusy; bcrypt can't be interrupted, so it keeps its
+place in the queue until it does finish. With HASH_WORKERS = 0
+everything runs inline. Queue
+depth and outcomes are exported at /metrics (see app.py).
+
+The bcrypt cost is BCRYPT_LOG_ROUNDS. Hashes made with a different cost
+are upgraded transparently on the next successful login (see
+User.check_password), so operators can retune it without locking anyone
+out.
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+
+class HashingBusy(Exception):
+    """Too many password hashes already queued; try again shortly."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(password, hashed):
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+def hash_rounds(hashed):
+    """Cost factor a bcrypt hash was made with ("$2b$12$..." -> 12)."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """bcrypt hashing/checking with a bounded worker pool and metrics."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=0, max_pending=32,
+                 timeout=30):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rehashed = 0
+
+    def init_app(self, app):
+        """Configure from BCRYPT_LOG_ROUNDS and the HASH_* settings."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS',
+                                            DEFAULT_ROUNDS)
+        self.workers = app.config.setdefault('HASH_WORKERS', 0)
+        self.max_pending = app.config.setdefault('HASH_MAX_PENDING', 32)
+        self.timeout = app.config.setdefault('HASH_TIMEOUT', 30)
+
+    def _get_pool(self):
+        # Pools don't survive fork, so each gunicorn worker makes its own.
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def _release(self, future):
+        # Runs once the job is over (finished, failed or cancelled), which
+        # for a timed-out hash can be well after _run gave up on it.
+        with self.lock:
+            self.pending -= 1
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            result = fn(*args)
+            with self.lock:
+                self.completed += 1
+            return result
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HashingBusy()
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+            pool = self._get_pool()
+
+        future = pool.submit(fn, *args)
+        future.add_done_callback(self._release)
+
+        try:
+            result = future.result(self.timeout)
+        except TimeoutError:
+            # only stops it if it hasn't started yet
+            future.cancel()
+            with self.lock:
+                self.timed_out += 1
+            raise HashingBusy()
+
+        with self.lock:
+            self.completed += 1
+
+        return result
+
+    def hash(self, password):
+        """bcrypt hash (as text) of `password` at the configured cost."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self._run(_hash, password.encode('UTF-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        if not password:
+            return False
+
+        return self._run(_check,
+                         password.encode('UTF-8'),
+                         hashed.encode('UTF-8'))
+
+    def rehash(self, password):
+        """Like hash(), but counted as a cost upgrade in stats()."""
+
+        hashed = self.hash(password)
+
+        with self.lock:
+            self.rehashed += 1
+
+        return hashed
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than configured?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        """Dict of queue depth and throughput counters."""
+
+        with self.lock:
+            return dict(workers=self.workers,
+                        rounds=self.rounds,
+                        pending=self.pending,
+                        peak_pending=self.peak_pending,
+                        max_pending=self.max_pending,
+                        completed=self.completed,
+                        rejected=self.rejected,
+                        timed_out=self.timed_out,
+                        rehashed=self.rehashed)
+
+    def outcomes(self):
+        """{(outcome,): count} of hashes/checks, for /metrics."""
+
+        with self.lock:
+            return {('completed',): self.completed,
+                    ('rejected',): self.rejected,
+                    ('timed_out',): self.timed_out}
+
+
+hasher = PasswordHasher()
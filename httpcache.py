@@ -0,0 +1,53 @@
+"""HTTP caching helpers: validators and per-route Cache-Control.
+
+Routes that can tell cheaply whether their output changed build an ETag
+from the things the page shows (ids, versions, counts, the viewer's
+like/follow state) and hand rendering to `conditional`, which answers a
+matching If-None-Match with a bodiless 304 instead of rendering.
+"""
+
+from hashlib import sha1
+
+from flask import g, make_response, request, session
+
+# Pages that depend on who's looking may be stored by the browser but not
+# by shared caches, and must be revalidated every time.
+PRIVATE_REVALIDATE = 'private, no-cache'
+PUBLIC_REVALIDATE = 'public, no-cache'
+
+
+def make_etag(*parts):
+    """Weak-comparison ETag value from anything with a stable repr."""
+
+    return sha1(repr(parts).encode('UTF-8')).hexdigest()
+
+
+def viewer_parts():
+    """ETag parts for the logged-in user (the navbar shows their avatar)."""
+
+    if not g.user:
+        return (None,)
+
+    return (g.user.id, g.user.profile_version)
+
+
+def conditional(etag, render):
+    """304 if the client already has `etag`, else `render()` with validators.
+
+    Pages carrying flashed messages are always rendered, since the flash
+    isn't part of the ETag. If-None-Match is compared weakly (RFC 7232),
+    so it also matches a W/ version of `etag` set on a gzipped response.
+    """
+
+    cache_control = PRIVATE_REVALIDATE if g.user else PUBLIC_REVALIDATE
+
+    if '_flashes' not in session and request.if_none_match.contains_weak(etag):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(render())
+
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    resp.vary.add('Cookie')
+
+    return resp
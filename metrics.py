@@ -0,0 +1,397 @@
+"""Per-route request metrics in the Prometheus text format, at /metrics.
+
+Recorded for every request, labelled by Flask endpoint (homepage,
+users_show, update_msg_like, ...):
+
+    warbler_requests_total                  by endpoint, method, status
+    warbler_request_duration_seconds        histogram by endpoint, method
+    warbler_db_queries_total                by endpoint (see querystats)
+    warbler_db_duration_seconds             histogram of DB time/request
+    warbler_template_render_seconds         histogram by template
+
+Other modules add gauges read when a snapshot is taken (app.py adds the
+database pool and replica ones from routing.py).
+
+Request time is taken from before_request to teardown, so streamed pages
+count until their last chunk is sent. Template time comes from Flask's
+before_render_template / template_rendered signals (render_template
+only; stream_template pages are in their request's time).
+
+Gunicorn runs several worker processes, and a scrape reaches only one.
+With METRICS_DIR set, each worker writes its totals to its own file in
+that directory (after a request, at most every METRICS_FLUSH_INTERVAL
+seconds, so a scrape can miss an idle worker's last second) and /metrics
+adds up every file. Files are named worker-<pid>-<random token>.json, so
+a new worker that gets an old one's PID doesn't overwrite its file. Files of workers
+that have exited are kept, so counters never go backwards (their gauges
+are ignored); clear the directory when deploying. Without METRICS_DIR each worker reports only
+itself.
+"""
+
+import json
+import os
+import threading
+import time
+
+from flask import (Response, g, request, before_render_template,
+                   template_rendered)
+
+# Upper bounds (seconds) of the histogram buckets, as in Prometheus' clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    """Monotonic totals, one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Histogram:
+    """Bucketed observations: [count per bucket..., sum, count] per labels.
+
+    Bucket counts are stored per bucket (not cumulative) and only made
+    cumulative when rendered.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, labels, value):
+        counts = self.values.get(labels)
+
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 3)
+
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+
+        # last bucket slot is +Inf
+        counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def samples(self, labels, counts):
+        running = 0
+
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            running += count
+            le = bound if isinstance(bound, str) else repr(float(bound))
+            yield f"{self.name}_bucket", labels + (('le', le),), running
+
+        yield f"{self.name}_sum", labels, counts[-2]
+        yield f"{self.name}_count", labels, counts[-1]
+
+
+class Gauge:
+    """Values read from `collect()` ({label values: number}) when a
+    snapshot is taken, for state kept elsewhere (pool sizes, health).
+
+    Workers' values are combined with `merge` (added up by default), and
+    only live workers' values count.
+    """
+
+    def __init__(self, name, help, labelnames, collect, merge=None,
+                 kind='gauge'):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+        self.kind = kind
+
+        if merge is not None:
+            self.merge = merge
+
+    @property
+    def values(self):
+        return self.collect()
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, labels, value):
+        yield self.name, labels, value
+
+
+class Registry:
+    """A process's metrics, and merging/rendering snapshots of several."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """{name: [[label values, value], ...]} -- JSON-friendly copy."""
+
+        with self.lock:
+            return {name: [[list(labels), value]
+                           for labels, value in metric.values.items()]
+                    for name, metric in self.metrics.items()}
+
+    def merge(self, snapshots):
+        """Add up snapshots: {name: {label values: value}}."""
+
+        merged = {name: {} for name in self.metrics}
+
+        for snapshot in snapshots:
+            for name, rows in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                totals = merged[name]
+                for labels, value in rows:
+                    labels = tuple(labels)
+                    totals[labels] = (value if labels not in totals
+                                      else metric.merge(totals[labels], value))
+
+        return merged
+
+    def render(self, merged):
+        """Text exposition format for merged values."""
+
+        lines = []
+
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+
+            for values, value in sorted(merged[name].items()):
+                labels = tuple(zip(metric.labelnames, values))
+                for sample, sample_labels, number in metric.samples(labels,
+                                                                    value):
+                    lines.append(f"{sample}{format_labels(sample_labels)} "
+                                 f"{format_value(number)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+def escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def format_value(number):
+    if isinstance(number, int) or float(number).is_integer():
+        return str(int(number))
+    return repr(float(number))
+
+
+def worker_alive(filename):
+    """Is the process that wrote worker-<pid>-<token>.json still running?"""
+
+    try:
+        os.kill(int(filename[len('worker-'):].split('-')[0]), 0)
+    except ValueError:
+        return False
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class Metrics:
+    """Flask extension: record request metrics and serve /metrics."""
+
+    def __init__(self, app=None):
+        self.registry = Registry()
+
+        self.requests = self.registry.add(Counter(
+            'warbler_requests_total',
+            'Requests handled, by endpoint, method and status.',
+            ('endpoint', 'method', 'status')))
+        self.request_time = self.registry.add(Histogram(
+            'warbler_request_duration_seconds',
+            'Time from request start until the response is sent.',
+            ('endpoint', 'method')))
+        self.queries = self.registry.add(Counter(
+            'warbler_db_queries_total',
+            'SQL statements issued, by endpoint.',
+            ('endpoint',)))
+        self.db_time = self.registry.add(Histogram(
+            'warbler_db_duration_seconds',
+            'Time spent in SQL statements per request.',
+            ('endpoint',)))
+        self.render_time = self.registry.add(Histogram(
+            'warbler_template_render_seconds',
+            'Time to render a template with render_template.',
+            ('template',)))
+
+        self.directory = None
+        self.flush_interval = 1.0
+        self.last_flush = 0.0
+        self.file_pid = None
+        self.filename = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 1.0)
+
+        self.directory = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self.start_request)
+        app.after_request(self.note_status)
+        app.teardown_request(self.finish_request)
+
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+
+    # Request hooks
+
+    def start_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def note_status(self, resp):
+        g.metrics_status = resp.status_code
+        return resp
+
+    def finish_request(self, exc):
+        started = g.pop('metrics_started', None)
+
+        if started is None:
+            return
+
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'none'
+        status = g.pop('metrics_status', 500 if exc else 200)
+        stats = g.get('query_stats')
+
+        with self.registry.lock:
+            self.requests.inc((endpoint, request.method, str(status)))
+            self.request_time.observe((endpoint, request.method), elapsed)
+
+            if stats is not None:
+                self.queries.inc((endpoint,), stats.count)
+                self.db_time.observe((endpoint,), stats.total_time)
+
+        self.maybe_flush()
+
+    def start_render(self, app, template, context):
+        g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+    def finish_render(self, app, template, context):
+        renders = g.get('metrics_renders')
+
+        if renders:
+            elapsed = time.perf_counter() - renders.pop()
+            with self.registry.lock:
+                self.render_time.observe((template.name or 'string',),
+                                         elapsed)
+
+    # Multiprocess mode
+
+    def path(self):
+        # made after fork, so each worker gets its own
+        if self.file_pid != os.getpid():
+            self.file_pid = os.getpid()
+            self.filename = f"worker-{self.file_pid}-{os.urandom(4).hex()}.json"
+
+        return os.path.join(self.directory, self.filename)
+
+    def maybe_flush(self):
+        if (self.directory and
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write this process's totals to its file in METRICS_DIR."""
+
+        self.last_flush = time.monotonic()
+        path = self.path()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+
+        with open(tmp, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+
+        # readers never see a half-written file
+        os.replace(tmp, path)
+
+    def collect(self):
+        """Snapshots of every worker (or just this one)."""
+
+        if not self.directory:
+            return [self.registry.snapshot()]
+
+        self.flush()
+        snapshots = []
+        gauges = [name for name, metric in self.registry.metrics.items()
+                  if metric.kind == 'gauge']
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            # an exited worker's counts stand, its gauges don't
+            if not worker_alive(name):
+                for gauge in gauges:
+                    snapshot.pop(gauge, None)
+
+            snapshots.append(snapshot)
+
+        return snapshots
+
+    def serve(self):
+        """GET /metrics"""
+
+        merged = self.registry.merge(self.collect())
+
+        return Response(self.registry.render(merged),
+                        content_type=CONTENT_TYPE,
+                        headers={'Cache-Control': 'no-store'})
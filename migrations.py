@@ -0,0 +1,191 @@
+"""Versioned schema migrations.
+
+db.create_all() only creates missing tables, so columns and indexes
+added to models later never reach a database that already has the
+table. Together the migrations here bring a database made before any of
+them (the original users/messages/follows/likes schema) up to what
+create_all builds today; `flask migrate` applies the pending ones in
+order, each in its own transaction, and records them in
+schema_migrations.
+
+Steps check before creating, so running a migration against a database
+that already has its tables, columns or indexes (one made by create_all,
+say) just records it, after re-running any backfill. seed.py marks
+everything applied after create_all.
+
+Migrations are only ever appended, so versions don't follow the order
+the features were written in: the user counters (4) and home timelines
+(5) came before the indexes, but were added here later. Both backfill
+from the base tables (the same as `flask reconcile-counts` and `flask
+rebuild-timelines`), which on a big database takes a while.
+
+Indexes are built with a plain CREATE INDEX, which blocks writes to the
+table while it runs; migrate big tables in a quiet moment.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, orm
+
+from models import (db, User, Message, Like, FollowersFollowee, Timeline,
+                    IdempotencyKey, MESSAGE_FTS_INDEX, add_username_trgm_index)
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+)
+
+
+class Migration:
+    """Numbered list of steps; each step is called with a Connection."""
+
+    def __init__(self, version, name, *steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+    def __repr__(self):
+        return f"<Migration {self.version}: {self.name}>"
+
+    def apply(self, conn):
+        for step in self.steps:
+            step(conn)
+
+
+def add_index(model, name):
+    """Step: create `model`'s index `name` (as declared) if it's missing."""
+
+    index = next(index for index in model.__table__.indexes
+                 if index.name == name)
+
+    def step(conn):
+        existing = {found['name']
+                    for found in inspect(conn).get_indexes(index.table.name)}
+        if index.name not in existing:
+            index.create(conn)
+
+    return step
+
+
+def add_column(model, name):
+    """Step: add `model`'s column `name` (as declared) if it's missing.
+
+    Columns added to an existing table need a server_default if they're
+    NOT NULL.
+    """
+
+    column = model.__table__.c[name]
+
+    def step(conn):
+        existing = {found['name']
+                    for found in inspect(conn).get_columns(column.table.name)}
+        if name not in existing:
+            spec = (conn.dialect.ddl_compiler(conn.dialect, None)
+                    .get_column_specification(column))
+            conn.execute(f"ALTER TABLE {column.table.name} ADD COLUMN {spec}")
+
+    return step
+
+
+def backfill(fill):
+    """Step: run `fill(session)` inside the migration's transaction."""
+
+    def step(conn):
+        session = orm.Session(bind=conn)
+        try:
+            fill(session)
+            session.commit()
+        finally:
+            session.close()
+
+    return step
+
+
+def add_table(model):
+    """Step: create `model`'s table (and its indexes) if it's missing."""
+
+    def step(conn):
+        model.__table__.create(conn, checkfirst=True)
+
+    return step
+
+
+def postgres_only(sql):
+    """Step: run `sql` on Postgres, skip it elsewhere."""
+
+    def step(conn):
+        if conn.dialect.name == 'postgresql':
+            conn.execute(sql)
+
+    return step
+
+
+MIGRATIONS = [
+    Migration(1, "search indexes",
+              add_username_trgm_index,
+              postgres_only(MESSAGE_FTS_INDEX)),
+    Migration(2, "indexes for profile, likes and follower lookups",
+              add_index(Message, 'ix_messages_user_id_timestamp'),
+              add_index(Like, 'ix_likes_msg_id'),
+              add_index(FollowersFollowee, 'ix_follows_follower_id')),
+    Migration(3, "idempotency keys",
+              add_table(IdempotencyKey)),
+    Migration(4, "cached user counts and profile versions",
+              add_column(User, 'profile_version'),
+              add_column(User, 'messages_count'),
+              add_column(User, 'following_count'),
+              add_column(User, 'followers_count'),
+              add_column(User, 'likes_count'),
+              backfill(User.reconcile_counts)),
+    Migration(5, "home timelines",
+              add_table(Timeline),
+              backfill(Timeline.rebuild)),
+]
+
+
+def applied_versions(engine):
+    """Versions recorded in schema_migrations (creating it if need be)."""
+
+    schema_migrations.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        return {version for (version,)
+                in conn.execute(db.select([schema_migrations.c.version]))}
+
+
+def pending(engine):
+    done = applied_versions(engine)
+    return [migration for migration in MIGRATIONS
+            if migration.version not in done]
+
+
+def record(conn, migration):
+    conn.execute(schema_migrations.insert().values(
+        version=migration.version, name=migration.name))
+
+
+def migrate(engine, log=print):
+    """Apply pending migrations in order; returns those applied."""
+
+    todo = pending(engine)
+
+    for migration in todo:
+        with engine.begin() as conn:
+            migration.apply(conn)
+            record(conn, migration)
+        log(f"Applied {migration.version}: {migration.name}")
+
+    return todo
+
+
+def stamp(engine):
+    """Mark every migration applied (the schema came from create_all)."""
+
+    todo = pending(engine)
+
+    with engine.begin() as conn:
+        for migration in todo:
+            record(conn, migration)
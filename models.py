@@ -1,12 +1,35 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+from array import array
+from datetime import datetime, timedelta
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import make_transient_to_detached
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import querystats
+from followgraph import FollowGraph
+from hashing import hasher
+from routing import RoutingSQLAlchemy, ReplicaRouter
+
+db = RoutingSQLAlchemy()
+replica_router = ReplicaRouter(db)
+
+
+def insert_ignoring_conflicts(table, **values):
+    """INSERT one row unless it would duplicate a key; returns 1 or 0.
+
+    ON CONFLICT DO NOTHING on Postgres, INSERT OR IGNORE on SQLite.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        stmt = (postgresql.insert(table)
+                .values(**values)
+                .on_conflict_do_nothing())
+    else:
+        stmt = table.insert().prefix_with('OR IGNORE').values(**values)
+
+    return db.session.execute(stmt).rowcount
 
 
 class FollowersFollowee(db.Model):
@@ -14,6 +37,12 @@ class FollowersFollowee(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key covers lookups by followee_id; this one covers
+    # "who follows B" (fan-out, followers pages, counts).
+    __table_args__ = (
+        db.Index('ix_follows_follower_id', 'follower_id'),
+    )
+
     followee_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,6 +55,38 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def following_ids(cls, user_id):
+        """Ids of the users `user_id` follows, ascending."""
+
+        # (followee_id=A, follower_id=B) means "A follows B"
+        rows = (db.session
+                .query(cls.follower_id)
+                .filter(cls.followee_id == user_id)
+                .order_by(cls.follower_id))
+
+        return [id for (id,) in rows]
+
+    @classmethod
+    def edges(cls):
+        """Every follow as parallel arrays: (follower ids, followed ids)."""
+
+        followers = array('q')
+        followees = array('q')
+
+        # (followee_id=A, follower_id=B) means "A follows B"
+        for a, b in (db.session
+                     .query(cls.followee_id, cls.follower_id)
+                     .yield_per(10000)):
+            followers.append(a)
+            followees.append(b)
+
+        return followers, followees
+
+
+# Who follows whom, cached per worker (see followgraph.py)
+follow_graph = FollowGraph(load=FollowersFollowee.following_ids)
+
 
 class User(db.Model):
     """User in the system."""
@@ -72,6 +133,48 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped whenever the user edits their profile; part of the key for
+    # cached message cards (caching.FragmentCache) and page ETags
+    # (httpcache).
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Denormalized counters shown on profile/home cards, so pages don't
+    # load whole relationships just to `| length` them. Kept up to date by
+    # the routes that change them (see bump_counts); reconcile_counts
+    # rebuilds them from the base tables.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', backref='author')
 
     likes = db.relationship(
@@ -94,14 +197,83 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return follow_graph.is_following(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return follow_graph.is_following(self.id, other_user.id)
+
+    # Counters change on other users' actions, so they're left out of
+    # snapshots and loaded fresh when a page actually shows them.
+    COUNTER_COLUMNS = ('messages_count', 'following_count',
+                       'followers_count', 'likes_count')
+
+    def snapshot(self):
+        """Plain dict of this user's (non-counter) columns, for caching."""
+
+        return {column.key: getattr(self, column.key)
+                for column in self.__table__.columns
+                if column.key not in self.COUNTER_COLUMNS}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Attach a user rebuilt from `snapshot` to the session, no query.
+
+        Behaves like a user loaded from the database: relationships and
+        counters lazy-load and changes are flushed as UPDATEs.
+        """
+
+        user = cls(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @classmethod
+    def bump_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to counter columns of some users.
+
+        `user_ids` is a single id, a list of ids or a query selecting ids:
+
+            User.bump_counts(user.id, messages_count=1)
+            User.bump_counts([a.id, b.id], followers_count=-1)
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        if isinstance(user_ids, list) and not user_ids:
+            return
+
+        values = {getattr(cls, column): getattr(cls, column) + delta
+                  for column, delta in deltas.items()}
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls, session=None):
+        """Recompute every user's counter columns from the base tables.
+
+        Runs in db.session unless given another `session` (migrations).
+        """
+
+        session = session or db.session
+
+        def count_of(column, owner_column):
+            return (db.select([db.func.count(column)])
+                    .where(owner_column == cls.id)
+                    .as_scalar())
+
+        # (followee_id=A, follower_id=B) means "A follows B"; see followers
+        session.query(cls).update({
+            cls.messages_count: count_of(Message.id, Message.user_id),
+            cls.following_count: count_of(FollowersFollowee.follower_id,
+                                          FollowersFollowee.followee_id),
+            cls.followers_count: count_of(FollowersFollowee.followee_id,
+                                          FollowersFollowee.follower_id),
+            cls.likes_count: count_of(Like.msg_id, Like.user_id),
+        }, synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -110,7 +282,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -135,19 +307,69 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's password?
+
+        If it does and the stored hash uses a different bcrypt cost than
+        is configured, the password is rehashed at the new cost (the
+        caller commits).
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.rehash(password)
+
+        return True
+
+
+# Username search (see search.py) on Postgres goes through a trigram GIN
+# index so substring/prefix matches don't scan the whole table. Existing
+# databases get it from migrations.py.
+PG_TRGM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+USERNAME_TRGM_INDEX = ("CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+                       "ON users USING gin (username gin_trgm_ops)")
+
+
+def add_username_trgm_index(conn):
+    """Create the username trigram index on Postgres.
+
+    Skipped where the server doesn't ship pg_trgm (it's in contrib, which
+    some installs leave out): search still works, by sequential scan.
+    """
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    available = conn.execute("SELECT 1 FROM pg_available_extensions "
+                             "WHERE name = 'pg_trgm'").scalar()
+    if available:
+        conn.execute(PG_TRGM_EXTENSION)
+        conn.execute(USERNAME_TRGM_INDEX)
+
+
+@event.listens_for(User.__table__, 'after_create')
+def create_username_trgm_index(target, connection, **kw):
+    add_username_trgm_index(connection)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # A user's messages, newest first (profiles, counts, backfills)
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -161,7 +383,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -186,7 +408,17 @@ class Message(db.Model):
     def is_liked(self, user):
         """Takes user instance and checks if the user has liked a message"""
 
-        return user in self.likers
+        return self.id in Like.liked_ids_for(user and user.id, [self.id])
+
+
+# Message search (see search.py) on Postgres uses a full-text GIN index.
+MESSAGE_FTS_INDEX = ("CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+                     "ON messages USING gin (to_tsvector('simple', text))")
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL(MESSAGE_FTS_INDEX).execute_if(dialect='postgresql'))
 
 
 class Like(db.Model):
@@ -194,6 +426,11 @@ class Like(db.Model):
 
     __tablename__ = 'likes'
 
+    # The primary key covers a user's likes; this covers a message's
+    __table_args__ = (
+        db.Index('ix_likes_msg_id', 'msg_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id'),
@@ -209,9 +446,295 @@ class Like(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow()
+        default=datetime.utcnow
     )
 
+    @classmethod
+    def liked_ids_for(cls, user_id, msg_ids):
+        """Which of `msg_ids` has `user_id` liked? Returns a set of ids.
+
+        Resolves the like buttons for a whole page of messages in one query.
+        """
+
+        msg_ids = list(msg_ids)
+
+        if user_id is None or not msg_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.msg_id)
+                .filter(cls.user_id == user_id, cls.msg_id.in_(msg_ids)))
+
+        return {msg_id for (msg_id,) in rows}
+
+    @classmethod
+    def toggle(cls, user_id, msg_id):
+        """Like `msg_id` for `user_id`, or unlike it if they already do.
+
+        Returns whether it's liked now. A DELETE, then an INSERT if that
+        deleted nothing; the INSERT skips a row that's already there, so
+        two toggles racing each other end up liked, with likes_count
+        bumped once.
+        """
+
+        if (cls.query
+                .filter_by(user_id=user_id, msg_id=msg_id)
+                .delete(synchronize_session=False)):
+            User.bump_counts(user_id, likes_count=-1)
+            return False
+
+        if insert_ignoring_conflicts(cls.__table__,
+                                     user_id=user_id,
+                                     msg_id=msg_id,
+                                     timestamp=datetime.utcnow()):
+            User.bump_counts(user_id, likes_count=1)
+
+        return True
+
+    @classmethod
+    def count_for(cls, msg_id):
+        """How many users like `msg_id`?"""
+
+        return (db.session
+                .query(db.func.count())
+                .filter(cls.msg_id == msg_id)
+                .scalar())
+
+
+class IdempotencyKey(db.Model):
+    """The response to a request sent with an Idempotency-Key header.
+
+    A retry (double-click, client timeout) with the same key gets this
+    response back instead of doing the work again. Keys are per user;
+    `flask prune-idempotency-keys` drops ones older than MAX_AGE.
+    """
+
+    __tablename__ = 'idempotency_keys'
+
+    __table_args__ = (
+        db.Index('ix_idempotency_keys_created_at', 'created_at'),
+    )
+
+    MAX_AGE = timedelta(days=1)
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True
+    )
+
+    key = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    # the request the key was first used for
+    path = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    # JSON body, set when the request that claimed the key commits
+    response = db.Column(
+        db.Text
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+    @classmethod
+    def claim(cls, user_id, key, path):
+        """Reserve `key` for this request; False if it's been used.
+
+        On Postgres a claim racing an uncommitted one for the same key
+        waits for it, so the loser sees its response (SQLite gets the same
+        by letting one writer in at a time). A key that's been used always
+        has its response by the time a claim sees it.
+        """
+
+        return bool(insert_ignoring_conflicts(cls.__table__,
+                                              user_id=user_id,
+                                              key=key,
+                                              path=path,
+                                              created_at=datetime.utcnow()))
+
+    @classmethod
+    def record(cls, user_id, key, response):
+        """Store the response for a key this request claimed."""
+
+        (cls.query
+         .filter_by(user_id=user_id, key=key)
+         .update({cls.response: response}, synchronize_session=False))
+
+    @classmethod
+    def prune(cls, max_age=MAX_AGE):
+        """Delete keys older than `max_age`; returns how many."""
+
+        return (cls.query
+                .filter(cls.created_at < datetime.utcnow() - max_age)
+                .delete(synchronize_session=False))
+
+
+class Timeline(db.Model):
+    """Materialized home timeline: one row per (reader, message).
+
+    Rows are written when a message is posted (fan-out-on-write), so the
+    home page is a single range read on (user_id, timestamp) no matter
+    how many users the reader follows.
+    """
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'msg_id'),
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+        db.Index('ix_timelines_msg_id', 'msg_id'),
+    )
+
+    # whose home page this row appears on
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    msg_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # copied from the message so follows/unfollows can prune by author
+    # and reads can sort without joining messages
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # How many of a followee's latest messages get copied into a reader's
+    # timeline when they start following them.
+    BACKFILL_LIMIT = 100
+
+    # NOTE: a row in `follows` with (followee_id=A, follower_id=B) means
+    # "A follows B" -- see User.followers/User.following. The helpers
+    # below are written against that convention.
+
+    @classmethod
+    def fan_out(cls, msg):
+        """Push a new message onto its author's and their followers' timelines.
+
+        Message must already be flushed (so it has an id).
+        """
+
+        db.session.execute(cls.__table__.insert().values(
+            user_id=msg.user_id,
+            msg_id=msg.id,
+            author_id=msg.user_id,
+            timestamp=msg.timestamp))
+
+        readers = (db.session
+                   .query(FollowersFollowee.followee_id,
+                          db.literal(msg.id),
+                          db.literal(msg.user_id),
+                          db.literal(msg.timestamp))
+                   .filter(FollowersFollowee.follower_id == msg.user_id))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'msg_id', 'author_id', 'timestamp'],
+            readers.subquery().select()))
+
+    @classmethod
+    def backfill(cls, reader_id, author_id, limit=BACKFILL_LIMIT):
+        """Copy `author_id`'s latest messages into `reader_id`'s timeline."""
+
+        already_there = (db.session
+                         .query(cls.msg_id)
+                         .filter(cls.user_id == reader_id,
+                                 cls.author_id == author_id))
+
+        latest = (db.session
+                  .query(db.literal(reader_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id == author_id,
+                          ~Message.id.in_(already_there))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'msg_id', 'author_id', 'timestamp'],
+            latest.subquery().select()))
+
+    @classmethod
+    def prune(cls, reader_id, author_id):
+        """Remove all of `author_id`'s messages from `reader_id`'s timeline."""
+
+        (cls.query
+         .filter_by(user_id=reader_id, author_id=author_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def retract(cls, msg_id):
+        """Remove a message from every timeline it was fanned out to."""
+
+        (cls.query
+         .filter_by(msg_id=msg_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def messages_query(cls, user_id):
+        """Query for messages on `user_id`'s home timeline.
+
+        Unordered; sort/paginate on (Timeline.timestamp, Timeline.msg_id),
+        which is what the timeline index covers.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.msg_id == Message.id)
+                .filter(cls.user_id == user_id)
+                .options(db.joinedload(Message.author)))
+
+    @classmethod
+    def rebuild(cls, session=None):
+        """Rebuild every timeline from messages and follows.
+
+        Used after bulk loads (see seed.py), which bypass fan-out, and by
+        the migration that adds timelines. Runs in db.session unless given
+        another `session`.
+        """
+
+        session = session or db.session
+
+        session.query(cls).delete(synchronize_session=False)
+
+        own = session.query(Message.user_id.label('user_id'),
+                            Message.id,
+                            Message.user_id.label('author_id'),
+                            Message.timestamp)
+
+        followed = (session
+                    .query(FollowersFollowee.followee_id,
+                           Message.id,
+                           Message.user_id,
+                           Message.timestamp)
+                    .join(Message,
+                          Message.user_id == FollowersFollowee.follower_id))
+
+        session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'msg_id', 'author_id', 'timestamp'],
+            own.union_all(followed).subquery().select()))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -221,3 +744,5 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    querystats.init_app(app)
+    replica_router.init_app(app)
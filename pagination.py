@@ -0,0 +1,110 @@
+"""Keyset (cursor) pagination.
+
+Instead of OFFSET, each page is fetched with a `(timestamp, id) < cursor`
+filter on an index, so page 1000 costs the same as page 1. The cursor
+handed to the browser is an opaque, URL-safe token.
+
+Lists ordered by id alone (the user directory) use a plain `?after=<id>`
+and can be streamed straight off the database cursor with StreamedPage.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+class InvalidCursor(ValueError):
+    """Cursor token could not be decoded."""
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque token pointing just past (`timestamp`, `id`)."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIME_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Turn a token from encode_cursor back into (timestamp, id).
+
+    Raises InvalidCursor for anything we didn't produce.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('UTF-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+    except (ValueError, UnicodeError) as exc:
+        raise InvalidCursor(token) from exc
+
+
+def paginate(query, timestamp_col, id_col, before=None, per_page=20):
+    """Return a Page of `query` ordered newest first by (timestamp, id).
+
+    `before` is a cursor token from a previous page (or None for the first
+    page). One extra row is fetched to know whether there is a next page;
+    `next_cursor` is None on the last page.
+    """
+
+    if before:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < tuple_(*decode_cursor(before)))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    items = rows[:per_page]
+    next_cursor = None
+
+    if len(rows) > per_page:
+        last = items[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return Page(items, next_cursor)
+
+
+class StreamedPage:
+    """One page of `query` ordered by `id_col`, read lazily as it's iterated.
+
+    Rows come from a server-side cursor (yield_per), so a page can be
+    rendered while it's still being fetched. Like paginate(), one extra
+    row is read to find out whether there is a next page; `next_after`
+    (the id to pass as `after` for the next page) is only known once
+    iteration has finished, and is None on the last page.
+    """
+
+    def __init__(self, query, id_col, after=None, per_page=30):
+        if after is not None:
+            query = query.filter(id_col > after)
+
+        self.query = query.order_by(id_col).limit(per_page + 1)
+        self.id_col = id_col
+        self.per_page = per_page
+        self.next_after = None
+
+    def ids(self):
+        """Subquery of this page's ids, for per-page lookups in one query."""
+
+        return (self.query
+                .with_entities(self.id_col)
+                .limit(self.per_page)
+                .as_scalar())
+
+    def __iter__(self):
+        last = None
+
+        for n, row in enumerate(self.query.yield_per(self.per_page + 1)):
+            if n == self.per_page:
+                self.next_after = last.id
+                break
+            last = row
+            yield row
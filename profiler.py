@@ -0,0 +1,171 @@
+"""Opt-in sampling profiler for single requests.
+
+A request is profiled when it carries a valid X-Profile header (a token
+from `flask profile-token`, signed with SECRET_KEY and good for
+PROFILE_TOKEN_MAX_AGE seconds) or, with PROFILE_SAMPLE_RATE above 0,
+when it's picked at random. Otherwise the only cost is a header lookup
+(and a random() call when sampling is on).
+
+While a request is profiled a background thread looks at its stack every
+PROFILE_INTERVAL seconds (sys._current_frames) until teardown, so
+streamed pages are covered to the end. The samples are written to
+PROFILE_DIR in the collapsed-stack format ("outer;inner;leaf count" per
+line) that flamegraph.pl, speedscope and inferno read; the file name is
+returned in the X-Profile-Id header. Only the newest PROFILE_MAX_FILES
+files are kept.
+
+    curl -H "X-Profile: $(flask profile-token)" https://.../users/1/likes
+    flamegraph.pl instance/profiles/<X-Profile-Id> > likes.svg
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Profile'
+
+
+def collapse(frame):
+    """'outer;...;inner' labels of the stack ending at `frame`."""
+
+    labels = []
+
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} "
+                      f"({os.path.basename(code.co_filename)}:"
+                      f"{code.co_firstlineno})")
+        frame = frame.f_back
+
+    return ';'.join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of thread `thread_id` every `interval` seconds."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+            del frame
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiler:
+    """Flask extension: profile requests that ask for it (or a sample)."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_DIR',
+                              os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PROFILE_MAX_FILES', 200)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+
+        self.app = app
+        self.serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                                 salt='profile')
+
+        app.before_request(self.start)
+        app.after_request(self.add_header)
+        app.teardown_request(self.finish)
+
+    def token(self):
+        """A fresh X-Profile header value."""
+
+        return self.serializer.dumps('profile')
+
+    def wanted(self):
+        """Should the current request be profiled?"""
+
+        token = request.headers.get(HEADER)
+
+        if token is not None:
+            try:
+                self.serializer.loads(
+                    token, max_age=self.app.config['PROFILE_TOKEN_MAX_AGE'])
+                return True
+            except BadSignature:
+                return False
+
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def start(self):
+        if not self.wanted():
+            return
+
+        g.profile_id = (f"{time.strftime('%Y%m%d-%H%M%S')}-"
+                        f"{request.endpoint or 'none'}-{os.getpid()}-"
+                        f"{threading.get_ident()}.collapsed")
+        g.profile_started = time.perf_counter()
+        g.profile_sampler = Sampler(threading.get_ident(),
+                                    self.app.config['PROFILE_INTERVAL'])
+        g.profile_sampler.start()
+
+    def add_header(self, resp):
+        profile_id = g.get('profile_id')
+
+        if profile_id is not None:
+            resp.headers['X-Profile-Id'] = profile_id
+
+        return resp
+
+    def finish(self, exc):
+        sampler = g.pop('profile_sampler', None)
+
+        if sampler is None:
+            return
+
+        stacks = sampler.stop()
+        elapsed = time.perf_counter() - g.pop('profile_started')
+        directory = self.app.config['PROFILE_DIR']
+
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, g.profile_id), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        self.app.logger.info("Profiled %s %s: %.1fms, %d samples -> %s",
+                             request.method, request.path, elapsed * 1000,
+                             sum(stacks.values()), g.profile_id)
+
+        prune(directory, self.app.config['PROFILE_MAX_FILES'])
+
+
+def prune(directory, max_files):
+    """Delete all but the newest `max_files` profiles in `directory`."""
+
+    # names start with the time, so they sort oldest first
+    names = sorted(name for name in os.listdir(directory)
+                   if name.endswith('.collapsed'))
+
+    for name in names[:max(0, len(names) - max_files)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            # another worker pruned it first
+            pass
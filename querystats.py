@@ -0,0 +1,172 @@
+"""Per-request SQL statement counting and N+1 detection.
+
+Every statement sent through any SQLAlchemy engine is timed and recorded
+into whichever collectors are active on the current thread. The app
+installs one collector per request (see init_app) and reports the totals
+in response headers; tests can open their own with assert_max_queries.
+"""
+
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Statements repeated at least this many times in one request get logged
+# as a likely N+1 (lazy loads in a loop).
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+# Collapse "IN (?, ?, ?)" / "IN (%(p_1)s, %(p_2)s)" so lists of different
+# lengths count as the same statement shape.
+_PARAM_LIST = re.compile(r"\(\s*(\?|%\(\w+\)s)(\s*,\s*(\?|%\(\w+\)s))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+_local = threading.local()
+
+
+class QueryStats:
+    """Statements seen while a collector was active."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def __repr__(self):
+        return (f"<QueryStats {self.count} queries "
+                f"in {self.total_time * 1000:.1f}ms>")
+
+    def record(self, statement, elapsed):
+        """Add one executed statement that took `elapsed` seconds."""
+
+        self.count += 1
+        self.total_time += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+        """Statement shapes issued at least `threshold` times, most first."""
+
+        return [(shape, count)
+                for shape, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+def statement_shape(statement):
+    """Normalize SQL so repeats of the same query compare equal."""
+
+    statement = _PARAM_LIST.sub("(?)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def _active_collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@contextmanager
+def collect_queries():
+    """Record every statement run on this thread inside the block.
+
+        with collect_queries() as stats:
+            ...
+        stats.count, stats.total_time, stats.repeated()
+    """
+
+    stats = QueryStats()
+    collectors = _active_collectors()
+    collectors.append(stats)
+
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """Test helper: fail if the block issues more than `budget` statements."""
+
+    with collect_queries() as stats:
+        yield stats
+
+    if stats.count > budget:
+        shapes = "\n".join(f"  {count}x {shape}"
+                           for shape, count in stats.shapes.most_common())
+        raise AssertionError(
+            f"{stats.count} queries issued, budget was {budget}:\n{shapes}")
+
+
+# The start time lives on the execution context, which goes away with the
+# statement, so one that raises (no after_cursor_execute) leaves nothing
+# behind. The few statements run without a context (sequence prefetches)
+# use a slot on the connection, overwritten each time.
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+    else:
+        conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        start = context._query_start
+    else:
+        start = conn.info.pop('query_start')
+    elapsed = time.perf_counter() - start
+
+    for stats in _active_collectors():
+        stats.record(statement, elapsed)
+
+
+def init_app(app):
+    """Collect query stats for every request of `app`.
+
+    Adds X-DB-Queries / X-DB-Time (ms) response headers when
+    QUERY_STATS_HEADERS is on (the default) and logs statement shapes
+    repeated QUERY_STATS_N_PLUS_ONE_THRESHOLD or more times.
+    """
+
+    app.config.setdefault('QUERY_STATS_HEADERS', True)
+    app.config.setdefault('QUERY_STATS_N_PLUS_ONE_THRESHOLD',
+                          DEFAULT_N_PLUS_ONE_THRESHOLD)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        _active_collectors().append(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(resp):
+        stats = g.get('query_stats')
+
+        if stats is None:
+            return resp
+
+        if app.config['QUERY_STATS_HEADERS']:
+            resp.headers['X-DB-Queries'] = str(stats.count)
+            resp.headers['X-DB-Time'] = f"{stats.total_time * 1000:.1f}"
+
+        threshold = app.config['QUERY_STATS_N_PLUS_ONE_THRESHOLD']
+        for shape, count in stats.repeated(threshold):
+            app.logger.warning("Possible N+1 on %s: %d x %s",
+                               request.endpoint,
+                               count,
+                               shape)
+
+        return resp
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        stats = g.get('query_stats')
+        collectors = _active_collectors()
+
+        if stats in collectors:
+            collectors.remove(stats)
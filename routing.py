@@ -0,0 +1,267 @@
+"""Send read-only requests to database replicas.
+
+Replicas are Flask-SQLAlchemy binds listed in REPLICA_BINDS (app.py
+fills both from DATABASE_REPLICA_URLS). For each GET/HEAD request one
+healthy replica is picked, and the session's reads go there; everything
+else -- other methods, views marked @use_primary, flushes and
+INSERT/UPDATE/DELETE statements -- goes to the primary, as does the rest
+of a request once it has written.
+
+Read-your-writes: a request that wrote pins its user to the primary for
+REPLICA_PIN_SECONDS (an expiry time in their session cookie), so after
+posting or following they don't see a replica that hasn't caught up.
+
+Replica health is checked at most every REPLICA_CHECK_INTERVAL seconds,
+when a request needs a replica: a replica that errors, or (Postgres)
+whose last replayed transaction is more than REPLICA_MAX_LAG seconds
+old, is skipped until a later check passes. A connection error on a
+replica also marks it down straight away. With no healthy replica, reads
+go to the primary.
+"""
+
+import random
+import threading
+import time
+
+from flask import g, request, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+
+# Session key holding the time.time() until which reads use the primary
+PIN_KEY = 'db_pinned_until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+REPLICATION_LAG = ("SELECT COALESCE(EXTRACT(EPOCH FROM "
+                   "now() - pg_last_xact_replay_timestamp()), 0)")
+
+
+def use_primary(view):
+    """Mark a GET view that writes (or must read its own writes)."""
+
+    view.use_primary = True
+    return view
+
+
+class RoutingSession(SignallingSession):
+    """Session that asks the app's ReplicaRouter where to send reads."""
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replica_router')
+
+        if router is not None and not has_bind_key(mapper):
+            engine = router.engine_for(self, clause)
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+def has_bind_key(mapper):
+    if mapper is None:
+        return False
+
+    table = getattr(mapper, 'persist_selectable', None)
+    if table is None:
+        table = mapper.mapped_table
+
+    return table.info.get('bind_key') is not None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replica:
+    """One replica bind and what its last health check found."""
+
+    def __init__(self, key, engine):
+        self.key = key
+        self.engine = engine
+        self.healthy = True
+        self.lag = 0.0
+        self.checked = None
+        self.requests = 0
+
+        event.listen(engine, 'handle_error', self.connection_failed)
+
+    def __repr__(self):
+        state = 'up' if self.healthy else 'down'
+        return f"<Replica {self.key} {state} lag={self.lag:.1f}s>"
+
+    def connection_failed(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.healthy = False
+
+
+class ReplicaRouter:
+    """Picks a replica per read-only request; see the module docstring."""
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.replicas = None
+        self.lock = threading.Lock()
+        self.primary_requests = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_BINDS', [])
+        app.config.setdefault('REPLICA_PIN_SECONDS', 5)
+        app.config.setdefault('REPLICA_CHECK_INTERVAL', 10)
+        app.config.setdefault('REPLICA_MAX_LAG', 10)
+
+        self.app = app
+        app.extensions['replica_router'] = self
+
+        app.before_request(self.choose)
+        app.after_request(self.pin)
+
+    def configure(self):
+        """Forget replicas, so they're rebuilt from REPLICA_BINDS."""
+
+        self.replicas = None
+
+    def get_replicas(self):
+        if self.replicas is None:
+            self.replicas = [
+                Replica(key, self.db.get_engine(self.app, bind=key))
+                for key in self.app.config['REPLICA_BINDS']]
+
+        return self.replicas
+
+    # Health
+
+    def check(self, replica):
+        """Run a health check on `replica` now."""
+
+        try:
+            with replica.engine.connect() as conn:
+                if conn.dialect.name == 'postgresql':
+                    replica.lag = float(conn.execute(REPLICATION_LAG).scalar())
+                else:
+                    conn.execute("SELECT 1")
+                    replica.lag = 0.0
+            replica.healthy = replica.lag <= self.app.config['REPLICA_MAX_LAG']
+        except DBAPIError:
+            replica.healthy = False
+
+        replica.checked = time.monotonic()
+
+    def healthy_replicas(self):
+        """Replicas to use, checking any whose last check is stale."""
+
+        interval = self.app.config['REPLICA_CHECK_INTERVAL']
+        now = time.monotonic()
+        healthy = []
+
+        for replica in self.get_replicas():
+            if replica.checked is None or now - replica.checked >= interval:
+                # one request per worker runs the check; others go on with
+                # the last result
+                if self.lock.acquire(blocking=replica.checked is None):
+                    try:
+                        self.check(replica)
+                    finally:
+                        self.lock.release()
+            if replica.healthy:
+                healthy.append(replica)
+
+        return healthy
+
+    # Per request
+
+    def choose(self):
+        """before_request: pick this request's replica (or none)."""
+
+        g.db_replica = None
+        g.db_wrote = False
+
+        if not self.app.config['REPLICA_BINDS']:
+            return
+
+        view = self.app.view_functions.get(request.endpoint)
+
+        if (request.method in READ_METHODS and
+                not getattr(view, 'use_primary', False) and
+                session.get(PIN_KEY, 0) <= time.time()):
+            healthy = self.healthy_replicas()
+            if healthy:
+                g.db_replica = random.choice(healthy)
+
+        if g.db_replica is not None:
+            g.db_replica.requests += 1
+        else:
+            self.primary_requests += 1
+
+    def engine_for(self, db_session, clause):
+        """Engine for a statement in this request; None for the primary."""
+
+        if not has_request_context():
+            return None
+
+        if db_session._flushing or isinstance(clause, UpdateBase):
+            g.db_wrote = True
+            return None
+
+        replica = g.get('db_replica')
+
+        if replica is None or g.get('db_wrote'):
+            return None
+
+        return replica.engine
+
+    def pin(self, resp):
+        """after_request: keep a user who just wrote on the primary."""
+
+        if self.app.config['REPLICA_BINDS'] and g.get('db_wrote'):
+            session[PIN_KEY] = (time.time() +
+                                self.app.config['REPLICA_PIN_SECONDS'])
+
+        return resp
+
+    # Metrics
+
+    def pool_stats(self):
+        """{(bind, state): connections} for the primary and replicas."""
+
+        engines = [('primary', self.db.engine)]
+        engines += [(replica.key, replica.engine)
+                    for replica in self.get_replicas()]
+        stats = {}
+
+        for key, engine in engines:
+            pool = engine.pool
+            # QueuePool reports these; SQLite's pools don't
+            if hasattr(pool, 'checkedout'):
+                stats[(key, 'checked_out')] = pool.checkedout()
+                stats[(key, 'idle')] = pool.checkedin()
+                stats[(key, 'overflow')] = max(0, pool.overflow())
+
+        return stats
+
+    def replica_health(self):
+        """{(bind,): 1 if healthy else 0} for each replica."""
+
+        return {(replica.key,): int(replica.healthy)
+                for replica in self.get_replicas()}
+
+    def replica_lag(self):
+        """{(bind,): replication lag in seconds at the last check}."""
+
+        return {(replica.key,): replica.lag
+                for replica in self.get_replicas()}
+
+    def request_counts(self):
+        """{(bind,): requests routed there} by this worker."""
+
+        counts = {('primary',): self.primary_requests}
+        counts.update({(replica.key,): replica.requests
+                       for replica in self.get_replicas()})
+        return counts
@@ -0,0 +1,535 @@
+"""Username and message search.
+
+On Postgres, searches run against a pg_trgm GIN index on users.username
+(created alongside the users table, see models.py), so both substring and
+prefix matches are index lookups rather than a sequential scan. Servers
+without pg_trgm get no index, and scan.
+
+Other databases (SQLite in development and tests) get an in-process
+trigram index instead, built lazily per worker and kept in step with
+User inserts/updates/deletes committed through this process.
+
+Either way results are ranked exact match first, then prefix matches,
+then other substring matches (shorter usernames first within each group).
+
+Message search works the same way: a GIN index over
+to_tsvector('simple', text) on Postgres, an in-process positional
+inverted index (TextIndex) elsewhere.
+"""
+
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict, namedtuple
+from heapq import nlargest
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session, object_session
+
+from models import db, User, Message
+from pagination import Page, paginate, encode_cursor, decode_cursor
+
+# Queries shorter than this only match username prefixes; a 1-2 letter
+# substring match would hit most of the table.
+MIN_SUBSTRING_LENGTH = 3
+
+
+class NgramIndex:
+    """In-memory trigram inverted index over short strings (usernames).
+
+    Strings are lowercased and padded like pg_trgm does ("  abc "), so a
+    padded query prefix finds values starting with it and an unpadded query
+    finds values containing it. Candidates are verified before returning.
+    """
+
+    N = 3
+
+    def __init__(self):
+        self.values = {}
+        self.postings = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    @classmethod
+    def grams(cls, text):
+        return {text[i:i + cls.N] for i in range(len(text) - cls.N + 1)}
+
+    @classmethod
+    def padded(cls, text):
+        return " " * (cls.N - 1) + text.lower() + " "
+
+    def add(self, id, text):
+        """Index `text` under `id`, replacing whatever `id` had before."""
+
+        with self.lock:
+            self._remove(id)
+            self.values[id] = text.lower()
+            for gram in self.grams(self.padded(text)):
+                self.postings[gram].add(id)
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        old = self.values.pop(id, None)
+
+        if old is None:
+            return
+
+        for gram in self.grams(self.padded(old)):
+            ids = self.postings[gram]
+            ids.discard(id)
+            if not ids:
+                del self.postings[gram]
+
+    def search(self, query):
+        """Ids of values matching `query`, best match first."""
+
+        query = query.lower()
+
+        if len(query) < MIN_SUBSTRING_LENGTH:
+            # the padded prefix ("  ab") only yields grams from the start
+            grams = self.grams(self.padded(query)[:-1])
+            matches = str.startswith
+        else:
+            grams = self.grams(query)
+            matches = str.__contains__
+
+        with self.lock:
+            postings = sorted((self.postings.get(gram, set())
+                               for gram in grams),
+                              key=len)
+            candidates = set.intersection(*postings) if postings else set()
+            found = [(id, self.values[id]) for id in candidates
+                     if matches(self.values[id], query)]
+
+        def rank(item):
+            id, value = item
+            group = 0 if value == query else 1 if value.startswith(query) else 2
+            return group, len(value), value
+
+        return [id for id, value in sorted(found, key=rank)]
+
+
+class LazyIndex:
+    """Per-worker in-process index, loaded from the database on first use.
+
+    `load` yields (id, *values) rows that are fed to `factory().add`.
+    """
+
+    def __init__(self, factory, load):
+        self.factory = factory
+        self.load = load
+        self.index = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """The index, loading it on first use."""
+
+        with self.lock:
+            if self.index is None:
+                index = self.factory()
+                for id, *values in self.load():
+                    index.add(id, *values)
+                self.index = index
+
+            return self.index
+
+    def reset(self):
+        """Forget everything; the next search reloads from the database."""
+
+        with self.lock:
+            self.index = None
+
+    def apply(self, changes):
+        """Apply committed (id, values-or-None) changes if loaded."""
+
+        index = self.index
+
+        if index is None:
+            return
+
+        for id, values in changes:
+            if values is None:
+                index.remove(id)
+            else:
+                index.add(id, *values)
+
+
+user_index = LazyIndex(
+    NgramIndex,
+    lambda: (db.session.query(User.id, User.username).yield_per(1000)))
+
+
+def uses_postgres():
+    """Can we search with the Postgres trigram/full-text indexes?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def like_escape(text):
+    """Escape LIKE wildcards in user input."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def _sql_search(query):
+    """Ranked, unpaginated Postgres query for usernames matching `query`."""
+
+    pattern = like_escape(query)
+    prefix = User.username.ilike(f"{pattern}%", escape='\\')
+
+    if len(query) < MIN_SUBSTRING_LENGTH:
+        matches = prefix
+    else:
+        matches = User.username.ilike(f"%{pattern}%", escape='\\')
+
+    rank = case([(func.lower(User.username) == query.lower(), 0),
+                 (prefix, 1)],
+                else_=2)
+
+    return (User
+            .query
+            .filter(matches)
+            .order_by(rank, func.length(User.username), User.username))
+
+
+def search_users(query, page=1, per_page=20):
+    """Find users whose username contains `query`, best matches first.
+
+    Returns (users, has_more) for 1-based `page`.
+    """
+
+    query = query.strip()
+    offset = (page - 1) * per_page
+
+    if not query:
+        return [], False
+
+    if uses_postgres():
+        users = _sql_search(query).offset(offset).limit(per_page + 1).all()
+        return users[:per_page], len(users) > per_page
+
+    ids = user_index.get().search(query)
+    page_ids = ids[offset:offset + per_page]
+
+    if not page_ids:
+        return [], False
+
+    by_id = {user.id: user
+             for user in User.query.filter(User.id.in_(page_ids))}
+
+    users = [by_id[id] for id in page_ids if id in by_id]
+    return users, len(ids) > offset + per_page
+
+
+def typeahead_users(query, limit=8):
+    """Top `limit` (id, username, image_url) rows for a search box prefix."""
+
+    query = query.strip()
+
+    if not query:
+        return []
+
+    if uses_postgres():
+        return (_sql_search(query)
+                .with_entities(User.id, User.username, User.image_url)
+                .limit(limit)
+                .all())
+
+    ids = user_index.get().search(query)[:limit]
+
+    if not ids:
+        return []
+
+    rows = {row.id: row
+            for row in (db.session
+                        .query(User.id, User.username, User.image_url)
+                        .filter(User.id.in_(ids)))}
+
+    return [rows[id] for id in ids if id in rows]
+
+
+##############################################################################
+# Message search
+
+
+Clause = namedtuple('Clause', ['kind', 'words'])
+
+# "quoted phrase" or a bare word (a trailing * makes it a prefix)
+_QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+# Letters/digits only, matching how Postgres' parser splits on underscores.
+_TOKEN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """Lowercased word tokens of `text`."""
+
+    return _TOKEN.findall(text.lower())
+
+
+def parse_query(query):
+    """Turn a search box query into a list of Clauses, all of which must match.
+
+    Clause kinds are 'term' (exact word), 'prefix' (word*) and 'phrase'
+    ("words in order").
+    """
+
+    clauses = []
+
+    for phrase, word in _QUERY_PART.findall(query):
+        if phrase:
+            words = tokenize(phrase)
+            if len(words) > 1:
+                clauses.append(Clause('phrase', words))
+            elif words:
+                clauses.append(Clause('term', words))
+            continue
+
+        words = tokenize(word)
+        for i, token in enumerate(words):
+            last = i == len(words) - 1
+            kind = 'prefix' if last and word.endswith('*') else 'term'
+            clauses.append(Clause(kind, [token]))
+
+    return clauses
+
+
+def to_tsquery(clauses):
+    """Postgres tsquery source for parsed clauses.
+
+    Safe to interpolate: tokens are letters and digits only.
+    """
+
+    parts = []
+
+    for clause in clauses:
+        if clause.kind == 'phrase':
+            words = " <-> ".join(f"'{word}'" for word in clause.words)
+            parts.append(f"({words})")
+        elif clause.kind == 'prefix':
+            parts.append(f"'{clause.words[0]}':*")
+        else:
+            parts.append(f"'{clause.words[0]}'")
+
+    return " & ".join(parts)
+
+
+class TextIndex:
+    """In-memory positional inverted index over message text.
+
+    Keeps token -> {message id: positions} postings, a sorted vocabulary
+    for prefix queries and each message's (timestamp, id) sort key, so
+    results can be keyset-paginated without touching the database.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.vocabulary = []
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, id, text, timestamp):
+        """Index message `id`, replacing whatever it had before."""
+
+        positions = defaultdict(list)
+        for position, token in enumerate(tokenize(text)):
+            positions[token].append(position)
+
+        with self.lock:
+            self._remove(id)
+
+            for token, at in positions.items():
+                if token not in self.postings:
+                    insort(self.vocabulary, token)
+                self.postings[token][id] = tuple(at)
+
+            self.docs[id] = (timestamp, tuple(positions))
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        doc = self.docs.pop(id, None)
+
+        if doc is None:
+            return
+
+        for token in doc[1]:
+            ids = self.postings[token]
+            del ids[id]
+            if not ids:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def _expand(self, prefix):
+        start = bisect_left(self.vocabulary, prefix)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _matching(self, clause):
+        if clause.kind == 'prefix':
+            ids = set()
+            for token in self._expand(clause.words[0]):
+                ids.update(self.postings[token])
+            return ids
+
+        postings = [self.postings.get(word, {}) for word in clause.words]
+        ids = set.intersection(*(set(posting) for posting in postings))
+
+        if clause.kind == 'term':
+            return ids
+
+        def in_order(id):
+            rest = [set(posting[id]) for posting in postings[1:]]
+            return any(all(start + i + 1 in at for i, at in enumerate(rest))
+                       for start in postings[0][id])
+
+        return {id for id in ids if in_order(id)}
+
+    def search(self, clauses, before=None, limit=20):
+        """Up to `limit` (timestamp, id) keys matching all clauses.
+
+        Newest first, starting just past the `before` key if given.
+        """
+
+        if not clauses:
+            return []
+
+        with self.lock:
+            ids = None
+            for clause in clauses:
+                matching = self._matching(clause)
+                ids = matching if ids is None else ids & matching
+                if not ids:
+                    return []
+
+            keys = ((self.docs[id][0], id) for id in ids)
+            if before is not None:
+                keys = (key for key in keys if key < before)
+
+            return nlargest(limit, keys)
+
+
+message_index = LazyIndex(
+    TextIndex,
+    lambda: (db.session
+             .query(Message.id, Message.text, Message.timestamp)
+             .yield_per(1000)))
+
+
+def search_messages(query, before=None, per_page=20):
+    """Messages matching `query`, newest first, as a pagination.Page.
+
+    Supports bare words (all must appear), word* prefixes and "quoted
+    phrases". `before` is a cursor from a previous page; authors come
+    back eager-loaded. Raises pagination.InvalidCursor for a bad cursor.
+    """
+
+    clauses = parse_query(query)
+
+    if not clauses:
+        return Page([], None)
+
+    if uses_postgres():
+        matches = (func.to_tsvector('simple', Message.text)
+                   .op('@@')(func.to_tsquery('simple', to_tsquery(clauses))))
+        return paginate(Message
+                        .query
+                        .filter(matches)
+                        .options(db.joinedload(Message.author)),
+                        Message.timestamp,
+                        Message.id,
+                        before=before,
+                        per_page=per_page)
+
+    cursor = decode_cursor(before) if before else None
+    keys = message_index.get().search(clauses, cursor, limit=per_page + 1)
+    page_keys = keys[:per_page]
+
+    if not page_keys:
+        return Page([], None)
+
+    by_id = {msg.id: msg
+             for msg in (Message
+                         .query
+                         .filter(Message.id.in_([id for _, id in page_keys]))
+                         .options(db.joinedload(Message.author)))}
+
+    messages = [by_id[id] for _, id in page_keys if id in by_id]
+    next_cursor = encode_cursor(*page_keys[-1]) if len(keys) > per_page else None
+
+    return Page(messages, next_cursor)
+
+
+##############################################################################
+# Keep the in-process indexes in step with committed changes
+
+
+def _pending(session, index):
+    changes = session.info.setdefault('search_changes', {})
+    return changes.setdefault(index, [])
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_saved(mapper, connection, user):
+    session = object_session(user)
+    if session is not None:
+        _pending(session, user_index).append((user.id, (user.username,)))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    session = object_session(user)
+    if session is not None:
+        _pending(session, user_index).append((user.id, None))
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_saved(mapper, connection, msg):
+    session = object_session(msg)
+    if session is not None:
+        _pending(session, message_index).append(
+            (msg.id, (msg.text, msg.timestamp)))
+
+
+@event.listens_for(Message, 'after_delete')
+def _message_deleted(mapper, connection, msg):
+    session = object_session(msg)
+    if session is not None:
+        _pending(session, message_index).append((msg.id, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('search_changes', {})
+    for index, index_changes in changes.items():
+        index.apply(index_changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_changes(session, previous_transaction):
+    session.info.pop('search_changes', None)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _bulk_delete(context):
+    if context.mapper.class_ is User:
+        user_index.reset()
+        # messages go with their authors (ON DELETE CASCADE)
+        message_index.reset()
+    elif context.mapper.class_ is Message:
+        message_index.reset()
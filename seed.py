@@ -1,50 +1,266 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py [--data-dir generator] [--chunk-size 50000]
+
+Drops and recreates every table, then streams users.csv, messages.csv
+and follows.csv into the database a chunk at a time: COPY FROM STDIN on
+Postgres, batched executemany elsewhere (SQLite). Secondary indexes are
+dropped for the load and rebuilt once the data is in, sequences are
+moved past the loaded ids, and each step reports its rows/sec.
+
+CSV headers name the columns to fill; anything left out gets the
+column's server default. Empty fields load as NULL.
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from itertools import islice
+
+from sqlalchemy import text
 
-from csv import DictReader
 from app import db
-from models import User, Message, FollowersFollowee, Like
+from migrations import stamp
+from models import User, Message, FollowersFollowee, Like, Timeline
+
+# Load order (follows and messages reference users)
+CSV_TABLES = [('users.csv', User.__table__),
+              ('messages.csv', Message.__table__),
+              ('follows.csv', FollowersFollowee.__table__)]
+
+
+def report(step, started, rows=None):
+    """Print how long `step` took, and its throughput if it loaded rows."""
+
+    elapsed = time.perf_counter() - started
+
+    if rows is None:
+        print(f"{step:<24} {'':>17} {elapsed:8.2f}s")
+    else:
+        rate = rows / elapsed if elapsed else 0
+        print(f"{step:<24} {rows:>12,} rows {elapsed:8.2f}s "
+              f"({rate:,.0f} rows/s)")
+
+
+def chunks(rows, size):
+    """Lists of up to `size` items from iterator `rows`."""
+
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def copy_chunk(cursor, table, columns, chunk):
+    """COPY one chunk of CSV rows into `table` (Postgres)."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(chunk)
+    buf.seek(0)
+
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) "
+        f"FROM STDIN WITH (FORMAT csv)",
+        buf)
+
+
+def insert_chunk(cursor, table, columns, chunk, paramstyle):
+    """executemany one chunk of CSV rows into `table` (anything else)."""
+
+    marker = '?' if paramstyle == 'qmark' else '%s'
+    cursor.executemany(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join([marker] * len(columns))})",
+        [[value if value != '' else None for value in row]
+         for row in chunk])
+
+
+def load_csv(conn, path, table, chunk_size):
+    """Stream the CSV at `path` into `table`; returns the row count."""
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    paramstyle = db.engine.dialect.paramstyle
+    cursor = conn.cursor()
+    count = 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+
+        for chunk in chunks(reader, chunk_size):
+            if postgres:
+                copy_chunk(cursor, table, columns, chunk)
+            else:
+                insert_chunk(cursor, table, columns, chunk, paramstyle)
+            count += len(chunk)
+
+    conn.commit()
+    return count
+
+
+def drop_secondary_indexes(tables):
+    """Drop indexes not backing a constraint; returns their definitions."""
+
+    if db.engine.dialect.name == 'postgresql':
+        found = text(
+            "SELECT indexname, indexdef FROM pg_indexes i "
+            "WHERE schemaname = current_schema() AND tablename = :table "
+            "AND NOT EXISTS "
+            "(SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)")
+    else:
+        # constraint-backed sqlite indexes have no sql
+        found = text(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL")
+
+    definitions = {}
+
+    with db.engine.begin() as conn:
+        for table in tables:
+            rows = conn.execute(found, table=table.name).fetchall()
+            definitions[table.name] = [sql for name, sql in rows]
+            for name, sql in rows:
+                conn.execute(f"DROP INDEX {name}")
+
+    return definitions
+
+
+def create_indexes(definitions, table):
+    """Recreate `table`'s indexes dropped by drop_secondary_indexes."""
+
+    started = time.perf_counter()
+
+    with db.engine.begin() as conn:
+        for sql in definitions.pop(table.name, []):
+            conn.execute(sql)
+
+    report(f"indexes on {table.name}", started)
+
+
+def reset_sequences():
+    """Move id sequences past the highest loaded id (Postgres)."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    with db.engine.begin() as conn:
+        for table in (User.__table__, Message.__table__):
+            conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),"
+                f" COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1,"
+                f" false)")
+
+
+# (user_id, msg_id) of a few likes in the 1x dataset
+SAMPLE_LIKES = [(100, 97), (72, 17), (193, 97)]
+
+
+def add_sample_accounts():
+    """Our own test accounts and a few likes."""
+
+    lena = User(
+        id=403,
+        username="meow",
+        password="$2b$12$sPCpn3/c7WAd623GKiGNWesVRaZCdTsQlBGBILA9QYsJHbpCFA5lW",
+        image_url="https://static.boredpanda.com/blog/wp-content/uploads/2016/08/Cute-kittens-46-57b323088a692__605.jpg",
+        email="meow@email.com"
+    )
+
+    gabriela = User(
+        id=401,
+        username="satan",
+        password="$2b$12$evlyorusVLeASmpmCTYyb.7ADy7oh9BEyVqjQLz67XFUpNuFMAQVO",
+        image_url="https://previews.123rf.com/images/hermandesign2015/hermandesign20151709/hermandesign2015170900004/85861572-red-devil-head-cartoon.jpg",
+        email="hahaha@gmail.com"
+    )
+
+    # generated datasets past 1x already use those ids
+    last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    if last_id >= gabriela.id:
+        gabriela.id, lena.id = last_id + 1, last_id + 2
+
+    db.session.add(lena)
+    db.session.add(gabriela)
+
+    # db.session.add(FollowersFollowee(followee_id=403, follower_id=401))
+    # db.session.add(FollowersFollowee(followee_id=401, follower_id=403))
+
+    # smaller datasets (--users/--messages) may not have these rows
+    likers, liked = zip(*SAMPLE_LIKES)
+    user_ids = {user_id for (user_id,)
+                in db.session.query(User.id).filter(User.id.in_(likers))}
+    msg_ids = {msg_id for (msg_id,)
+               in db.session.query(Message.id).filter(Message.id.in_(liked))}
+
+    for user_id, msg_id in SAMPLE_LIKES:
+        if user_id in user_ids and msg_id in msg_ids:
+            db.session.add(Like(user_id=user_id, msg_id=msg_id))
+
+    db.session.commit()
+
+
+def seed(data_dir, chunk_size):
+    db.drop_all()
+    db.create_all()
+    stamp(db.engine)
+
+    tables = [table for name, table in CSV_TABLES] + [Timeline.__table__]
+    deferred = drop_secondary_indexes(tables)
+
+    conn = db.engine.raw_connection()
 
+    try:
+        for name, table in CSV_TABLES:
+            started = time.perf_counter()
+            count = load_csv(conn, os.path.join(data_dir, name), table,
+                             chunk_size)
+            report(f"load {table.name}", started, count)
+    finally:
+        conn.close()
 
-db.drop_all()
-db.create_all()
+    # the rebuilds below join on these, so they're needed from here on
+    for name, table in CSV_TABLES:
+        create_indexes(deferred, table)
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    add_sample_accounts()
+    reset_sequences()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    # bulk loads skip fan-out and counter updates, so build everyone's
+    # home timeline and cached counts in one go
+    started = time.perf_counter()
+    Timeline.rebuild()
+    db.session.commit()
+    report("rebuild timelines", started, Timeline.query.count())
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
+    create_indexes(deferred, Timeline.__table__)
 
-lena = User(
-    id=403,
-    username="meow",
-    password="$2b$12$sPCpn3/c7WAd623GKiGNWesVRaZCdTsQlBGBILA9QYsJHbpCFA5lW",
-    image_url="https://static.boredpanda.com/blog/wp-content/uploads/2016/08/Cute-kittens-46-57b323088a692__605.jpg",
-    email="meow@email.com"
-)
+    started = time.perf_counter()
+    User.reconcile_counts()
+    db.session.commit()
+    report("reconcile counts", started, User.query.count())
 
-gabriela = User(
-    id=401,
-    username="satan",
-    password="$2b$12$evlyorusVLeASmpmCTYyb.7ADy7oh9BEyVqjQLz67XFUpNuFMAQVO",
-    image_url="https://previews.123rf.com/images/hermandesign2015/hermandesign20151709/hermandesign2015170900004/85861572-red-devil-head-cartoon.jpg",
-    email="hahaha@gmail.com"
-)
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as conn:
+            conn.execute("ANALYZE")
 
-db.session.add(lena)
-db.session.add(gabriela)
 
-# db.session.add(FollowersFollowee(followee_id=403, follower_id=401))
-# db.session.add(FollowersFollowee(followee_id=401, follower_id=403))
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reset the database and load CSV fixtures into it.")
+    parser.add_argument('--data-dir', default='generator',
+                        help='directory with users/messages/follows.csv')
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help='rows per COPY / executemany batch')
+    args = parser.parse_args()
 
-like1 = Like(user_id=100, msg_id=97)
-like2 = Like(user_id=72, msg_id=17)
-like3 = Like(user_id=193, msg_id=97)
+    started = time.perf_counter()
+    seed(args.data_dir, args.chunk_size)
+    print(f"done in {time.perf_counter() - started:.2f}s")
 
-db.session.add(like1)
-db.session.add(like2)
-db.session.add(like3)
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+// Like buttons without a page reload (see /api/v1/messages/<id>/like).
+// Without JavaScript, or if the API turns the request down, the like
+// forms post and redirect as before.
+
+$(function () {
+  // Random Idempotency-Key: one per click, reused for that click's retries
+  function newKey() {
+    var bytes = new Uint8Array(16);
+    window.crypto.getRandomValues(bytes);
+    return Array.prototype.map.call(bytes, function (b) {
+      return ('0' + b.toString(16)).slice(-2);
+    }).join('');
+  }
+
+  $(document).on('submit', 'form[action$="/like"]', function (evt) {
+    var form = this;
+    var $button = $(form).find('.like-btn');
+    var msgId = form.getAttribute('action').split('/')[2];
+    var key = newKey();
+
+    evt.preventDefault();
+    if ($button.prop('disabled')) {
+      return;
+    }
+    $button.prop('disabled', true);
+
+    function send(retries) {
+      $.ajax({
+        url: '/api/v1/messages/' + msgId + '/like',
+        method: 'POST',
+        headers: {'Idempotency-Key': key},
+        dataType: 'json'
+      }).done(function (data) {
+        $button.find('i')
+          .toggleClass('fas', data.liked)
+          .toggleClass('far', !data.liked);
+        $button.attr('title', data.likes + (data.likes === 1 ? ' like' : ' likes'));
+        $button.prop('disabled', false);
+      }).fail(function (xhr) {
+        if (xhr.status === 0) {
+          // no response: it may or may not have gone through, so only
+          // retry with the same key
+          if (retries > 0) {
+            setTimeout(function () { send(retries - 1); }, 500);
+          } else {
+            $button.prop('disabled', false);
+          }
+          return;
+        }
+        form.submit();
+      });
+    }
+
+    send(2);
+  });
+});
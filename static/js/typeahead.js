@@ -0,0 +1,26 @@
+// Username suggestions for the navbar search box (see /users/typeahead).
+
+$(function () {
+  var $search = $('#search');
+  var $suggestions = $('#search-suggestions');
+  var pending = null;
+
+  $search.on('input', function () {
+    var q = $search.val().trim();
+
+    clearTimeout(pending);
+    if (!q) {
+      $suggestions.empty();
+      return;
+    }
+
+    pending = setTimeout(function () {
+      $.getJSON('/users/typeahead', {q: q}, function (data) {
+        $suggestions.empty();
+        data.users.forEach(function (user) {
+          $('<option>').attr('value', user.username).appendTo($suggestions);
+        });
+      });
+    }, 150);
+  });
+});
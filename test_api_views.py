@@ -0,0 +1,244 @@
+"""JSON API View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api_views.py
+
+
+import gzip
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import (db, connect_db, User, Message, Like, FollowersFollowee,
+                    Timeline, IdempotencyKey)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiViewTestCase(TestCase):
+    """Test the JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Like.query.delete()
+        IdempotencyKey.query.delete()
+        FollowersFollowee.query.delete()
+        Timeline.query.delete()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.author = User.signup(username="author",
+                                  email="author@test.com",
+                                  password="author",
+                                  image_url=None)
+        db.session.commit()
+
+        self.testuser_id = self.testuser.id
+        self.author_id = self.author.id
+
+        for i in range(3):
+            msg = Message(text=f"Warble {i}",
+                          user_id=self.author_id,
+                          timestamp=datetime(2018, 1, i + 1))
+            db.session.add(msg)
+            db.session.flush()
+            Timeline.fan_out(msg)
+        db.session.commit()
+
+    def get_json(self, url, **kwargs):
+        resp = self.client.get(url, **kwargs)
+        return resp, json.loads(resp.data)
+
+    def test_user_messages(self):
+        """ Are a user's messages paged newest first with authors listed once? """
+
+        per_page = app.config['MESSAGES_PER_PAGE']
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            resp, data = self.get_json(
+                f"/api/v1/users/{self.author_id}/messages")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["Warble 2", "Warble 1"])
+            self.assertEqual(data['messages'][0]['timestamp'],
+                             "2018-01-03T00:00:00Z")
+            self.assertEqual(list(data['users']), [str(self.author_id)])
+            self.assertEqual(data['users'][str(self.author_id)]['username'],
+                             "author")
+
+            resp, data = self.get_json(
+                f"/api/v1/users/{self.author_id}/messages"
+                f"?before={data['next_cursor']}")
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["Warble 0"])
+            self.assertIsNone(data['next_cursor'])
+
+            resp, data = self.get_json(
+                f"/api/v1/users/{self.author_id}/messages?before=nope")
+            self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = per_page
+
+        resp, data = self.get_json("/api/v1/users/999999/messages")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_timeline_and_profile(self):
+        """ Do the timeline and profile reflect the viewer? """
+
+        resp, data = self.get_json("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp, data = self.get_json(f"/api/v1/users/{self.author_id}")
+            self.assertEqual(data['messages_count'], 0)
+            self.assertFalse(data['following'])
+
+            c.post(f"/users/follow/{self.author_id}")
+
+            resp, data = self.get_json("/api/v1/timeline")
+            self.assertEqual(len(data['messages']), 3)
+            self.assertFalse(data['messages'][0]['liked'])
+
+            resp, data = self.get_json(f"/api/v1/users/{self.author_id}")
+            self.assertTrue(data['following'])
+            self.assertEqual(data['followers_count'], 1)
+
+    def test_toggle_like(self):
+        """ Does the like endpoint toggle, returning state and count? """
+
+        msg_id = Message.query.first().id
+        url = f"/api/v1/messages/{msg_id}/like"
+
+        resp = self.client.post(url)
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(url)
+            self.assertEqual(json.loads(resp.data),
+                             {'message_id': msg_id, 'liked': True,
+                              'likes': 1})
+
+            resp = c.post(url)
+            self.assertEqual(json.loads(resp.data),
+                             {'message_id': msg_id, 'liked': False,
+                              'likes': 0})
+
+            resp = c.post("/api/v1/messages/999999/like")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post("/messages/999999/like", data={"route": "/"})
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+
+    def test_idempotency_key(self):
+        """ Is a retried toggle with the same key answered, not repeated? """
+
+        first, second = [msg.id for msg in Message.query.limit(2)]
+        headers = {'Idempotency-Key': 'click-1'}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/api/v1/messages/{first}/like", headers=headers)
+            self.assertTrue(json.loads(resp.data)['liked'])
+            self.assertNotIn('Idempotent-Replayed', resp.headers)
+
+            resp = c.post(f"/api/v1/messages/{first}/like", headers=headers)
+            self.assertTrue(json.loads(resp.data)['liked'])
+            self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+
+            resp = c.post(f"/api/v1/messages/{second}/like", headers=headers)
+            self.assertEqual(resp.status_code, 422)
+
+            resp = c.post(f"/api/v1/messages/{first}/like",
+                          headers={'Idempotency-Key': 'x' * 65})
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+
+    def test_toggle_ignores_if_none_match(self):
+        """ Does a toggle always answer with the new state, never a 304? """
+
+        msg_id = Message.query.first().id
+        headers = {'Idempotency-Key': 'click-1', 'If-None-Match': '*'}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for replayed in (False, True):
+                resp = c.post(f"/api/v1/messages/{msg_id}/like",
+                              headers=headers)
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('ETag', resp.headers)
+                self.assertTrue(json.loads(resp.data)['liked'])
+                self.assertEqual('Idempotent-Replayed' in resp.headers,
+                                 replayed)
+
+    def test_gzip_and_etag(self):
+        """ Are big responses gzipped, and unchanged ones answered with 304? """
+
+        for i in range(5):
+            db.session.add(Message(text="A longer warble " * 8,
+                                   user_id=self.author_id))
+        db.session.commit()
+
+        url = f"/api/v1/users/{self.author_id}/messages"
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))
+                             ['messages']), 8)
+
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # plain responses carry the strong form of the same tag
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['ETag'], etag[2:])
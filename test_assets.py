@@ -0,0 +1,104 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from assets import build, IMMUTABLE
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, assets
+
+
+class AssetBuildTestCase(TestCase):
+    """Test fingerprinting, precompression and serving of built assets."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.static = os.path.join(self.tmp, 'static')
+        self.dist = os.path.join(self.static, 'dist')
+
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+        with open(os.path.join(self.static, 'stylesheets', 'style.css'),
+                  'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n')
+
+        self.manifest = build(self.static, self.dist)
+
+        self.old_dist = assets.dist_folder
+        assets.dist_folder = self.dist
+        assets.load_manifest()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        assets.dist_folder = self.old_dist
+        assets.load_manifest()
+        shutil.rmtree(self.tmp)
+
+    def test_build(self):
+        """ Are files fingerprinted, compressed and cross-referenced? """
+
+        css = self.manifest['stylesheets/style.css']
+        png = self.manifest['images/bg.png']
+
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(self.dist, css + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.dist, png + '.gz')))
+
+        with open(os.path.join(self.dist, css)) as f:
+            self.assertIn(f'url("/assets/{png}")', f.read())
+
+        # rebuilding unchanged files gives the same names
+        self.assertEqual(build(self.static, self.dist), self.manifest)
+
+    def test_serve(self):
+        """ Are built assets served immutable, gzipped when accepted? """
+
+        css = self.manifest['stylesheets/style.css']
+
+        with app.test_request_context():
+            self.assertEqual(app.jinja_env.globals['asset_url'](
+                'stylesheets/style.css'), f'/assets/{css}')
+
+        resp = self.client.get(f'/assets/{css}',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(resp.content_type.startswith('text/css'))
+        self.assertIn(b'/assets/images/bg.', gzip.decompress(resp.data))
+        resp.close()
+
+        resp = self.client.get(f'/assets/{css}')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'/assets/images/bg.', resp.data)
+        resp.close()
+
+        self.assertEqual(self.client.get(f'/assets/{css}.gz').status_code,
+                         404)
+        self.assertEqual(
+            self.client.get('/assets/../../app.py').status_code, 404)
+
+    def test_static_uncached(self):
+        """ Are plain /static/ URLs, which deploys change, left uncached? """
+
+        resp = self.client.get('/static/stylesheets/style.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'],
+                         'no-cache, no-store, must-revalidate')
+        self.assertEqual(resp.headers['Expires'], '0')
+        resp.close()
@@ -0,0 +1,86 @@
+"""Benchmark harness tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_benchmark.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like, FollowersFollowee, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+from benchmark import (DEFAULT_MIX, InProcessClient, Workload, percentile,
+                       regressions, run)
+
+db.create_all()
+
+
+class BenchmarkTestCase(TestCase):
+    """Test the request mix replay and its report."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Timeline.query.delete()
+        User.query.delete()
+        Message.query.delete()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="x")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        messages = [Message(text=f"Warble {i}", user_id=users[i % 3].id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.message_ids = [msg.id for msg in messages]
+
+    def tearDown(self):
+        # the users followed each other; not every test cleans up follows
+        FollowersFollowee.query.delete()
+        db.session.commit()
+
+    def test_run(self):
+        """ Does every route in the mix get timed, without server errors? """
+
+        workload = Workload(DEFAULT_MIX, self.user_ids, self.message_ids)
+        summary = run(workload, InProcessClient, requests=60,
+                      warmup=5).summary()
+
+        self.assertEqual(set(summary), set(DEFAULT_MIX) | {'all'})
+        self.assertEqual(summary['all']['count'], 60)
+        self.assertEqual(summary['all']['errors'], 0)
+        self.assertGreater(summary['home']['queries'], 0)
+        self.assertGreater(summary['all']['rps'], 0)
+
+        # posts went through as the signed-in users
+        self.assertGreater(Message.query.count(), 5)
+
+    def test_percentiles_and_regressions(self):
+        """ Are nearest-rank percentiles and slowdowns reported? """
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+        before = {'home': {'p95_ms': 10.0, 'queries': 4.0}}
+        self.assertEqual(
+            regressions(before, {'home': {'p95_ms': 11.0, 'queries': 4.0}},
+                        0.2),
+            [])
+        self.assertEqual(
+            len(regressions(before,
+                            {'home': {'p95_ms': 13.0, 'queries': 6.0},
+                             'new': {'p95_ms': 1.0, 'queries': 1.0}},
+                            0.2)),
+            2)
@@ -0,0 +1,52 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+
+from unittest import TestCase
+
+from caching import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU cache."""
+
+    def test_lru_eviction(self):
+        """ Is the least recently used entry evicted first? """
+
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_memory_cap(self):
+        """ Are entries evicted to stay under max_bytes? """
+
+        cache = LRUCache(maxsize=100, max_bytes=10, sizeof=len)
+        cache.set("a", "xxxx")
+        cache.set("b", "xxxx")
+        cache.set("c", "xxxx")
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.bytes, 8)
+        self.assertIsNone(cache.get("a"))
+
+        cache.invalidate("b")
+        self.assertEqual(cache.bytes, 4)
+
+    def test_ttl(self):
+        """ Are expired entries treated as misses? """
+
+        cache = LRUCache(ttl=-1)
+        cache.set("a", 1)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
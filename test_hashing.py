@@ -0,0 +1,60 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashing.py
+
+
+import time
+from unittest import TestCase
+
+from hashing import PasswordHasher, HashingBusy, hash_rounds
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test the pooled bcrypt hasher."""
+
+    def test_pool_round_trip(self):
+        """ Do hashes made in the process pool check out? """
+
+        hasher = PasswordHasher(rounds=4, workers=1)
+        hashed = hasher.hash("secret")
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(hasher.check(hashed, "secret"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+        self.assertFalse(hasher.check("not a hash", "secret"))
+        self.assertEqual(hasher.stats()["completed"], 4)
+
+    def test_backpressure(self):
+        """ Are hashes rejected once the queue is full? """
+
+        hasher = PasswordHasher(rounds=4, workers=1, max_pending=0)
+
+        self.assertRaises(HashingBusy, hasher.hash, "secret")
+        self.assertEqual(hasher.stats()["rejected"], 1)
+
+    def test_timeout(self):
+        """ Does a hash that takes too long shed the request, not crash it? """
+
+        hasher = PasswordHasher(rounds=10, workers=1, timeout=0.001)
+
+        self.assertRaises(HashingBusy, hasher.hash, "secret")
+        self.assertEqual(hasher.stats()["timed_out"], 1)
+
+        # the hash still holds its slot until it really finishes
+        self.assertEqual(hasher.stats()["pending"], 1)
+        deadline = time.monotonic() + 10
+        while hasher.stats()["pending"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(hasher.stats()["pending"], 0)
+        self.assertEqual(hasher.stats()["completed"], 0)
+
+    def test_needs_rehash(self):
+        """ Are hashes made at another cost flagged for upgrade? """
+
+        hasher = PasswordHasher(rounds=4)
+
+        self.assertFalse(hasher.needs_rehash(hasher.hash("secret")))
+        self.assertTrue(hasher.needs_rehash(
+            "$2b$12$sPCpn3/c7WAd623GKiGNWesVRaZCdTsQlBGBILA9QYsJHbpCFA5lW"))
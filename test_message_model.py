@@ -106,6 +106,23 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.m1.is_liked(self.u1))
         self.assertFalse(self.m1.is_liked(u2))
 
+    def test_liked_ids_for(self):
+        """ Does liked_ids_for resolve a page of messages in one go? """
+
+        m2 = Message(
+           id=1000002,
+           text=LOREM_IPSUM_REG,
+           user_id=1000
+        )
+
+        db.session.add(m2)
+        db.session.add(Like(user_id=1000, msg_id=1000002))
+        db.session.commit()
+
+        self.assertEqual(Like.liked_ids_for(1000, [1000001, 1000002]), {1000002})
+        self.assertEqual(Like.liked_ids_for(1000, []), set())
+        self.assertEqual(Like.liked_ids_for(None, [1000002]), set())
+
     def test_likes_relationship(self):
         """ tests if the likes relationship is functional """
 
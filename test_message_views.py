@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 # from sqlalchemy.orm.exc import DetachedInstanceError
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Like, Timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -39,6 +39,8 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Like.query.delete()
+        Timeline.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -72,6 +74,53 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_fans_out(self):
+        """Does a new message land on the author's and followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        db.session.commit()
+
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            msg = Message.query.one()
+            readers = {row.user_id for row in Timeline.query.filter_by(msg_id=msg.id)}
+            self.assertEqual(readers, {self.testuser.id, follower_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            self.assertIn(b"Fanned out", resp.data)
+
+    def test_search_messages(self):
+        """Can a user search message text by phrase?"""
+
+        db.session.add(Message(text="Warbling in the rain",
+                               user_id=self.testuser.id))
+        db.session.add(Message(text="The rain in Spain",
+                               user_id=self.testuser.id))
+        db.session.commit()
+
+        resp = self.client.get('/messages/search?q="in the rain"')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Warbling in the rain", resp.data)
+        self.assertNotIn(b"The rain in Spain", resp.data)
+
+        resp = self.client.get('/messages/search?q=rain spa*')
+        self.assertIn(b"The rain in Spain", resp.data)
+        self.assertNotIn(b"Warbling in the rain", resp.data)
+
     def test_show_message(self):
         """Can a user view a message?"""
 
@@ -95,6 +144,40 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"TESTINGGG", resp.data)
 
+    def test_show_message_conditional_get(self):
+        """Is an unchanged message page answered with a 304?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="other1",
+                            image_url=None)
+        db.session.flush()
+        msg = Message(text="Cache me", user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/messages/{msg_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # liking it changes the page, so the old ETag no longer matches
+            c.post(f"/messages/{msg_id}/like", data={"route": "/"})
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
     # def test_destroy_message(self):
     #     """Can a user destroy a message?"""
 
@@ -0,0 +1,113 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, metrics
+
+from metrics import Counter, Histogram, Registry
+
+
+class MetricsTestCase(TestCase):
+    """Test per-route metrics and their aggregation across workers."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.directory = None
+        shutil.rmtree(self.directory)
+
+    def scrape(self):
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        return resp.get_data(as_text=True)
+
+    def value(self, text, sample):
+        for line in text.splitlines():
+            if line.startswith(sample + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0.0
+
+    def test_request_metrics(self):
+        """ Are requests counted and timed by endpoint, with templates? """
+
+        requests = ('warbler_requests_total'
+                    '{endpoint="homepage",method="GET",status="200"}')
+        renders = ('warbler_template_render_seconds_count'
+                   '{template="home-anon.html"}')
+        before = self.scrape()
+
+        self.client.get('/')
+        self.client.get('/no-such-page')
+        text = self.scrape()
+
+        self.assertEqual(self.value(text, requests),
+                         self.value(before, requests) + 1)
+        self.assertEqual(self.value(text, renders),
+                         self.value(before, renders) + 1)
+        self.assertIn('endpoint="none",method="GET",status="404"', text)
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram',
+                      text)
+        self.assertIn('warbler_request_duration_seconds_bucket'
+                      '{endpoint="homepage",method="GET",le="+Inf"}', text)
+        self.assertIn('warbler_hash_total{outcome="rejected"}', text)
+        self.assertIn('warbler_cache_requests_total'
+                      '{cache="fragment",result="hit"}', text)
+        self.assertIn('warbler_cache_entries{cache="user"}', text)
+        self.assertIn('\nwarbler_hash_pending ', text)
+
+    def test_multiprocess(self):
+        """ Does /metrics add up every worker's file in METRICS_DIR? """
+
+        metrics.directory = self.directory
+        requests = ('warbler_requests_total'
+                    '{endpoint="homepage",method="GET",status="200"}')
+
+        own = self.value(self.scrape(), requests)
+
+        self.assertTrue(os.path.basename(metrics.path())
+                        .startswith(f"worker-{os.getpid()}-"))
+
+        # an exited worker whose PID this process reused
+        stale = f"worker-{os.getpid()}-0123abcd.json"
+        with open(os.path.join(self.directory, stale), 'w') as f:
+            json.dump({'warbler_requests_total':
+                       [[['homepage', 'GET', '200'], 5]]}, f)
+
+        self.assertEqual(self.value(self.scrape(), requests), own + 5)
+
+    def test_render(self):
+        """ Are histograms cumulative, and snapshots merged? """
+
+        registry = Registry()
+        hits = registry.add(Counter('hits', 'Hits.', ('page',)))
+        timing = registry.add(Histogram('timing', 'Timing.', ('page',),
+                                        buckets=(0.1, 1.0)))
+
+        hits.inc(('a"b',), 2)
+        timing.observe(('x',), 0.05)
+        timing.observe(('x',), 0.5)
+        timing.observe(('x',), 5)
+
+        snapshot = registry.snapshot()
+        text = registry.render(registry.merge([snapshot, snapshot]))
+
+        self.assertIn('hits{page="a\\"b"} 4', text)
+        self.assertIn('timing_bucket{page="x",le="0.1"} 2', text)
+        self.assertIn('timing_bucket{page="x",le="1.0"} 4', text)
+        self.assertIn('timing_bucket{page="x",le="+Inf"} 6', text)
+        self.assertIn('timing_sum{page="x"} 11.1', text)
+        self.assertIn('timing_count{page="x"} 6', text)
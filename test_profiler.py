@@ -0,0 +1,91 @@
+"""Profiler tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiler.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, profiler
+
+from profiler import Sampler, prune
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilerTestCase(TestCase):
+    """Test opt-in request profiling."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.directory = tempfile.mkdtemp()
+        app.config['PROFILE_DIR'] = self.directory
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        shutil.rmtree(self.directory)
+
+    def test_header(self):
+        """ Are only requests with a valid token profiled? """
+
+        resp = self.client.get('/')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+
+        resp = self.client.get('/', headers={'X-Profile': 'forged'})
+        self.assertNotIn('X-Profile-Id', resp.headers)
+
+        resp = self.client.get('/', headers={'X-Profile': profiler.token()})
+        profile_id = resp.headers['X-Profile-Id']
+        self.assertIn('-homepage-', profile_id)
+        self.assertEqual(os.listdir(self.directory), [profile_id])
+
+    def test_sample_rate(self):
+        """ Does PROFILE_SAMPLE_RATE profile requests without a header? """
+
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        resp = self.client.get('/')
+        self.assertIn('X-Profile-Id', resp.headers)
+
+    def test_sampler(self):
+        """ Are another thread's stacks counted in collapsed form? """
+
+        worker = threading.Thread(target=busy_wait, args=(0.2,))
+        worker.start()
+
+        sampler = Sampler(worker.ident, 0.005)
+        sampler.start()
+        worker.join()
+        stacks = sampler.stop()
+
+        leaf = (f"busy_wait (test_profiler.py:"
+                f"{busy_wait.__code__.co_firstlineno})")
+
+        self.assertGreater(sum(stacks.values()), 5)
+        self.assertTrue(any(stack.endswith(leaf) for stack in stacks))
+        self.assertTrue(all(';' in stack for stack in stacks))
+
+    def test_prune(self):
+        """ Are only the newest profiles kept? """
+
+        for name in ['20180101-000000-a', '20180102-000000-b',
+                     '20180103-000000-c']:
+            open(os.path.join(self.directory, f"{name}.collapsed"),
+                 'w').close()
+
+        prune(self.directory, 2)
+
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['20180102-000000-b.collapsed',
+                          '20180103-000000-c.collapsed'])
@@ -0,0 +1,344 @@
+"""Query plan tests: the hot pages must not scan whole tables."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_plans.py
+
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, inspect
+
+from models import db, User, Message, Like, FollowersFollowee, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from migrations import MIGRATIONS, applied_versions, migrate, schema_migrations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@contextmanager
+def capture_selects():
+    """(statement, parameters) of reads this thread runs in the block.
+
+    That's SELECTs and INSERT ... SELECTs (timeline fan-out).
+    """
+
+    thread = threading.get_ident()
+    captured = []
+
+    def before_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+        verb = statement.lstrip()[:6].upper()
+        if (threading.get_ident() == thread and
+                (verb == 'SELECT' or
+                 verb == 'INSERT' and 'SELECT' in statement.upper())):
+            captured.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+
+    try:
+        yield captured
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+
+
+def explain(statement, parameters):
+    """`statement`'s plan: the root node of Postgres' JSON plan, or
+    SQLite's EXPLAIN QUERY PLAN detail lines.
+
+    On Postgres sequential scans are disabled first, so the planner only
+    picks one when no index can serve the query. So are merge and hash
+    joins: with tables this small the planner would rather walk a whole
+    index into one than look rows up, which it won't do at real sizes.
+    """
+
+    conn = db.engine.raw_connection()
+
+    try:
+        cursor = conn.cursor()
+
+        if db.engine.dialect.name == 'postgresql':
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("SET enable_mergejoin = off")
+            cursor.execute("SET enable_hashjoin = off")
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return plan[0]['Plan']
+
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def postgres_nodes(node):
+    """Every node of a Postgres plan."""
+
+    yield node
+
+    for child in node.get('Plans', []):
+        yield from postgres_nodes(child)
+
+
+def full_scans(statement, parameters):
+    """Tables `statement` would read in full, according to EXPLAIN.
+
+    On Postgres, index scans with no index condition (a walk over the
+    whole index) count too.
+    """
+
+    plan = explain(statement, parameters)
+
+    if db.engine.dialect.name == 'postgresql':
+        found = []
+        for node in postgres_nodes(plan):
+            if node['Node Type'] == 'Seq Scan':
+                found.append(f"Seq Scan on {node['Relation Name']}")
+            elif (node['Node Type'] in ('Index Scan', 'Index Only Scan',
+                                        'Bitmap Index Scan') and
+                    'Index Cond' not in node):
+                found.append(f"{node['Node Type']} using "
+                             f"{node['Index Name']} (no condition)")
+        return found
+
+    tables = set(db.metadata.tables)
+    # "SCAN messages" / "SCAN messages USING INDEX ..." read the whole
+    # table or index; "SEARCH ..." doesn't
+    return [detail for detail in plan
+            if detail.split()[0] == 'SCAN' and detail.split()[1] in tables]
+
+
+def searched_indexes(statement, parameters):
+    """Indexes `statement` looks rows up in (with a condition)."""
+
+    plan = explain(statement, parameters)
+
+    if db.engine.dialect.name == 'postgresql':
+        return {node['Index Name'] for node in postgres_nodes(plan)
+                if 'Index Cond' in node}
+
+    # "SEARCH likes USING COVERING INDEX sqlite_autoindex_likes_1 (...)"
+    return {detail.split('INDEX ')[1].split()[0] for detail in plan
+            if detail.startswith('SEARCH') and 'INDEX ' in detail}
+
+
+def analyze():
+    """Refresh planner statistics, so plans reflect the test data."""
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            for table in db.metadata.sorted_tables:
+                conn.execute(f"ANALYZE {table.name}")
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the queries behind the busiest pages."""
+
+    def setUp(self):
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Timeline.query.delete()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"user{i}",
+                             email=f"user{i}@test.com",
+                             password="password",
+                             image_url=None)
+                 for i in range(4)]
+        db.session.commit()
+
+        self.user_id = users[0].id
+
+        for user in users[1:]:
+            db.session.add(FollowersFollowee(followee_id=self.user_id,
+                                             follower_id=user.id))
+            db.session.add(FollowersFollowee(followee_id=user.id,
+                                             follower_id=self.user_id))
+            for day in range(1, 4):
+                db.session.add(Message(text=f"Warble from {user.username}",
+                                       user_id=user.id,
+                                       timestamp=datetime(2018, 1, day)))
+        db.session.commit()
+
+        for msg in Message.query.limit(4):
+            db.session.add(Like(user_id=self.user_id, msg_id=msg.id))
+        Timeline.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+        analyze()
+
+        self.other_id = users[1].id
+
+    def assertNoFullScans(self, captured):
+        self.assertTrue(captured, "no queries captured")
+
+        for statement, parameters in captured:
+            scans = full_scans(statement, parameters)
+            self.assertEqual(scans, [], f"full scan in:\n{statement}")
+
+    def get(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with capture_selects() as captured:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return captured
+
+    def test_homepage(self):
+        """ Does the home timeline read by index? """
+
+        self.assertNoFullScans(self.get('/'))
+
+    def test_users_show(self):
+        """ Does a profile page read the user's messages by index? """
+
+        self.assertNoFullScans(self.get(f'/users/{self.other_id}'))
+
+    def test_users_likes(self):
+        """ Does the likes page read the user's likes by index? """
+
+        captured = self.get(f'/users/{self.user_id}/likes')
+        self.assertNoFullScans(captured)
+
+        # the likes primary key, (user_id, msg_id), finds the user's likes
+        likes_by_user = {'postgresql': 'likes_pkey',
+                         'sqlite': 'sqlite_autoindex_likes_1'}
+        liked_messages = [(statement, parameters)
+                          for statement, parameters in captured
+                          if 'JOIN likes' in statement]
+        self.assertEqual(len(liked_messages), 1)
+        self.assertIn(likes_by_user[db.engine.dialect.name],
+                      searched_indexes(*liked_messages[0]))
+
+    def test_authenticate(self):
+        """ Does logging in look the user up by index? """
+
+        with capture_selects() as captured:
+            self.assertTrue(User.authenticate("user1", "password"))
+
+        self.assertNoFullScans(captured)
+
+    def test_post_fan_out(self):
+        """ Does posting find the author's followers by index? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.other_id
+
+            with capture_selects() as captured:
+                c.post('/messages/new', data={'text': 'Hello'})
+
+        self.assertNoFullScans(captured)
+
+    def test_toggle_like(self):
+        """ Does the like endpoint find the message and count by index? """
+
+        msg_id = Message.query.filter_by(user_id=self.other_id).first().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with capture_selects() as captured:
+                c.post(f'/api/v1/messages/{msg_id}/like')
+
+        self.assertNoFullScans(captured)
+
+
+class MigrationTestCase(TestCase):
+    """Test the migration runner."""
+
+    def test_migrate(self):
+        """ Do migrations run once, and not fail on indexes already there? """
+
+        schema_migrations.drop(db.engine, checkfirst=True)
+
+        applied = migrate(db.engine, log=lambda line: None)
+        self.assertEqual([m.version for m in applied],
+                         [m.version for m in MIGRATIONS])
+        self.assertEqual(applied_versions(db.engine),
+                         {m.version for m in MIGRATIONS})
+
+        self.assertEqual(migrate(db.engine, log=lambda line: None), [])
+
+    def test_migrate_original_schema(self):
+        """ Do migrations bring the original schema up to today's? """
+
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        engine = create_engine(f"sqlite:///{path}")
+
+        try:
+            for sql in ORIGINAL_SCHEMA:
+                engine.execute(sql)
+
+            migrate(engine, log=lambda line: None)
+
+            columns = {column['name'] for column
+                       in inspect(engine).get_columns('users')}
+            self.assertLessEqual(set(User.COUNTER_COLUMNS) |
+                                 {'profile_version'}, columns)
+
+            counts = engine.execute(
+                "SELECT id, messages_count, following_count, "
+                "followers_count, likes_count, profile_version "
+                "FROM users ORDER BY id").fetchall()
+            self.assertEqual([tuple(row) for row in counts],
+                             [(1, 1, 1, 0, 0, 1), (2, 0, 0, 1, 1, 1)])
+
+            # user 1's own message; user 2, whom they follow, has none
+            timelines = engine.execute(
+                "SELECT user_id, msg_id FROM timelines").fetchall()
+            self.assertEqual([tuple(row) for row in timelines], [(1, 1)])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+
+# users/messages/follows/likes as they were before any migration
+ORIGINAL_SCHEMA = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE, image_url TEXT,
+        header_image_url TEXT, bio TEXT, location TEXT,
+        password TEXT NOT NULL)""",
+    """CREATE TABLE messages (
+        id INTEGER PRIMARY KEY, text VARCHAR(140) NOT NULL,
+        timestamp DATETIME NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)""",
+    """CREATE TABLE follows (
+        followee_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        follower_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (followee_id, follower_id))""",
+    """CREATE TABLE likes (
+        user_id INTEGER REFERENCES users (id),
+        msg_id INTEGER REFERENCES messages (id),
+        timestamp DATETIME NOT NULL,
+        PRIMARY KEY (user_id, msg_id))""",
+    "INSERT INTO users (id, email, username, password) "
+    "VALUES (1, 'a@test.com', 'a', 'x'), (2, 'b@test.com', 'b', 'x')",
+    "INSERT INTO messages VALUES (1, 'hello', '2018-01-01 00:00:00', 1)",
+    # (followee_id=A, follower_id=B) means "A follows B": 1 follows 2
+    "INSERT INTO follows VALUES (1, 2)",
+    "INSERT INTO likes VALUES (2, 1, '2018-01-02 00:00:00')",
+]
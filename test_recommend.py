@@ -0,0 +1,64 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommend.py
+
+
+from unittest import TestCase, skipUnless
+
+from recommend import Recommender, Snapshot, np
+
+# follower -> followed
+EDGES = [(1, 2), (2, 3), (2, 4), (5, 1), (5, 4), (6, 4)]
+
+
+@skipUnless(np is not None, "needs numpy and scipy")
+class RecommendTestCase(TestCase):
+    """Test friends-of-friends / shared-follower suggestions."""
+
+    def setUp(self):
+        self.snapshot = Snapshot.from_edges(*zip(*EDGES))
+
+    def ids(self, positions):
+        return [int(self.snapshot.ids[pos]) for pos in positions]
+
+    def test_scores(self):
+        """ Are candidates ranked by paths, skipping follows and self? """
+
+        me = np.arange(len(self.snapshot.ids))
+        top = self.snapshot.top_n(self.snapshot.A, me, 3)
+        by_user = {int(self.snapshot.ids[i]): self.ids(t)
+                   for i, t in enumerate(top)}
+
+        # 1 -> 2 -> {3, 4} (friends of friends), and 5 follows 1 and 4
+        # (a shared follower), so 4 beats 3
+        self.assertEqual(by_user[1], [4, 3])
+        # 3 follows nobody; its follower 2 also follows 4
+        self.assertEqual(by_user[3], [4])
+        self.assertEqual(by_user[5], [2])
+
+        self.assertEqual(
+            {self.ids([pos])[0]: self.ids(t)
+             for pos, t in self.snapshot.recompute_all(3).items()},
+            by_user)
+
+    def test_recommender_uses_live_follows(self):
+        """ Do the user's latest follows and popular fallbacks apply? """
+
+        following = {1: [2]}
+
+        recommender = Recommender(load_edges=lambda: zip(*EDGES),
+                                  following=lambda id: following.get(id, []),
+                                  count=3)
+        recommender.run_async = False
+
+        # 4 and 3 are scored; 5 is the most followed account left over
+        self.assertEqual(recommender.suggestions(1), [4, 3, 5])
+
+        # cached until the follow routes invalidate it, then the new
+        # follow counts without waiting for a new snapshot
+        following[1] = [2, 4]
+        self.assertEqual(recommender.suggestions(1), [4, 3, 5])
+        recommender.invalidate(1)
+        self.assertEqual(recommender.suggestions(1), [3, 5, 6])
@@ -0,0 +1,126 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_routing.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Like, Timeline, replica_router
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# exists only on the replica, so a 200 for it means the replica answered
+REPLICA_ONLY_ID = 999999
+
+
+class RoutingTestCase(TestCase):
+    """Test that reads go to a replica and writes stay on the primary.
+
+    The "replica" is a second database (a SQLite file) holding a copy of
+    the users plus one user the primary doesn't have.
+    """
+
+    def setUp(self):
+        Like.query.delete()
+        Timeline.query.delete()
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.use_replica(f"sqlite:///{self.path}")
+
+        replica = db.get_engine(app, bind='replica_0')
+        db.metadata.create_all(bind=replica)
+
+        users = User.__table__
+        rows = [dict(row) for row in db.engine.execute(users.select())]
+        rows.append(dict(rows[0], id=REPLICA_ONLY_ID, username="replicaonly",
+                         email="replica@test.com"))
+        replica.execute(users.insert(), rows)
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['REPLICA_BINDS'] = []
+        app.config['REPLICA_PIN_SECONDS'] = 5
+        replica_router.configure()
+        os.remove(self.path)
+
+    def use_replica(self, url):
+        app.config['SQLALCHEMY_BINDS'] = {'replica_0': url}
+        app.config['REPLICA_BINDS'] = ['replica_0']
+        replica_router.configure()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def test_reads_use_replica(self):
+        """ Are GETs served from the replica, and POSTs from the primary? """
+
+        resp = self.client.get(f'/users/{REPLICA_ONLY_ID}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('replicaonly', resp.get_data(as_text=True))
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post('/messages/new', data={"text": "Hello"})
+            self.assertEqual(resp.status_code, 302)
+
+        # the write went to the primary only
+        self.assertEqual(Message.query.count(), 1)
+        replica = db.get_engine(app, bind='replica_0')
+        self.assertEqual(
+            replica.execute(Message.__table__.select()).fetchall(), [])
+
+    def test_read_your_writes(self):
+        """ After writing, is the user pinned to the primary for a while? """
+
+        with self.client as c:
+            self.login(c)
+
+            self.assertEqual(c.get(f'/users/{REPLICA_ONLY_ID}').status_code,
+                             200)
+
+            c.post('/messages/new', data={"text": "Hello"})
+            self.assertEqual(c.get(f'/users/{REPLICA_ONLY_ID}').status_code,
+                             404)
+
+            app.config['REPLICA_PIN_SECONDS'] = 0
+            c.post('/messages/new', data={"text": "Hello again"})
+            self.assertEqual(c.get(f'/users/{REPLICA_ONLY_ID}').status_code,
+                             200)
+
+    def test_unhealthy_replica(self):
+        """ Does a replica that can't be reached fall back to the primary? """
+
+        self.use_replica("sqlite:////nonexistent/warbler/replica.db")
+
+        resp = self.client.get(f'/users/{REPLICA_ONLY_ID}')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get(f'/users/{self.testuser_id}')
+        self.assertEqual(resp.status_code, 200)
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('warbler_db_replica_healthy{bind="replica_0"} 0', text)
+        self.assertIn('warbler_db_requests_routed_total{bind="primary"}',
+                      text)
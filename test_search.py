@@ -0,0 +1,89 @@
+"""Search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from search import NgramIndex, TextIndex, parse_query
+
+
+class NgramIndexTestCase(TestCase):
+    """Test the in-process username index."""
+
+    def setUp(self):
+        self.index = NgramIndex()
+
+        for id, username in enumerate(["Meow", "meowcodes", "homeowner", "cat"]):
+            self.index.add(id, username)
+
+    def test_ranking(self):
+        """ Are exact, then prefix, then substring matches returned in order? """
+
+        self.assertEqual(self.index.search("meow"), [0, 1, 2])
+        self.assertEqual(self.index.search("owne"), [2])
+        self.assertEqual(self.index.search("dog"), [])
+
+    def test_short_queries_match_prefixes(self):
+        """ Do 1-2 letter queries only match the start of usernames? """
+
+        self.assertEqual(self.index.search("me"), [0, 1])
+        self.assertEqual(self.index.search("c"), [3])
+
+    def test_update_and_remove(self):
+        """ Does re-adding replace an entry and remove drop it? """
+
+        self.index.add(3, "meowcat")
+        self.assertEqual(self.index.search("cat"), [3])
+        self.assertEqual(self.index.search("meow"), [0, 3, 1, 2])
+
+        self.index.remove(3)
+        self.assertEqual(self.index.search("cat"), [])
+        self.assertEqual(len(self.index), 3)
+
+
+class TextIndexTestCase(TestCase):
+    """Test the in-process message text index."""
+
+    def setUp(self):
+        self.index = TextIndex()
+
+        self.index.add(1, "The quick brown fox", datetime(2018, 1, 1))
+        self.index.add(2, "A brown quick dog", datetime(2018, 1, 2))
+        self.index.add(3, "Quickly, the fox ran", datetime(2018, 1, 3))
+
+    def search(self, query, **kwargs):
+        return [id for _, id in self.index.search(parse_query(query), **kwargs)]
+
+    def test_terms_and_prefixes(self):
+        """ Must all terms match, and does word* match by prefix? """
+
+        self.assertEqual(self.search("brown quick"), [2, 1])
+        self.assertEqual(self.search("quick*"), [3, 2, 1])
+        self.assertEqual(self.search("fox quick*"), [3, 1])
+        self.assertEqual(self.search("cat"), [])
+
+    def test_phrases(self):
+        """ Do quoted phrases only match words in order? """
+
+        self.assertEqual(self.search('"quick brown"'), [1])
+        self.assertEqual(self.search('"brown quick"'), [2])
+        self.assertEqual(self.search('"the fox"'), [3])
+
+    def test_keyset_pages(self):
+        """ Are results limited and resumable from a (timestamp, id) key? """
+
+        first = self.index.search(parse_query("quick*"), limit=2)
+        self.assertEqual([id for _, id in first], [3, 2])
+
+        self.assertEqual(self.search("quick*", before=first[-1]), [1])
+
+    def test_remove(self):
+        """ Does removing a message drop it and its vocabulary? """
+
+        self.index.remove(3)
+        self.assertEqual(self.search("quick*"), [2, 1])
+        self.assertNotIn("quickly", self.index.vocabulary)
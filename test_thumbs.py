@@ -0,0 +1,158 @@
+"""Thumbnail tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_thumbs.py
+
+
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from PIL import Image
+
+from thumbs import FetchError, HTTPFetcher, ThumbnailCache, is_public
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, thumbnails
+
+
+def make_image(path, size=(300, 200), color='red'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size, color).save(path, 'JPEG')
+
+
+class ThumbnailTestCase(TestCase):
+    """Test resizing, caching and serving of user images."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.remote = os.path.join(self.tmp, 'remote')
+        make_image(os.path.join(self.remote, 'pics', 'me.jpg'))
+
+        self.old_config = {key: app.config[key] for key in
+                           ('THUMBS_DIR', 'THUMBS_FETCHER',
+                            'THUMBS_LOCAL_ROOT')}
+        app.config['THUMBS_DIR'] = os.path.join(self.tmp, 'cache')
+        app.config['THUMBS_FETCHER'] = 'local'
+        app.config['THUMBS_LOCAL_ROOT'] = self.remote
+        thumbnails.configure()
+        thumbnails.failures.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.old_config)
+        thumbnails.configure()
+        shutil.rmtree(self.tmp)
+
+    def get(self, source, size, **kwargs):
+        resp = self.client.get(thumbnails.url(source, size), **kwargs)
+        resp.get_data()
+        resp.close()
+        return resp
+
+    def test_resize_and_cache(self):
+        """ Is a source fetched once, resized and served immutable? """
+
+        resp = self.get('https://example.com/pics/me.jpg', 'timeline')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (96, 96))
+
+        # every avatar size was rendered from that one fetch
+        os.remove(os.path.join(self.remote, 'pics', 'me.jpg'))
+        resp = self.get('https://example.com/pics/me.jpg', 'profile')
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (400, 400))
+
+        etag = resp.headers['ETag']
+        resp = self.get('https://example.com/pics/me.jpg', 'profile',
+                        headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_fallback_and_signature(self):
+        """ Do broken sources fall back, and forged tokens 404? """
+
+        resp = self.get('https://example.com/missing.jpg', 'card')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (140, 140))
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+
+        self.assertEqual(self.get('', 'hero').status_code, 200)
+
+        url = thumbnails.url('https://example.com/pics/me.jpg', 'card')
+        self.assertEqual(self.client.get(url + 'x').status_code, 404)
+        self.assertEqual(
+            self.client.get(url.replace('/card/', '/huge/')).status_code, 404)
+
+    def test_malformed_source(self):
+        """ Does a source Pillow chokes on fall back, and stay failed? """
+
+        calls = []
+
+        def broken(source):
+            # what Pillow raises for some malformed files
+            calls.append(source)
+            raise ValueError("tile cannot extend outside image")
+
+        thumbnails.fetcher = broken
+
+        for i in range(2):
+            resp = self.get('https://example.com/pics/bad.png', 'card')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (140, 140))
+            self.assertNotIn('immutable', resp.headers['Cache-Control'])
+
+        self.assertEqual(calls, ['https://example.com/pics/bad.png'])
+
+    def test_eviction(self):
+        """ Are least recently used images evicted past the byte cap? """
+
+        cache = ThumbnailCache(os.path.join(self.tmp, 'small'), max_bytes=25)
+
+        cache.put('s', 'a', b'a' * 10, 'image/png')
+        cache.put('s', 'b', b'b' * 10, 'image/png')
+        os.utime(cache.get('s', 'a')[0], (1, 1))
+        cache.put('s', 'c', b'c' * 10, 'image/png')
+
+        self.assertIsNone(cache.get('s', 'a'))
+        self.assertIsNotNone(cache.get('s', 'b'))
+        self.assertIsNotNone(cache.get('s', 'c'))
+
+        # identical content is stored once
+        cache.put('s', 'd', b'c' * 10, 'image/png')
+        self.assertEqual(cache.get('s', 'c')[0], cache.get('s', 'd')[0])
+
+
+class HTTPFetcherTestCase(TestCase):
+    """Test that user-supplied image URLs can't reach internal hosts."""
+
+    def test_is_public(self):
+        """ Are loopback, private, link-local and reserved addresses refused? """
+
+        for ip in ('127.0.0.1', '10.1.2.3', '192.168.0.1', '172.16.0.1',
+                   '169.254.169.254', '100.64.0.1', '0.0.0.0', '240.0.0.1',
+                   '::1', 'fe80::1', 'fd00::1', '::ffff:127.0.0.1'):
+            self.assertFalse(is_public(ip), ip)
+
+        for ip in ('93.184.216.34', '2606:2800:220:1::'):
+            self.assertTrue(is_public(ip), ip)
+
+    def test_refuses_internal_urls(self):
+        """ Does the fetcher refuse internal hosts and non-http schemes? """
+
+        fetch = HTTPFetcher(timeout=1)
+
+        for url in ('http://127.0.0.1/avatar.png',
+                    'http://localhost:5000/avatar.png',
+                    'http://169.254.169.254/latest/meta-data/',
+                    'https://[::1]/avatar.png',
+                    'file:///etc/passwd',
+                    'ftp://example.com/avatar.png'):
+            with self.assertRaises(FetchError):
+                fetch(url)
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, FollowersFollowee
+from models import db, User, Message, FollowersFollowee, Like
+from hashing import hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -34,6 +35,7 @@ class UserModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Like.query.delete()
         User.query.delete()
         Message.query.delete()
         FollowersFollowee.query.delete()
@@ -50,6 +52,9 @@ class UserModelTestCase(TestCase):
 
         self.client = app.test_client()
 
+    def tearDown(self):
+        db.session.rollback()
+
     def test_user_model(self):
         """Does basic model work?"""
 
@@ -154,4 +159,45 @@ class UserModelTestCase(TestCase):
 
         self.assertIs(User.authenticate(username="testuser", password="123456"), self.u1)
         self.assertFalse(User.authenticate(username="testuser2", password="123456"))
-        self.assertFalse(User.authenticate(username="testuser", password="12345"))        
\ No newline at end of file
+        self.assertFalse(User.authenticate(username="testuser", password="12345"))        
+
+    def test_reconcile_counts(self):
+        """ Does reconcile_counts rebuild the cached counters from the base tables? """
+
+        u2 = User(
+            id=2000,
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add(u2)
+        db.session.commit()
+
+        db.session.add(Message(text="hello", user_id=1000))
+        # user 1000 follows user 2000
+        db.session.add(FollowersFollowee(followee_id=1000, follower_id=2000))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(self.u1.messages_count, 1)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.followers_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.following_count, 0)
+
+
+    def test_rehash_on_login(self):
+        """ Does logging in upgrade a hash made at a different bcrypt cost? """
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            self.assertIs(User.authenticate(username="testuser", password="123456"), self.u1)
+            self.assertTrue(self.u1.password.startswith("$2b$04$"))
+            self.assertIs(User.authenticate(username="testuser", password="123456"), self.u1)
+        finally:
+            hasher.rounds = rounds
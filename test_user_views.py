@@ -6,10 +6,14 @@
 
 
 import os
+import re
+from datetime import datetime
 from flask import session
+from html.parser import HTMLParser
 from unittest import TestCase
 
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Like, FollowersFollowee, Timeline
+from querystats import assert_max_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,7 +25,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, user_cache, follow_graph, recommender
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -33,6 +37,31 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+VOID_TAGS = {'img', 'input', 'br', 'hr', 'meta', 'link'}
+
+
+def unclosed_tags(html):
+    """Tags opened in `html` and never closed (or closed out of order)."""
+
+    class Parser(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.stack = []
+
+        def handle_starttag(self, tag, attrs):
+            if tag not in VOID_TAGS:
+                self.stack.append(tag)
+
+        def handle_endtag(self, tag):
+            if self.stack and self.stack[-1] == tag:
+                self.stack.pop()
+            else:
+                self.stack.append(f"/{tag}")
+
+    parser = Parser()
+    parser.feed(html)
+    return parser.stack
+
 
 class UserViewTestCase(TestCase):
     """Test views for user."""
@@ -40,6 +69,9 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Like.query.delete()
+        FollowersFollowee.query.delete()
+        Timeline.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -109,4 +141,371 @@ class UserViewTestCase(TestCase):
 
         self.assertEqual(resp.status_code, 200)
         # gets correct flash msg
-        self.assertIn(b'Log out successful!', resp.data)
\ No newline at end of file
+        self.assertIn(b'Log out successful!', resp.data)
+
+    def test_follow_updates_timeline(self):
+        """ Does following backfill the home timeline and unfollowing prune it? """
+
+        author = User.signup(
+            username="author",
+            email="author@test.com",
+            password="author",
+            image_url=None)
+        db.session.flush()
+        db.session.add(Message(text="Old warble", user_id=author.id))
+        db.session.commit()
+
+        author_id = author.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{author_id}")
+            resp = c.get("/")
+            self.assertIn(b"Old warble", resp.data)
+
+            c.post(f"/users/stop-following/{author_id}")
+            resp = c.get("/")
+            self.assertNotIn(b"Old warble", resp.data)
+            self.assertEqual(
+                Timeline.query.filter_by(author_id=author_id).count(), 0)
+
+    def test_profile_pagination(self):
+        """ Does the profile page hand out a cursor that reaches older messages? """
+
+        for i in range(3):
+            db.session.add(Message(text=f"Warble {i}",
+                                   user_id=self.testuser.id,
+                                   timestamp=datetime(2018, 1, i + 1)))
+        db.session.commit()
+
+        per_page = app.config['MESSAGES_PER_PAGE']
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            resp = self.client.get(f"/users/{self.testuser.id}")
+            self.assertIn(b"Warble 2", resp.data)
+            self.assertIn(b"Warble 1", resp.data)
+            self.assertNotIn(b"Warble 0", resp.data)
+
+            cursor = re.search(rb'\?before=([\w-]+)', resp.data).group(1)
+            resp = self.client.get(
+                f"/users/{self.testuser.id}?before={cursor.decode()}")
+            self.assertIn(b"Warble 0", resp.data)
+            self.assertNotIn(b"Warble 1", resp.data)
+            self.assertNotIn(b"Load more", resp.data)
+
+            resp = self.client.get(f"/users/{self.testuser.id}?before=nope")
+            self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = per_page
+
+    def test_follow_updates_counts(self):
+        """ Do following and unfollowing keep the cached counts in step? """
+
+        other = User.signup(
+            username="other",
+            email="other@test.com",
+            password="other1",
+            image_url=None)
+        db.session.commit()
+
+        other_id = other.id
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f"/users/follow/{other_id}")
+            self.assertEqual(User.query.get(user_id).following_count, 1)
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{other_id}")
+            self.assertEqual(User.query.get(user_id).following_count, 0)
+            self.assertEqual(User.query.get(other_id).followers_count, 0)
+
+    def test_follow_graph(self):
+        """ Do follow routes keep the follow graph current, once per follow? """
+
+        other = User(username="other",
+                     email="other@test.com",
+                     password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+
+        user_id = self.testuser.id
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            self.assertFalse(follow_graph.is_following(user_id, other_id))
+
+            c.post(f"/users/follow/{other_id}")
+            c.post(f"/users/follow/{other_id}")
+            self.assertTrue(follow_graph.is_following(user_id, other_id))
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+
+            resp = c.get(f"/users/{other_id}")
+            self.assertIn(f"/users/stop-following/{other_id}".encode(),
+                          resp.data)
+
+            c.post(f"/users/stop-following/{other_id}")
+            self.assertFalse(follow_graph.is_following(user_id, other_id))
+            self.assertEqual(FollowersFollowee.query.count(), 0)
+
+    def test_follow_with_stale_graph(self):
+        """ Does following go by the database, not this worker's cache? """
+
+        other = User(username="other",
+                     email="other@test.com",
+                     password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+
+        user_id = self.testuser.id
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f"/users/follow/{other_id}")
+
+            # as if another worker made the follow this one hasn't seen
+            follow_graph.remove(user_id, other_id)
+
+            resp = c.post(f"/users/follow/{other_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(follow_graph.is_following(user_id, other_id))
+            self.assertEqual(FollowersFollowee.query.count(), 1)
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+            self.assertEqual(User.query.get(user_id).following_count, 1)
+
+    def test_who_to_follow(self):
+        """ Does the home sidebar suggest friends of friends? """
+
+        friend = User(username="friend",
+                      email="friend@test.com",
+                      password="HASHED_PASSWORD")
+        fof = User(username="friendoffriend",
+                   email="fof@test.com",
+                   password="HASHED_PASSWORD")
+        db.session.add_all([friend, fof])
+        db.session.flush()
+        self.testuser.following.append(friend)
+        friend.following.append(fof)
+        db.session.commit()
+
+        recommender.run_async = False
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get("/")
+                self.assertIn(b"Who to follow", resp.data)
+                self.assertIn(b"@friendoffriend", resp.data)
+        finally:
+            recommender.run_async = True
+
+    def test_query_budgets(self):
+        """ Do the home and profile pages stay within their query budgets? """
+
+        for i in range(6):
+            author = User(username=f"author{i}",
+                          email=f"author{i}@test.com",
+                          password="HASHED_PASSWORD")
+            self.testuser.following.append(author)
+            db.session.flush()
+            msg = Message(text=f"Warble {i}", user_id=author.id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Like(user_id=self.testuser.id, msg_id=msg.id))
+
+        db.session.commit()
+        Timeline.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with assert_max_queries(4):
+                resp = c.get("/")
+            self.assertIn(b"Warble 5", resp.data)
+            self.assertIn("X-DB-Queries", resp.headers)
+
+            with assert_max_queries(4):
+                c.get(f"/users/{self.testuser.id}")
+
+            with assert_max_queries(4):
+                c.get(f"/users/{self.testuser.id}/likes")
+
+    def test_user_directory_pages(self):
+        """ Is the directory paged by id with follow state per page? """
+
+        others = [User(username=f"other{i}",
+                       email=f"other{i}@test.com",
+                       password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(others)
+        db.session.flush()
+        self.testuser.following.append(others[0])
+        db.session.commit()
+        other_ids = [other.id for other in others]
+
+        users_per_page = app.config['USERS_PER_PAGE']
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get("/users")
+                self.assertTrue(resp.is_streamed)
+                body = resp.get_data(as_text=True)
+                self.assertIn("@testuser<", body)
+                self.assertIn("@other0<", body)
+                self.assertNotIn("@other1<", body)
+                self.assertIn(f"/users/stop-following/{other_ids[0]}", body)
+
+                after = re.search(r'\?after=(\d+)', body).group(1)
+                body = c.get(f"/users?after={after}").get_data(as_text=True)
+                self.assertIn("@other1<", body)
+                self.assertIn("@other2<", body)
+                self.assertIn(f"/users/follow/{other_ids[1]}", body)
+                self.assertNotIn("More users", body)
+        finally:
+            app.config['USERS_PER_PAGE'] = users_per_page
+
+    def test_user_search(self):
+        """ Does search rank exact and prefix matches first and offer typeahead? """
+
+        for username in ["xtestuserx", "testuser_b", "test"]:
+            db.session.add(User(username=username,
+                                email=f"{username}@search.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        resp = self.client.get("/users?q=testuser")
+        body = resp.data.decode()
+
+        self.assertLess(body.index("@testuser<"), body.index("@testuser_b<"))
+        self.assertLess(body.index("@testuser_b<"), body.index("@xtestuserx<"))
+        self.assertNotIn("@test<", body)
+
+        resp = self.client.get("/users/typeahead?q=te")
+        usernames = [user["username"] for user in resp.json["users"]]
+        self.assertEqual(usernames, ["test", "testuser", "testuser_b"])
+
+    def test_session_user_cache(self):
+        """ Is the logged-in user served from the cache until their profile changes? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/")
+            hits = user_cache.hits
+
+            resp = c.get("/")
+            self.assertEqual(user_cache.hits, hits + 1)
+            self.assertIn(b"@testuser<", resp.data)
+
+            c.post("/users/profile",
+                   data={"username": "renamed",
+                         "email": "test@test.com",
+                         "password": "testuser"})
+
+            resp = c.get("/")
+            self.assertIn(b"@renamed<", resp.data)
+
+    def test_profile_change_rekeys_message_cards(self):
+        """ Do cached message cards pick up a new username after a profile edit? """
+
+        db.session.add(Message(text="Cached warble", user_id=self.testuser.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn(b">@testuser</a>", resp.data)
+
+            c.post("/users/profile",
+                   data={"username": "renamed",
+                         "email": "test@test.com",
+                         "password": "testuser"})
+
+            resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn(b">@renamed</a>", resp.data)
+            self.assertNotIn(b">@testuser</a>", resp.data)
+
+    def test_cached_message_cards_balanced(self):
+        """ Do cached message cards close every tag they open? """
+
+        other = User.signup(
+            username="other",
+            email="other@test.com",
+            password="other1",
+            image_url=None)
+        db.session.flush()
+        db.session.add(Message(text="Cached warble", user_id=other.id))
+        db.session.commit()
+
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the second render comes from the fragment cache
+            for i in range(2):
+                resp = c.get(f"/users/{other_id}")
+                html = resp.get_data(as_text=True)
+
+                card = re.search(
+                    r'<li class="list-group-item">(.*?)</li>', html, re.S)
+                self.assertIsNotNone(card)
+                self.assertEqual(unclosed_tags(card.group(1)), [])
+                self.assertIn('class="message-link"></a>', card.group(1))
+                self.assertIn('class="like-form"', card.group(1))
+
+    def test_delete_user_updates_like_counts(self):
+        """ Do users who liked a deleted user's messages lose those likes? """
+
+        liker = User.signup(
+            username="liker",
+            email="liker@test.com",
+            password="liker1",
+            image_url=None)
+        db.session.flush()
+
+        for text in ("First", "Second"):
+            msg = Message(text=text, user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Like(user_id=liker.id, msg_id=msg.id))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+        liker_id = liker.id
+        self.assertEqual(User.query.get(liker_id).likes_count, 2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(User.query.get(liker_id).likes_count, 0)
+        self.assertEqual(Like.query.count(), 0)
@@ -0,0 +1,433 @@
+"""Resized avatar and header images, served from a local disk cache.
+
+Users' image_url/header_image_url point anywhere, and templates used to
+show them full size everywhere. Templates now call
+
+    {{ thumb_url(user.image_url, 'timeline') }}
+
+which gives a /thumbs/<size>/<token> URL; the token is the source URL,
+signed with SECRET_KEY so the endpoint can't be used as an open proxy.
+The first request for a source fetches it once and renders every size
+of its kind (avatar or hero) with Pillow.
+
+Rendered images are stored content-addressed (objects/ab/<sha256>), with
+a small ref file per (size, source URL) pointing at the object, so the
+same picture under different URLs is stored once. Hits refresh the
+object's mtime; once the cache passes THUMBS_CACHE_BYTES the least
+recently used objects are deleted.
+
+Sources under /static/ are read from disk. Anything else goes through
+the configured fetcher: 'http' in production, or 'local' (files under
+THUMBS_LOCAL_ROOT, by URL path) in tests and offline development. The
+http fetcher only connects to public addresses (every address a host
+resolves to, on the first request and on each redirect, must be one), so
+a profile image URL can't point the server at localhost, the cloud
+metadata service or the internal network. When a
+source can't be fetched or decoded the default image is served instead
+and the source isn't retried for FAILURE_TTL seconds.
+"""
+
+import http.client
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import urllib.request
+from hashlib import sha256
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from flask import abort, request, send_file
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image, ImageOps
+from werkzeug.security import safe_join
+
+from assets import IMMUTABLE
+from caching import LRUCache
+
+# (kind, width, height, crop) -- twice the CSS size, for high-DPI screens.
+# A height of None keeps the aspect ratio.
+SIZES = {
+    'nav': ('avatar', 64, 64, True),            # .nav > li > a > img
+    'timeline': ('avatar', 96, 96, True),       # .timeline-image
+    'card': ('avatar', 140, 140, True),         # .card-image
+    'profile': ('avatar', 400, 400, True),      # #profile-avatar
+    'card-hero': ('hero', 600, None, False),    # .card-hero
+    'hero': ('hero', 1600, None, False),        # #warbler-hero
+}
+
+# Shown when a user has no image, or theirs can't be fetched or decoded.
+DEFAULTS = {
+    'avatar': '/static/images/default-pic.png',
+    'hero': '/static/images/warbler-hero.jpg',
+}
+
+# Sources that failed are not retried, and their fallback image is
+# cached by browsers, for this many seconds.
+FAILURE_TTL = 300
+
+
+class FetchError(Exception):
+    """The source image couldn't be retrieved."""
+
+
+def is_public(ip):
+    """Is `ip` a globally routable unicast address?"""
+
+    address = ipaddress.ip_address(ip.split('%')[0])
+
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+
+    return address.is_global and not address.is_multicast
+
+
+def connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                   source_address=None):
+    """socket.create_connection, refusing hosts with non-public addresses.
+
+    The address checked is the one connected to, so a DNS answer that
+    changes between check and connect can't slip through.
+    """
+
+    host, port = address
+    found = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+    for family, type, proto, canonname, sockaddr in found:
+        if not is_public(sockaddr[0]):
+            raise FetchError(f"Refusing non-public address {sockaddr[0]} "
+                             f"for {host}")
+
+    return socket.create_connection((found[0][4][0], port), timeout,
+                                    source_address)
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req,
+                            context=self._context)
+
+
+class HTTPRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects to http(s) URLs only."""
+
+    max_redirections = 5
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme not in ('http', 'https'):
+            raise FetchError(f"Unsupported redirect: {newurl}")
+
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def public_opener():
+    """An opener for http(s) to public addresses only: no proxies, no
+    ftp or file URLs."""
+
+    opener = urllib.request.OpenerDirector()
+
+    for handler in (PublicHTTPHandler(), PublicHTTPSHandler(),
+                    HTTPRedirectHandler(),
+                    urllib.request.HTTPDefaultErrorHandler(),
+                    urllib.request.HTTPErrorProcessor()):
+        opener.add_handler(handler)
+
+    return opener
+
+
+class HTTPFetcher:
+    """Fetch http(s) URLs on public hosts, refusing anything larger than
+    `max_bytes`."""
+
+    def __init__(self, timeout=5, max_bytes=10 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.opener = public_opener()
+
+    def __call__(self, url):
+        if urlsplit(url).scheme not in ('http', 'https'):
+            raise FetchError(f"Unsupported URL: {url}")
+
+        try:
+            with self.opener.open(url, timeout=self.timeout) as resp:
+                data = resp.read(self.max_bytes + 1)
+        except (OSError, ValueError) as exc:
+            raise FetchError(str(exc))
+
+        if len(data) > self.max_bytes:
+            raise FetchError(f"Image too large: {url}")
+
+        return data
+
+
+class LocalFetcher:
+    """Read URLs from files under `root`, by URL path (for tests)."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __call__(self, url):
+        path = safe_join(self.root, urlsplit(url).path.lstrip('/'))
+
+        if path is None:
+            raise FetchError(f"Bad path: {url}")
+
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError as exc:
+            raise FetchError(str(exc))
+
+
+def render(data, width, height, crop):
+    """`data` (any format Pillow reads) resized; returns (bytes, mimetype)."""
+
+    img = Image.open(BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+
+    if crop:
+        img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+    else:
+        img.thumbnail((width, height or img.height), Image.LANCZOS)
+
+    out = BytesIO()
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'image/png'
+
+    img.convert('RGB').save(out, 'JPEG', quality=85, optimize=True,
+                            progressive=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+class ThumbnailCache:
+    """Content-addressed, size-bounded disk cache of rendered images."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.bytes = None
+
+    def _ref_path(self, size, url):
+        key = sha256(f"{size}\0{url}".encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, 'refs', key[:2], key)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def get(self, size, url):
+        """(path, mimetype, digest) of the cached image, or None."""
+
+        try:
+            with open(self._ref_path(size, url)) as f:
+                digest, mimetype = f.read().split()
+        except (OSError, ValueError):
+            return None
+
+        path = self._object_path(digest)
+
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted since the ref was written
+            return None
+
+        return path, mimetype, digest
+
+    def put(self, size, url, data, mimetype):
+        """Store rendered `data` for (size, url)."""
+
+        digest = sha256(data).hexdigest()
+        path = self._object_path(digest)
+
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+            self._grow(len(data))
+
+        _write_atomic(self._ref_path(size, url),
+                      f"{digest} {mimetype}".encode('UTF-8'))
+
+    def _objects(self):
+        for root, dirs, files in os.walk(os.path.join(self.directory,
+                                                      'objects')):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def _grow(self, nbytes):
+        with self.lock:
+            if self.bytes is None:
+                self.bytes = sum(st.st_size for path, st in self._objects())
+            else:
+                self.bytes += nbytes
+
+            if self.bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently used objects down to 90% of max_bytes.
+
+        Refs to deleted objects are left behind; get() treats them as
+        misses and the next render overwrites them.
+        """
+
+        objects = sorted(self._objects(), key=lambda item: item[1].st_mtime)
+        total = sum(st.st_size for path, st in objects)
+        target = self.max_bytes * 0.9
+
+        for path, st in objects:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= st.st_size
+            except OSError:
+                pass
+
+        self.bytes = total
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Thumbnails:
+    """The /thumbs/ endpoint and the `thumb_url` template global."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('THUMBS_DIR',
+                              os.path.join(app.instance_path, 'thumbs'))
+        app.config.setdefault('THUMBS_CACHE_BYTES', 256 * 1024 * 1024)
+        app.config.setdefault('THUMBS_FETCHER', 'http')
+        app.config.setdefault('THUMBS_LOCAL_ROOT', None)
+
+        self.app = app
+        self.failures = LRUCache(maxsize=1024, ttl=FAILURE_TTL)
+        self.serializer = URLSafeSerializer(app.config['SECRET_KEY'],
+                                            salt='thumbs')
+        self.configure()
+
+        app.add_url_rule('/thumbs/<size>/<token>', 'thumbs', self.serve)
+        app.jinja_env.globals['thumb_url'] = self.url
+
+    def configure(self):
+        """(Re)build the cache and fetcher from the app's config."""
+
+        config = self.app.config
+        self.cache = ThumbnailCache(config['THUMBS_DIR'],
+                                    config['THUMBS_CACHE_BYTES'])
+
+        if config['THUMBS_FETCHER'] == 'local':
+            self.fetcher = LocalFetcher(config['THUMBS_LOCAL_ROOT'])
+        else:
+            self.fetcher = HTTPFetcher()
+
+    def url(self, source, size):
+        """URL of `source` resized to `size` (a key of SIZES)."""
+
+        kind = SIZES[size][0]
+        token = self.serializer.dumps(source or DEFAULTS[kind])
+        return f"/thumbs/{size}/{token}"
+
+    def fetch(self, source):
+        """Bytes of the image at `source`."""
+
+        if source.startswith('/static/'):
+            return LocalFetcher(self.app.static_folder)(
+                source[len('/static'):])
+
+        return self.fetcher(source)
+
+    def render_all(self, source, kind):
+        """Fetch `source` once and cache every size of `kind`."""
+
+        data = self.fetch(source)
+
+        for size, (size_kind, width, height, crop) in SIZES.items():
+            if size_kind == kind:
+                self.cache.put(size, source,
+                               *render(data, width, height, crop))
+
+    def serve(self, size, token):
+        """Cached thumbnail for the signed source URL in `token`."""
+
+        if size not in SIZES:
+            abort(404)
+
+        try:
+            source = self.serializer.loads(token)
+        except BadSignature:
+            abort(404)
+
+        kind = SIZES[size][0]
+        cache_control = IMMUTABLE
+
+        if self.failures.get(source):
+            source = DEFAULTS[kind]
+            cache_control = f'public, max-age={FAILURE_TTL}'
+
+        cached = self.cache.get(size, source)
+
+        if cached is None:
+            try:
+                self.render_all(source, kind)
+            except Exception as exc:
+                # Anyone can supply the source, so anything it makes go
+                # wrong falls back. OSError covers files Pillow can't
+                # identify; a traceback is logged for anything less usual
+                # (ValueError, SyntaxError, struct.error on some malformed
+                # files).
+                expected = isinstance(exc, (FetchError, OSError,
+                                            Image.DecompressionBombError))
+                self.app.logger.log(logging.INFO if expected
+                                    else logging.WARNING,
+                                    "thumbnail of %s failed: %s", source, exc,
+                                    exc_info=not expected)
+                self.failures.set(source, True)
+                source = DEFAULTS[kind]
+                cache_control = f'public, max-age={FAILURE_TTL}'
+                if self.cache.get(size, source) is None:
+                    self.render_all(source, kind)
+
+            cached = self.cache.get(size, source)
+
+        path, mimetype, digest = cached
+
+        # send_file's own ETag uses the mtime, which every hit refreshes
+        resp = send_file(path, mimetype=mimetype, add_etags=False)
+        resp.set_etag(digest)
+        resp.headers['Cache-Control'] = cache_control
+
+        return resp.make_conditional(request)